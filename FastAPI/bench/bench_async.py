@@ -0,0 +1,69 @@
+'''
+Throughput of the sync vs async keyword search routes at increasing client concurrency.
+
+Both route variants run against the stand-in transport in standin.py, which answers every
+elasticsearch call after a fixed latency. Usage:
+
+    python bench_async.py [--latency 0.1] [--requests 3000] [--clients 50 200 1000]
+'''
+import argparse
+import asyncio
+import statistics
+import time
+
+import standin
+
+
+async def run(app, path, clients, total):
+    '''
+    Fire `total` GETs from `clients` concurrent workers.
+
+    Return:
+        (requests per second, p50 latency in ms, p99 latency in ms, error count)
+    '''
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            status, _ = await standin.asgi_get(app, path, 'keyword=model')
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return total / elapsed, statistics.median(latencies) * 1e3, p99 * 1e3, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--latency', type = float, default = 0.1, help = 'simulated ES latency in seconds')
+    parser.add_argument('--requests', type = int, default = 3000, help = 'requests per run')
+    parser.add_argument('--clients', type = int, nargs = '+', default = [50, 200, 1000])
+    args = parser.parse_args()
+
+    standin.StandInConnection.latency = args.latency
+    standin.AsyncStandInConnection.latency = args.latency
+    app = standin.import_app()
+
+    asyncio.run(report(app, args))
+
+
+async def report(app, args):
+    print(f'{"route":<8}{"clients":>8}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}')
+    for clients in args.clients:
+        for name, path in (('sync', '/api/v0/search/document/'), ('async', '/api/v0/async/search/document/')):
+            rps, p50, p99, errors = await run(app, path, clients, max(args.requests, clients))
+            print(f'{name:<8}{clients:>8}{rps:>10.0f}{p50:>10.1f}{p99:>10.1f}{errors:>8}')
+
+
+if __name__ == '__main__':
+    main()
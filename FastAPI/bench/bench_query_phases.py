@@ -0,0 +1,108 @@
+'''
+Latency of the original fuzzy-only keyword query vs the two-phase exact-then-fuzzy planner.
+
+Needs a running elasticsearch (e.g. the docker-compose cluster, reachable on localhost:9200),
+or the local backend.
+A synthetic registry corpus is bulk-loaded into a scratch index, every keyword is searched
+with both strategies, and the scratch index is deleted afterwards. Usage:
+
+    ES_HOSTS=https://localhost:9200 ES_CA_CERTS=/path/to/ca.crt \
+    python bench_query_phases.py [--docs 20000] [--rounds 20]
+
+With SEARCH_BACKEND=local it runs against the in-process BM25 backend instead of a cluster.
+'''
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from elasticsearch import helpers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import es_client
+import index_template
+import search_query
+
+INDEX = 'bench-registry'
+WORDS = ['segmentation', 'tomography', 'diffraction', 'spectroscopy', 'unet', 'resnet', 'mask', 'label',
+         'peak', 'detection', 'classifier', 'autoencoder', 'denoising', 'reconstruction', 'xray', 'beamline',
+         'microscopy', 'crystal', 'scattering', 'image', 'workflow', 'training', 'inference', 'latent',
+         'clustering', 'regression', 'transformer', 'colorwheel', 'pipeline', 'feature', 'extraction']
+OWNERS = ['mlexchange team', 'lbnl', 'anl', 'slac', 'bnl']
+TYPES = ['model', 'app', 'workflow']
+
+
+def make_doc(i, rng):
+    name = ' '.join(rng.sample(WORDS, 2))
+    return {'name': name, 'version': f'{rng.randint(0, 3)}.{rng.randint(0, 9)}', 'type': rng.choice(['supervised', 'unsupervised']),
+            'uri': f'mlexchange/{name.replace(" ", "-")}:{i}', 'application': rng.sample(WORDS, 2),
+            'reference': f'doi:10.{1000 + i}/{i}', 'description': ' '.join(rng.choices(WORDS, k = 25)),
+            'content_type': rng.choice(TYPES), 'content_id': str(i), 'owner': rng.choice(OWNERS)}
+
+
+def typo(word, rng):
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def timed(es, body, rounds):
+    walls, tooks = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        raw = es.search(index = INDEX, body = body, request_cache = False)
+        walls.append((time.perf_counter() - start) * 1e3)
+        tooks.append(raw['took'])
+    return walls, tooks, raw
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--docs', type = int, default = 20000)
+    parser.add_argument('--rounds', type = int, default = 20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    es = es_client.make_client()
+    es.indices.delete(index = INDEX, ignore = [404])
+    es.indices.create(index = INDEX, body = index_template.index_body())
+    helpers.bulk(es, ({'_index': INDEX, '_id': str(i), '_source': make_doc(i, rng)} for i in range(args.docs)))
+    es.indices.refresh(index = INDEX)
+
+    keywords = rng.sample(WORDS, 8) + [' '.join(rng.sample(WORDS, 2)) for _ in range(4)] + \
+               [typo(word, rng) for word in rng.sample(WORDS, 8)]
+    results = {'fuzzy only': ([], []), 'two-phase': ([], [])}
+    phases = {'exact': 0, 'fuzzy': 0}
+    try:
+        for keyword in keywords:
+            legacy = {'query': {'multi_match': {'query': keyword, 'fuzziness': 'AUTO'}}, 'track_total_hits': True}
+            walls, tooks = timed(es, legacy, args.rounds)[:2]
+            results['fuzzy only'][0].extend(walls)
+            results['fuzzy only'][1].extend(tooks)
+
+            walls, tooks = [0.0] * args.rounds, [0] * args.rounds
+            for phase in search_query.plan_phases('auto'):
+                body = search_query.keyword_search(keyword, phase).to_dict()
+                phase_walls, phase_tooks, raw = timed(es, body, args.rounds)
+                walls = [a + b for a, b in zip(walls, phase_walls)]
+                tooks = [a + b for a, b in zip(tooks, phase_tooks)]
+                if search_query.enough_hits(raw, search_query.FUZZY_MIN_HITS):
+                    break
+            phases[phase] += 1
+            results['two-phase'][0].extend(walls)
+            results['two-phase'][1].extend(tooks)
+    finally:
+        es.indices.delete(index = INDEX, ignore = [404])
+
+    print(f'{args.docs} docs, {len(keywords)} keywords x {args.rounds} rounds; '
+          f'two-phase answered {phases["exact"]} exact / {phases["fuzzy"]} fuzzy')
+    print(f'{"strategy":<12}{"p50 ms":>10}{"p99 ms":>10}{"mean took":>12}')
+    for name, (walls, tooks) in results.items():
+        walls.sort()
+        p99 = walls[min(len(walls) - 1, int(len(walls) * 0.99))]
+        print(f'{name:<12}{statistics.median(walls):>10.1f}{p99:>10.1f}{statistics.mean(tooks):>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
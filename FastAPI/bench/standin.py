@@ -0,0 +1,188 @@
+'''
+Local stand-in transport for benchmarking the search-api without an elasticsearch cluster.
+
+The connection classes answer every request with a canned response after a fixed simulated
+latency, and cap concurrency at the configured pool size the way a real connection pool does.
+'''
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from fnmatch import fnmatchcase
+
+from elasticsearch import Connection
+from elasticsearch._async.http_aiohttp import AsyncConnection
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+INFO = {'name': 'standin', 'cluster_name': 'standin', 'version': {'number': '7.17.1', 'build_flavor': 'default'},
+        'tagline': 'You Know, for Search'}
+CORPUS_SIZE = 25
+INDICES = ['app', 'model', 'workflow']
+HEADERS = {'x-elastic-product': 'Elasticsearch', 'content-type': 'application/json'}
+
+
+def canned_response(method, url, body = None):
+    '''
+    Pick the canned reply for a request path.
+
+    Args:
+        method: HTTP method of the request
+        url: request path, without query string
+        body: serialized request body
+    Return:
+        dict, the JSON body elasticsearch would answer with
+    '''
+    if url == '/':
+        return INFO
+    if url.endswith('/_alias'):
+        patterns = url.strip('/').split('/')[0].split(',')
+        return {index: {'aliases': {}} for index in INDICES if any(fnmatchcase(index, p) for p in patterns)}
+    if url.endswith('/_bulk'):
+        actions = [json.loads(line) for line in body.splitlines() if line.strip()][::2]
+        return {'took': 1, 'errors': False,
+                'items': [{'index': {'_index': a['index']['_index'], '_id': a['index']['_id'],
+                                     'status': 201, 'result': 'created'}} for a in actions]}
+    if url.endswith('/_msearch'):
+        lines = [line for line in body.splitlines() if line.strip()]
+        return {'took': 1, 'responses': [canned_response('POST', '/' + json.loads(header).get('index', '') + '/_search', search)
+                                         for header, search in zip(lines[::2], lines[1::2])]}
+    if url.endswith('/_pit'):
+        return {'id': 'standin-pit'} if method == 'POST' else {'succeeded': True, 'num_freed': 1}
+    if url.endswith('/_search'):
+        query = json.loads(body) if body else {}
+        start = query.get('search_after', [0, -1])[-1] + 1
+        # keywords containing "typo" only match once fuzzy matching is enabled
+        corpus = 0 if b'typo' in body and b'fuzziness' not in body else CORPUS_SIZE
+        hits = [{'_index': 'model', '_type': '_doc', '_id': str(i), '_score': 1.0, 'sort': [1.0, i],
+                 '_source': {'name': f'model {i}', 'content_type': 'model', 'content_id': str(i)}}
+                for i in range(start, min(start + query.get('size', 10), corpus))]
+        shards = len(url.strip('/').split('/')[0].split(',')) if url.count('/') > 1 else len(INDICES)
+        resp = {'took': 1, 'timed_out': False, '_shards': {'total': shards, 'successful': shards, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': corpus, 'relation': 'eq'}, 'max_score': 1.0, 'hits': hits}}
+        if 'aggs' in query:
+            resp['aggregations'] = {name: {'buckets': [{'key': 'standin', 'doc_count': corpus}]} for name in query['aggs']}
+        if 'pit' in query:
+            resp['pit_id'] = query['pit']['id']
+        return resp
+    return {'acknowledged': True, 'result': 'created', '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+
+class StandInConnection(Connection):
+    '''
+    Blocking stand-in, used by the sync client.
+    '''
+    latency = 0.02
+
+    def __init__(self, *args, maxsize = 10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = threading.BoundedSemaphore(maxsize)
+
+    def perform_request(self, method, url, params = None, body = None, timeout = None, ignore = (), headers = None):
+        start = time.perf_counter()
+        with self._pool:
+            time.sleep(self.latency)
+        data = json.dumps(canned_response(method, url, body))
+        self.log_request_success(method, url, url, body, 200, None, time.perf_counter() - start)
+        return 200, HEADERS, data
+
+    def close(self):
+        pass
+
+
+class AsyncStandInConnection(AsyncConnection):
+    '''
+    Asyncio stand-in, used by the async client.
+    '''
+    latency = 0.02
+
+    def __init__(self, *args, maxsize = 10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._maxsize = maxsize
+        self._pool = None
+
+    async def perform_request(self, method, url, params = None, body = None, timeout = None, ignore = (), headers = None):
+        if self._pool is None:
+            self._pool = asyncio.BoundedSemaphore(self._maxsize)
+        start = time.perf_counter()
+        async with self._pool:
+            await asyncio.sleep(self.latency)
+        data = json.dumps(canned_response(method, url, body))
+        self.log_request_success(method, url, url, body, 200, None, time.perf_counter() - start)
+        return 200, HEADERS, data
+
+    async def close(self):
+        pass
+
+
+def import_app():
+    '''
+    Import the search-api with its real clients, then swap them for stand-in backed ones.
+
+    Return:
+        the FastAPI app object from main.py
+    '''
+    os.environ.setdefault('ES_CA_CERTS', '')
+    os.environ.setdefault('ES_HOSTS', 'http://standin:9200')
+    # every request reaches the stand-in elasticsearch instead of being served from the result cache
+    # or sharing the call of an identical search in flight
+    os.environ.setdefault('SEARCH_CACHE_SIZE', '0')
+    os.environ.setdefault('SEARCH_COALESCE', '0')
+    # measure the routes rather than admission control: no request waits for a slot or is shed
+    os.environ.setdefault('ADMISSION_MAX_READS', '1000000')
+    os.environ.setdefault('ADMISSION_MAX_WRITES', '1000000')
+    os.environ.setdefault('ADMISSION_MAX_EXPORTS', '1000000')
+    sys.path.insert(0, SRC_DIR)
+    import es_client
+    import main
+    # report the simulated round trip to the metrics, like the real connection classes
+    timed = lambda cls: type(cls.__name__, (es_client.TimedConnectionMixin, cls), {})
+    es_client.es = es_client.make_client(connection_class = timed(StandInConnection))
+    es_client.aes = es_client.make_async_client(connection_class = timed(AsyncStandInConnection))
+    return main.app
+
+
+async def asgi_request(app, method, path, query = '', chunks = ()):
+    '''
+    Issue one in-process HTTP request against an ASGI app.
+
+    Args:
+        chunks: request body, sent as one ASGI message per chunk
+    Return:
+        (status code, response body bytes)
+    '''
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+             'query_string': query.encode(), 'headers': [(b'host', b'bench')],
+             'client': ('127.0.0.1', 0), 'server': ('bench', 80)}
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in chunks]
+    messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+    status = None
+    body = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            body.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status, b''.join(body)
+
+
+async def asgi_get(app, path, query = ''):
+    '''
+    Issue one in-process GET against an ASGI app.
+
+    Return:
+        (status code, response body bytes)
+    '''
+    return await asgi_request(app, 'GET', path, query)
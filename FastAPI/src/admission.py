@@ -0,0 +1,205 @@
+import asyncio
+import math
+import os
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
+
+from metrics import Counter, InstrumentedRoute
+
+#----------Admission Settings----------#
+# Requests reaching elasticsearch are admitted against budgets of concurrent requests: reads
+# (searches, batches, task status), writes (indexing, updates, deletes), so a bulk ingest
+# cannot take the slots interactive searches need, and exports. Beyond its budget a request
+# waits in a short queue, served round-robin across clients so one busy caller cannot starve
+# the others, and is shed with 429 and Retry-After when the queue is full or the wait too
+# long: failing fast beats letting every caller time out together once the search pools saturate.
+#
+# A budget counts HTTP requests, not elasticsearch calls. A request holds its slot for all its
+# calls, whose number is bounded per route (two query phases for a search, one msearch per
+# round of a batch, BULK_MAX_IN_FLIGHT bulk requests for an ingest), and shedding it halfway
+# would waste the work already done. A streamed response holds its slot until the last chunk
+# is sent: an export pages through its point-in-time for as long as the client reads, so
+# exports get their own small budget rather than tying up read slots for minutes.
+ADMISSION_MAX_READS    = int(os.getenv('ADMISSION_MAX_READS', 32))      # concurrent read requests
+ADMISSION_MAX_WRITES   = int(os.getenv('ADMISSION_MAX_WRITES', 4))      # concurrent write requests
+ADMISSION_MAX_EXPORTS  = int(os.getenv('ADMISSION_MAX_EXPORTS', 2))     # concurrent exports, until their stream ends
+ADMISSION_QUEUE        = int(os.getenv('ADMISSION_QUEUE', 64))          # requests waiting per budget
+ADMISSION_CLIENT_QUEUE = int(os.getenv('ADMISSION_CLIENT_QUEUE', 8))    # requests waiting per client and budget
+ADMISSION_WAIT         = float(os.getenv('ADMISSION_WAIT', 1))          # seconds a request may wait for a slot
+ADMISSION_RETRY_AFTER  = float(os.getenv('ADMISSION_RETRY_AFTER', 1))   # seconds sent in Retry-After
+CLIENT_HEADER          = os.getenv('ADMISSION_CLIENT_HEADER', 'x-client-id')  # falls back to the client address
+
+UNMETERED_ROUTES = ('/healthz', '/readyz', '/metrics', '/search/cache')    # never call elasticsearch
+READ_POSTS       = ('/search/batch',)
+EXPORT_ROUTES    = ('/search/export',)
+
+SHED = Counter('search_api_shed_total', 'Requests rejected with 429 by admission control.', ('budget', 'reason'))
+
+#----------Budgets----------#
+class Overloaded(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class Budget:
+    '''
+    A number of concurrent slots with a bounded wait queue per client. Freed slots go to the
+    waiting clients in turn, and to each client's requests in arrival order.
+    '''
+    def __init__(self, name: str, limit: int, queue: int = ADMISSION_QUEUE,
+                 client_queue: int = ADMISSION_CLIENT_QUEUE, wait: float = ADMISSION_WAIT):
+        self.name, self.limit, self.queue, self.client_queue, self.wait = name, limit, queue, client_queue, wait
+        self.active = 0
+        self.waiting = 0
+        self._queues = OrderedDict()    # client -> deque of waiting futures
+
+    async def acquire(self, client: str):
+        '''
+        Raise:
+            Overloaded when the request cannot get a slot in time
+        '''
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        if self.waiting >= self.queue:
+            raise Overloaded('queue_full')
+        waiters = self._queues.setdefault(client, deque())
+        if len(waiters) >= self.client_queue:
+            raise Overloaded('client_queue_full')
+        slot = asyncio.get_running_loop().create_future()
+        waiters.append(slot)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(slot, self.wait)
+        except BaseException as e:
+            if slot.done() and not slot.cancelled():
+                self.release()      # granted while timing out or being cancelled
+            else:
+                self._discard(client, slot)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Overloaded('wait_timeout')
+            raise
+
+    def _discard(self, client: str, slot: asyncio.Future):
+        waiters = self._queues.get(client)
+        if waiters is not None and slot in waiters:
+            waiters.remove(slot)
+            self.waiting -= 1
+            if not waiters:
+                del self._queues[client]
+
+    def release(self):
+        '''
+        Hand the slot to the next waiting client, or free it.
+        '''
+        while self._queues:
+            client, waiters = next(iter(self._queues.items()))
+            slot = waiters.popleft()
+            self.waiting -= 1
+            if waiters:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
+
+    async def enter(self, client: str):
+        '''
+        acquire() answering 429 with Retry-After when the request is shed.
+        '''
+        try:
+            await self.acquire(client)
+        except Overloaded as e:
+            SHED.inc(self.name, e.reason)
+            raise HTTPException(status_code = 429, detail = f'Too many concurrent {self.name} requests, retry later',
+                                headers = {'Retry-After': str(math.ceil(ADMISSION_RETRY_AFTER))})
+
+    @asynccontextmanager
+    async def admit(self, client: str):
+        await self.enter(client)
+        try:
+            yield
+        finally:
+            self.release()
+
+budgets = {'read': Budget('read', ADMISSION_MAX_READS), 'write': Budget('write', ADMISSION_MAX_WRITES),
+           'export': Budget('export', ADMISSION_MAX_EXPORTS)}
+
+def route_budget(path: str, methods: set) -> str:
+    '''
+    The budget of a route: "read", "write", "export", or None for routes that never call
+    elasticsearch.
+    '''
+    if path.endswith(UNMETERED_ROUTES):
+        return None
+    if path.endswith(EXPORT_ROUTES):
+        return 'export'
+    if methods <= {'GET', 'HEAD'} or path.endswith(READ_POSTS):
+        return 'read'
+    return 'write'
+
+def client_id(request) -> str:
+    '''
+    The client a request is queued for: the client header when sent, else its address.
+    '''
+    return request.headers.get(CLIENT_HEADER) or (request.client.host if request.client else 'unknown')
+
+def metric_lines() -> list:
+    '''
+    Exposition lines of the budgets, for metrics.register_collector.
+    '''
+    lines = ['# HELP search_api_admitted_requests Requests holding an admission slot.',
+             '# TYPE search_api_admitted_requests gauge']
+    lines += [f'search_api_admitted_requests{{budget="{name}"}} {budget.active}' for name, budget in budgets.items()]
+    lines += ['# HELP search_api_queued_requests Requests waiting for an admission slot.',
+              '# TYPE search_api_queued_requests gauge']
+    lines += [f'search_api_queued_requests{{budget="{name}"}} {budget.waiting}' for name, budget in budgets.items()]
+    return lines + SHED.render()
+
+#----------Route Admission----------#
+class HeldResponse:
+    '''
+    A streamed response keeping its admission slot until it has been sent, or the client left.
+    '''
+    def __init__(self, response: StreamingResponse, budget: Budget):
+        self.response, self.budget = response, budget
+        self.status_code = response.status_code
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.budget.release()
+
+class AdmissionMixin:
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        name = route_budget(self.path, self.methods)
+        if name is None:
+            return handler
+        budget = budgets[name]
+
+        async def admitted_handler(request):
+            await budget.enter(client_id(request))
+            try:
+                response = await handler(request)
+            except BaseException:
+                budget.release()
+                raise
+            if isinstance(response, StreamingResponse):
+                return HeldResponse(response, budget)
+            budget.release()
+            return response
+        return admitted_handler
+
+class AdmittedRoute(InstrumentedRoute, AdmissionMixin, APIRoute):
+    '''
+    InstrumentedRoute admitting requests against the read or write budget, so the latency
+    it records includes the time spent waiting for a slot.
+    '''
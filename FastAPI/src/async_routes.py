@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+
+import es_client
+from admission import AdmittedRoute
+
+#----------Async Router----------#
+# Async variants of every route main.py defines with @routes. main.py mounts them here and
+# includes the router under API_URL_PREFIX + '/async'; they talk to elasticsearch through the
+# pooled AsyncElasticsearch client, so an in-flight request no longer holds one of the
+# Starlette threadpool threads. The request handling is shared in handlers.py.
+router = APIRouter(route_class = AdmittedRoute)
+
+#----------Lifecycle----------#
+@router.on_event('shutdown')
+async def close_async_client():
+    '''
+    Release the pooled aiohttp connections when the app stops.
+    '''
+    await es_client.aes.close()
@@ -0,0 +1,159 @@
+import os
+import time
+
+from elasticsearch import exceptions
+from pydantic import ValidationError
+
+from cache import result_cache, facet_cache, cache_key, facet_key
+from indices import requested_indices
+from models import SearchQuery
+from search_query import keyword_search, plan_phases, enough_hits, page_response, empty_page, check_facets, \
+                         add_facets, facet_response
+
+#----------Batch Settings----------#
+MAX_BATCH_QUERIES = int(os.getenv('MAX_BATCH_QUERIES', 50))    # queries accepted per batch request
+
+#----------Batch Search----------#
+class _Entry:
+    '''
+    Planning state of one query of a batch.
+    '''
+    def __init__(self, query: SearchQuery, phases: list, filters: dict, facets: list):
+        self.query = query
+        self.phases = phases
+        self.filters = filters
+        self.facets = facets
+        self.patterns = requested_indices(query.index, query.content_type)
+        self.indices = None
+        self.step = 0           # index into phases of the next phase to run
+        self.key = self.fkey = None
+        self.page = self.counts = None
+        self.started = None
+
+class SearchBatch:
+    '''
+    Runs a list of keyword searches in as few msearch round trips as possible and collects
+    the pages in request order.
+
+    Every query starts with its first planned phase in one shared msearch. Only the queries
+    whose exact phase found fewer than min_hits documents go into a second msearch with
+    their fuzzy phase. Pages and facet counts go through the same caches as
+    /search/document/. A query that fails validation or errors in elasticsearch only fails
+    its own result entry.
+
+    The routes resolve the unresolved() entries, send every body yielded by rounds() with
+    msearch and pass the response to feed(), or the exception to fail().
+    '''
+    def __init__(self, queries: list):
+        self._start = time.monotonic()
+        self.results = [None] * len(queries)
+        self._entries = {}
+        self._round = []
+        for i, raw in enumerate(queries):
+            try:
+                query = SearchQuery.parse_obj(raw)
+                phases = plan_phases(query.match, None, query.keyword)
+                filters = {'content_type': query.content_type, 'owner': query.owner,
+                           'application': query.application, 'version': query.version}
+                facets = check_facets(query.facets)
+                keyword_search(query.keyword, phases[0], filters, query.size, query.from_, query.exact_total)
+            except ValidationError as e:
+                self.results[i] = {'status': 400, 'error': [{k: v for k, v in error.items() if k != 'ctx'} for error in e.errors()]}
+                continue
+            except ValueError as e:
+                self.results[i] = {'status': 400, 'error': str(e)}
+                continue
+            self._entries[i] = _Entry(query, phases, filters, facets)
+
+    def unresolved(self) -> list:
+        '''
+        Entries whose index patterns still have to be resolved to concrete indices.
+        '''
+        return [entry for entry in self._entries.values() if entry.indices is None]
+
+    def _search(self, entry: _Entry):
+        q = entry.query
+        if entry.page is not None:
+            # page cached but not its facets: count them without fetching hits again
+            s = keyword_search(q.keyword, entry.page['phase'], entry.filters, 0, 0, q.exact_total)
+            return add_facets(s, entry.facets, q.facet_size)
+        s = keyword_search(q.keyword, entry.phases[entry.step], entry.filters, q.size, q.from_, q.exact_total)
+        if entry.fkey and entry.counts is None:
+            s = add_facets(s, entry.facets, q.facet_size)
+        return s
+
+    def _lookup(self):
+        '''
+        Answer what the caches and the resolved index sets already can.
+        '''
+        for i, entry in list(self._entries.items()):
+            q = entry.query
+            if not entry.indices:
+                self._finish(i, dict(empty_page(q.size, q.from_)))
+                continue
+            first = keyword_search(q.keyword, entry.phases[0], entry.filters, q.size, q.from_, q.exact_total)
+            entry.key = cache_key(entry.indices, first.to_dict(), entry.phases, q.min_hits)
+            if entry.facets:
+                entry.fkey = facet_key(entry.indices, first, entry.phases, q.min_hits, entry.facets, q.facet_size)
+                entry.counts = facet_cache.get(entry.fkey)
+            entry.page = result_cache.get(entry.key)
+            entry.started = time.monotonic()
+            if entry.page is not None and (entry.fkey is None or entry.counts is not None):
+                self._finish(i, dict(entry.page, facets = entry.counts))
+
+    def _finish(self, i: int, result: dict):
+        result.setdefault('status', 200)
+        self.results[i] = result
+        del self._entries[i]
+
+    def rounds(self):
+        '''
+        Yield the NDJSON-ready msearch body of each round until every query is answered;
+        feed() the response of a round before asking for the next one.
+        '''
+        self._lookup()
+        while self._entries:
+            self._round = list(self._entries)
+            body = []
+            for i in self._round:
+                entry = self._entries[i]
+                body.append({'index': ','.join(entry.indices), 'ignore_unavailable': True})
+                body.append(self._search(entry).to_dict())
+            yield body
+
+    def feed(self, resp: dict):
+        '''
+        Consume the msearch response of the current round.
+        '''
+        for i, raw in zip(self._round, resp['responses']):
+            entry = self._entries[i]
+            q = entry.query
+            if 'error' in raw:
+                self._finish(i, {'status': raw.get('status', 500), 'error': raw['error']})
+                continue
+            if entry.page is None:
+                phase = entry.phases[entry.step]
+                entry.step += 1
+                if not enough_hits(raw, q.min_hits) and entry.step < len(entry.phases):
+                    continue
+                entry.page = result_cache.put(entry.key, entry.indices, page_response(raw, q.size, q.from_, phase), entry.started)
+            if entry.fkey and entry.counts is None:
+                entry.counts = facet_cache.put(entry.fkey, entry.indices, facet_response(raw), entry.started)
+            self._finish(i, dict(entry.page, facets = entry.counts))
+
+    def fail(self, e: exceptions.TransportError):
+        '''
+        Fail every query of the current round after the msearch request itself failed.
+        '''
+        status = e.status_code if isinstance(e.status_code, int) else 503
+        for i in self._round:
+            self._finish(i, {'status': status, 'error': str(e)})
+
+    def response(self) -> dict:
+        '''
+        The batch response: one result per query, in request order.
+        '''
+        return {'took': int((time.monotonic() - self._start) * 1000),
+                'items': len(self.results),
+                'errors': sum(1 for result in self.results if 'error' in result),
+                'results': self.results}
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+from elasticsearch import exceptions
+from pydantic import ValidationError
+
+from embeddings import embedding_fields
+from index_template import aensure_index
+from models import NewDocument
+from vectors import vector_store
+
+#----------Bulk Settings----------#
+BULK_BATCH_DOCS    = int(os.getenv('BULK_BATCH_DOCS', 500))          # documents per bulk request
+BULK_BATCH_BYTES   = int(os.getenv('BULK_BATCH_BYTES', 5 * 2**20))   # payload bytes per bulk request
+BULK_MAX_IN_FLIGHT = int(os.getenv('BULK_MAX_IN_FLIGHT', 2))         # bulk requests sent concurrently
+BULK_MAX_LINE_BYTES = int(os.getenv('BULK_MAX_LINE_BYTES', 2**20))   # longest accepted NDJSON line
+
+#----------NDJSON Stream----------#
+async def iter_lines(chunks, max_line_bytes: int = BULK_MAX_LINE_BYTES):
+    '''
+    Split a stream of byte chunks into lines without reading the whole stream.
+
+    Args:
+        chunks: async iterator of bytes, e.g. Request.stream()
+        max_line_bytes: lines longer than this are dropped instead of buffered
+    Return:
+        async generator of (line number, line bytes), the line is None when it was too long
+    '''
+    buf = bytearray()
+    line_no = 0
+    overflow = False
+    async for chunk in chunks:
+        buf += chunk
+        *lines, tail = buf.split(b'\n')
+        buf = bytearray(tail)
+        for line in lines:
+            line_no += 1
+            yield line_no, None if overflow else bytes(line)
+            overflow = False
+        if len(buf) > max_line_bytes:
+            overflow = True
+            buf.clear()
+    if buf or overflow:
+        yield line_no + 1, None if overflow else bytes(buf)
+
+#----------Bulk Requests----------#
+async def send_batch(client, batch: list) -> list:
+    '''
+    Index one batch of validated documents with a single bulk request. The documents are
+    embedded together in a worker thread, off the event loop.
+
+    Args:
+        client: AsyncElasticsearch client
+        batch: list of (line number, index, document id, document dict)
+    Return:
+        list of per-item results, in batch order
+    '''
+    body = []
+    try:
+        for index in {index for _, index, _, _ in batch}:
+            await aensure_index(client, index)
+    except exceptions.TransportError as e:
+        status = e.status_code if isinstance(e.status_code, int) else 503
+        return [{'line': line_no, '_index': index, '_id': doc_id, 'status': status, 'error': str(e)}
+                for line_no, index, doc_id, _ in batch]
+    embeddings = await asyncio.to_thread(embedding_fields, [doc for _, _, _, doc in batch])
+    for (_, index, doc_id, doc), embedding in zip(batch, embeddings):
+        body.append({'index': {'_index': index, '_id': doc_id}})
+        body.append(dict(doc, embedding = embedding))
+    try:
+        resp = await client.bulk(body = body)
+    except exceptions.TransportError as e:
+        status = e.status_code if isinstance(e.status_code, int) else 503
+        return [{'line': line_no, '_index': index, '_id': doc_id, 'status': status, 'error': str(e)}
+                for line_no, index, doc_id, _ in batch]
+    results = []
+    for (line_no, _, _, _), embedding, item in zip(batch, embeddings, resp['items']):
+        item = item['index']
+        result = {'line': line_no, '_index': item['_index'], '_id': item['_id'], 'status': item['status']}
+        if 'error' in item:
+            result['error'] = item['error']
+        else:
+            result['result'] = item['result']
+            vector_store.upsert(item['_index'], item['_id'], embedding)
+        results.append(result)
+    return results
+
+async def bulk_ingest(client, chunks, index: str = None, batch_docs: int = BULK_BATCH_DOCS,
+                      max_in_flight: int = BULK_MAX_IN_FLIGHT) -> dict:
+    '''
+    Validate NDJSON lines against NewDocument and index them in bounded bulk batches.
+
+    Only the current batch plus max_in_flight batches awaiting elasticsearch are held in
+    memory; reading the request stream pauses while the in-flight limit is reached.
+
+    Args:
+        client: AsyncElasticsearch client
+        chunks: async iterator of bytes holding one NewDocument per line
+        index: target index, defaults to each document's content_type
+        batch_docs: maximum number of documents per bulk request
+        max_in_flight: maximum number of bulk requests awaiting a response
+    Return:
+        dict with the number of items, the number of failed items and per-item results in line order
+    '''
+    start = time.monotonic()
+    results = []
+    in_flight = deque()
+    batch, batch_bytes = [], 0
+    try:
+        async for line_no, line in iter_lines(chunks):
+            if line is None:
+                results.append({'line': line_no, 'status': 413, 'error': f'Line exceeds {BULK_MAX_LINE_BYTES} bytes'})
+                continue
+            if not line.strip():
+                continue
+            try:
+                doc = NewDocument.parse_raw(line)
+            except ValidationError as e:
+                errors = [{k: v for k, v in error.items() if k != 'ctx'} for error in e.errors()]
+                results.append({'line': line_no, 'status': 400, 'error': errors})
+                continue
+            batch.append((line_no, index or doc.content_type, doc.content_id, doc.dict()))
+            batch_bytes += len(line)
+            if len(batch) >= batch_docs or batch_bytes >= BULK_BATCH_BYTES:
+                in_flight.append(asyncio.ensure_future(send_batch(client, batch)))
+                batch, batch_bytes = [], 0
+                if len(in_flight) >= max_in_flight:
+                    results.extend(await in_flight.popleft())
+        if batch:
+            in_flight.append(asyncio.ensure_future(send_batch(client, batch)))
+        while in_flight:
+            results.extend(await in_flight.popleft())
+    finally:
+        for task in in_flight:
+            task.cancel()
+    results.sort(key = lambda result: result['line'])
+    return {'took': int((time.monotonic() - start) * 1000),
+            'items': len(results),
+            'errors': sum(1 for result in results if 'error' in result),
+            'results': results}
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+
+#----------Cache Settings----------#
+# Writes through the search-api invalidate the pages they affect. Writes made straight to
+# elasticsearch, like the Mining sync, are only seen once the pages expire: SEARCH_CACHE_TTL
+# bounds how stale a page can be after such a write.
+SEARCH_CACHE_SIZE  = int(os.getenv('SEARCH_CACHE_SIZE', 1024))     # cached pages, 0 disables the cache
+SEARCH_CACHE_TTL   = float(os.getenv('SEARCH_CACHE_TTL', 60))      # seconds a cached page stays valid
+REFRESH_GRACE      = float(os.getenv('REFRESH_GRACE', 1.5))        # index.refresh_interval plus some slack
+
+def cache_key(indices: list, body: dict, *extra) -> tuple:
+    '''
+    Normalized cache key: the target index set plus the exact request body (query and paging),
+    and any extra request options that change the result.
+    '''
+    return (tuple(sorted(indices)), json.dumps(body, sort_keys = True, separators = (',', ':'))) + tuple(map(str, extra))
+
+def _matches(patterns, index: str) -> bool:
+    '''
+    True when an index name (or pattern) overlaps any of the given index names/patterns.
+    '''
+    return any(fnmatchcase(index, pattern) or fnmatchcase(pattern, index) for pattern in patterns)
+
+#----------LRU + TTL Cache----------#
+class ResultCache:
+    '''
+    Thread-safe LRU cache with per-entry TTL for search results.
+
+    Entries remember the indices they were computed from, so a write to one index only drops
+    the entries that could contain it. Results of searches that started before a write became
+    visible (the write time plus REFRESH_GRACE) are never stored, which keeps a search racing
+    with a write, or running before the next refresh, from caching stale hits.
+    '''
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL,
+                 refresh_grace: float = REFRESH_GRACE, clock = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_grace = refresh_grace
+        self._clock = clock
+        self._entries = OrderedDict()   # key -> (expires at, indices, value)
+        self._written = {}              # index -> time of the last write
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, key):
+        '''
+        Return the cached value, or None on a miss.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, indices: list, value, started: float):
+        '''
+        Store a value computed from the given indices by a search that started at `started`
+        (a self._clock() timestamp). Returns the value so callers can chain it.
+        '''
+        if self.maxsize <= 0:
+            return value
+        with self._lock:
+            since = started - self.refresh_grace
+            if any(when >= since and _matches(indices, index) for index, when in self._written.items()):
+                return value
+            self._entries[key] = (self._clock() + self.ttl, tuple(indices), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, index: str):
+        '''
+        Drop every entry computed from `index` (a name, pattern or comma separated list).
+        '''
+        now = self._clock()
+        with self._lock:
+            for name in index.split(','):
+                self._written[name] = now
+                stale = [key for key, (_, indices, _) in self._entries.items() if _matches(indices, name)]
+                for key in stale:
+                    del self._entries[key]
+                self.invalidations += len(stale)
+            horizon = now - self.refresh_grace - self.ttl
+            self._written = {name: when for name, when in self._written.items() if when >= horizon}
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations,
+                    'invalidations': self.invalidations}
+
+result_cache = ResultCache()
+facet_cache  = ResultCache()    # facet counts, kept apart so paging reuses them
+
+def facet_key(indices: list, s, phases: list, min_hits: int, facets: list, facet_size: int) -> tuple:
+    '''
+    Cache key of facet counts: like cache_key, but only over the query, since the counts
+    do not depend on which page is requested.
+    '''
+    return cache_key(indices, {'query': s.to_dict().get('query')}, phases, min_hits, facets, facet_size)
+
+def invalidate(index: str):
+    '''
+    Drop cached pages and facet counts computed from `index` after a write.
+    '''
+    result_cache.invalidate(index)
+    facet_cache.invalidate(index)
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import threading
+
+from cache import cache_key
+
+#----------Coalescing Settings----------#
+SEARCH_COALESCE = os.getenv('SEARCH_COALESCE', '1').lower() in ('1', 'true')   # 0 sends every search to elasticsearch
+
+#----------Single Flight----------#
+class _Call:
+    '''
+    One in-flight call of the blocking path, waited on by the requests it was coalesced with.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Shares one in-flight call among concurrent callers asking for the same key: the first
+    caller (the leader) runs it, the others wait and receive its result or its exception.
+    Nothing is kept once the call returns, so unlike the result cache it never serves a
+    stale answer; it only collapses identical requests that overlap in time.
+
+    do() serves the threadpool routes, ado() the asyncio routes; a key in flight on one
+    path is not shared with the other.
+    '''
+    def __init__(self):
+        self._calls = {}        # key -> _Call of the blocking path
+        self._tasks = {}        # key -> asyncio.Task of the asyncio path
+        self._lock = threading.Lock()
+        self.leaders = self.coalesced = 0
+
+    def do(self, key, fn):
+        '''
+        Run fn() unless an identical call is in flight, then wait for that one instead.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def ado(self, key, fn):
+        '''
+        Await fn() unless an identical call is in flight, then await that one instead. The
+        shared task is shielded, so a cancelled caller does not cancel it for the others.
+        '''
+        task = self._tasks.get(key)
+        with self._lock:
+            if task is None:
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'in_flight': len(self._calls) + len(self._tasks),
+                    'leaders': self.leaders, 'coalesced': self.coalesced}
+
+single_flight = SingleFlight()
+
+def search(client, index: str, body: dict, **params) -> dict:
+    '''
+    es.search() through single_flight, keyed on the target indices and the request body.
+    '''
+    if not SEARCH_COALESCE:
+        return client.search(index = index, body = body, **params)
+    return single_flight.do(cache_key([index], body), lambda: client.search(index = index, body = body, **params))
+
+async def asearch(client, index: str, body: dict, **params) -> dict:
+    '''
+    search() with the asyncio client.
+    '''
+    if not SEARCH_COALESCE:
+        return await client.search(index = index, body = body, **params)
+    return await single_flight.ado(cache_key([index], body), lambda: client.search(index = index, body = body, **params))
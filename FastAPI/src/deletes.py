@@ -0,0 +1,175 @@
+import os
+import threading
+import time
+
+from elasticsearch import exceptions
+
+import cache
+from bulk import BULK_BATCH_DOCS
+from search_query import matching_search
+from vectors import vector_store
+
+#----------Delete Settings----------#
+# Deletes by query run as elasticsearch background tasks, split into slices that delete in
+# parallel and throttled to a rate of documents per second, so retiring a whole owner or
+# application does not starve the searches served by the same cluster.
+DELETE_REQUESTS_PER_SECOND = float(os.getenv('DELETE_REQUESTS_PER_SECOND', 500))   # -1 disables throttling
+DELETE_SLICES              = os.getenv('DELETE_SLICES', 'auto')                   # "auto": one slice per shard
+MAX_DELETE_IDS             = int(os.getenv('MAX_DELETE_IDS', 10000))               # ids accepted per bulk delete
+DELETE_TASK_CHECK_INTERVAL = float(os.getenv('DELETE_TASK_CHECK_INTERVAL', 1))     # seconds between checks of pending tasks by searches
+
+#----------Delete by Query----------#
+def delete_query(keyword: str, phase: str, filters: dict) -> dict:
+    '''
+    The delete-by-query body removing the documents a search with the same keyword and
+    filters would return.
+
+    Raise:
+        ValueError when neither a keyword nor a filter narrows the deletion
+    '''
+    if not keyword and not any(filters.values()):
+        raise ValueError('Give a keyword or a filter, deleting every document is not allowed')
+    return {'query': matching_search(keyword, phase, filters).to_dict()['query']}
+
+def check_throttle(requests_per_second: float):
+    '''
+    Raise:
+        ValueError unless the rate is positive, or -1 to disable throttling
+    '''
+    if requests_per_second <= 0 and requests_per_second != -1:
+        raise ValueError('requests_per_second must be positive, or -1 to disable throttling')
+
+class DeleteTasks:
+    '''
+    Delete-by-query tasks started by this process and the indices they delete from. Once a
+    task completes, the cached pages and loaded vectors of its indices are dropped: when a
+    poll of /tasks/{task} sees it completed, or else when a search checks the pending tasks.
+    '''
+    def __init__(self, check_interval: float = DELETE_TASK_CHECK_INTERVAL, clock = time.monotonic):
+        self.check_interval = check_interval
+        self._clock = clock
+        self._indices = {}      # task id -> indices
+        self._checked = float('-inf')
+        self._lock = threading.Lock()
+
+    def track(self, task_id: str, indices: list):
+        with self._lock:
+            self._indices[task_id] = indices
+
+    def due(self) -> list:
+        '''
+        Return:
+            the pending tasks to check, empty when there are none or they were checked less
+            than check_interval seconds ago
+        '''
+        with self._lock:
+            now = self._clock()
+            if not self._indices or now - self._checked < self.check_interval:
+                return []
+            self._checked = now
+            return list(self._indices)
+
+    def completed(self, task_id: str):
+        '''
+        Stop tracking a completed task and drop what was cached from its indices.
+        '''
+        with self._lock:
+            indices = self._indices.pop(task_id, [])
+        for name in indices:
+            cache.invalidate(name)
+            vector_store.drop(name)
+
+    def settle(self, client, task_ids: list):
+        '''
+        Check pending tasks with the blocking client, see due().
+        '''
+        for task_id in task_ids:
+            try:
+                self._checked_task(task_id, client.tasks.get(task_id = task_id))
+            except exceptions.NotFoundError:
+                self.completed(task_id)     # its result is gone, so it ended long ago
+            except exceptions.TransportError:
+                pass                        # checked again after check_interval
+
+    async def asettle(self, client, task_ids: list):
+        '''
+        settle() with the asyncio client.
+        '''
+        for task_id in task_ids:
+            try:
+                self._checked_task(task_id, await client.tasks.get(task_id = task_id))
+            except exceptions.NotFoundError:
+                self.completed(task_id)
+            except exceptions.TransportError:
+                pass
+
+    def _checked_task(self, task_id: str, resp: dict):
+        if resp.get('completed'):
+            self.completed(task_id)
+
+delete_tasks = DeleteTasks()
+
+def task_status(task_id: str, resp: dict) -> dict:
+    '''
+    Progress of a delete-by-query task from a tasks API response, settling the task when it
+    completed.
+
+    Return:
+        dict with the task id, whether it completed or was cancelled, the documents to delete
+        (total), deleted so far, version conflicts, batches, the throttle, failures and the
+        error of a failed task
+    '''
+    status = resp['task'].get('status', {})
+    final = resp.get('response', {})
+    total = status.get('total', 0)
+    if resp.get('completed'):
+        delete_tasks.completed(task_id)
+    return {'task': task_id,
+            'completed': resp.get('completed', False),
+            'cancelled': resp['task'].get('cancelled', False) or bool(final.get('canceled')),
+            'total': total,
+            'deleted': status.get('deleted', 0),
+            'progress': status.get('deleted', 0) / total if total else 1.0 if resp.get('completed') else 0.0,
+            'version_conflicts': status.get('version_conflicts', 0),
+            'batches': status.get('batches', 0),
+            'requests_per_second': status.get('requests_per_second'),
+            'running_time_in_nanos': resp['task'].get('running_time_in_nanos'),
+            'failures': final.get('failures', []),
+            'error': resp.get('error')}
+
+#----------Bulk Delete----------#
+def delete_batches(index: str, ids: list):
+    '''
+    Split ids into bulk delete request bodies of at most BULK_BATCH_DOCS actions.
+
+    Return:
+        generator of (ids of the batch, bulk body)
+    '''
+    for start in range(0, len(ids), BULK_BATCH_DOCS):
+        batch = ids[start:start + BULK_BATCH_DOCS]
+        yield batch, [{'delete': {'_index': index, '_id': doc_id}} for doc_id in batch]
+
+def delete_results(batch: list, resp: dict = None, error: exceptions.TransportError = None) -> list:
+    '''
+    Per-id results of one bulk delete: its response items, or the error of the whole request.
+    '''
+    if error is not None:
+        status = error.status_code if isinstance(error.status_code, int) else 503
+        return [{'_id': doc_id, 'status': status, 'error': str(error)} for doc_id in batch]
+    results = []
+    for doc_id, item in zip(batch, resp['items']):
+        item = item['delete']
+        result = {'_id': doc_id, 'status': item['status']}
+        if 'error' in item:
+            result['error'] = item['error']
+        else:
+            result['result'] = item['result']
+        results.append(result)
+    return results
+
+def delete_response(start: float, results: list) -> dict:
+    return {'took': int((time.monotonic() - start) * 1000),
+            'items': len(results),
+            'deleted': sum(1 for result in results if result.get('result') == 'deleted'),
+            'errors': sum(1 for result in results if 'error' in result),
+            'results': results}
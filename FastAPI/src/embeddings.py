@@ -0,0 +1,77 @@
+import importlib
+import os
+import re
+import zlib
+
+import numpy as np
+
+#----------Embedding Settings----------#
+# EMBEDDER is "hashing" (offline, CPU only) or "package.module:factory", a callable returning an
+# object with `name`, `dim` and `embed(texts) -> (len(texts), dim) array`, e.g. a wrapper around
+# a sentence-transformers model.
+EMBEDDER    = os.getenv('EMBEDDER', 'hashing')
+EMBED_DIM   = int(os.getenv('EMBED_DIM', 256))
+EMBED_FIELDS = ('name', 'application', 'description')     # document fields the text embedding covers
+_TOKEN = re.compile(r'\w+')
+
+class HashingEmbedder:
+    '''
+    Feature-hashing embedder: words and their character trigrams are hashed (crc32, stable
+    across processes) into `dim` signed buckets and the vector is L2-normalized. Trigrams let
+    word variants such as "segment" / "segmentation" land close together; no model download
+    or GPU is needed.
+    '''
+    def __init__(self, dim: int = EMBED_DIM):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def _features(self, text: str):
+        for word in _TOKEN.findall(text.lower()):
+            yield word, 1.0
+            padded = f'<{word}>'
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype = np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode())
+                vectors[row, h % self.dim] += weight if h & 0x80000000 else -weight
+        norms = np.linalg.norm(vectors, axis = 1, keepdims = True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+def load_embedder(spec: str = EMBEDDER):
+    '''
+    Build the embedder named by an EMBEDDER value.
+    '''
+    if spec == 'hashing':
+        return HashingEmbedder()
+    module, _, factory = spec.partition(':')
+    return getattr(importlib.import_module(module), factory)()
+
+embedder = load_embedder()
+
+def doc_text(source: dict) -> str:
+    '''
+    The text of a registry document that gets embedded.
+    '''
+    parts = []
+    for field in EMBED_FIELDS:
+        value = source.get(field)
+        parts += value if isinstance(value, list) else [value] if value else []
+    return ' '.join(map(str, parts))
+
+def embedding_fields(sources: list) -> list:
+    '''
+    The "embedding" fields stored with documents at index time: the model name and the vector,
+    rounded to keep the stored source small. The documents are embedded in one batch.
+    '''
+    vectors = embedder.embed([doc_text(source) for source in sources])
+    return [{'model': embedder.name, 'vector': [round(float(x), 5) for x in vector]} for vector in vectors]
+
+def embedding_field(source: dict) -> dict:
+    '''
+    embedding_fields() of one document.
+    '''
+    return embedding_fields([source])[0]
@@ -0,0 +1,184 @@
+import os
+import threading
+from ssl import create_default_context
+from time import perf_counter
+
+import aiohttp
+from elasticsearch import Elasticsearch, AsyncElasticsearch, AIOHttpConnection, AsyncTransport, Transport, \
+                          Urllib3HttpConnection, exceptions
+from elasticsearch._async.compat import get_running_loop
+from elasticsearch._async.http_aiohttp import ESClientResponse
+
+import local_backend
+import metrics
+
+#----------Connection Settings----------#
+# Every value can be overridden from the container environment.
+ES_HOSTS        = os.getenv('ES_HOSTS', 'https://es01:9200').split(',')
+ES_USER         = os.getenv('ES_USER', 'elastic')
+ES_PASSWORD     = os.getenv('ES_PASSWORD', 'elastic')
+ES_CA_CERTS     = os.getenv('ES_CA_CERTS', '/app/fastapi/src/certs/ca/ca.crt')
+ES_POOL_MAXSIZE = int(os.getenv('ES_POOL_MAXSIZE', 50))        # connections kept open per node
+ES_ASYNC_POOL_MAXSIZE = int(os.getenv('ES_ASYNC_POOL_MAXSIZE', 100))  # same for the async client, not capped by the threadpool
+ES_KEEPALIVE    = float(os.getenv('ES_KEEPALIVE', 75))         # seconds an idle pooled connection stays open
+ES_TIMEOUT      = float(os.getenv('ES_TIMEOUT', 10))           # default timeout for any ES call
+ES_SEARCH_TIMEOUT = float(os.getenv('ES_SEARCH_TIMEOUT', 5))   # per-request timeout for search calls
+SEARCH_BACKEND  = os.getenv('SEARCH_BACKEND', 'elasticsearch')  # "local" serves every call from local_backend.py
+
+#----------Instrumentation----------#
+class TimedConnectionMixin:
+    '''
+    Reports the HTTP round trip the connection already measures for its request log.
+    '''
+    def log_request_success(self, method, full_url, path, body, status_code, response, duration):
+        metrics.record_round_trip(duration)
+        super().log_request_success(method, full_url, path, body, status_code, response, duration)
+
+    def log_request_fail(self, method, full_url, path, body, duration, *args, **kwargs):
+        metrics.record_round_trip(duration)
+        super().log_request_fail(method, full_url, path, body, duration, *args, **kwargs)
+
+class TimedUrllib3HttpConnection(TimedConnectionMixin, Urllib3HttpConnection):
+    pass
+
+class TimedLocalConnection(TimedConnectionMixin, local_backend.LocalConnection):
+    pass
+
+class TimedAsyncLocalConnection(TimedConnectionMixin, local_backend.AsyncLocalConnection):
+    pass
+
+class MeasuredTransport(Transport):
+    '''
+    Transport recording every call in the elasticsearch metrics (took, network, serialization, errors).
+    '''
+    def perform_request(self, method, url, headers = None, params = None, body = None):
+        started = metrics.es_started()
+        try:
+            resp = super().perform_request(method, url, headers = headers, params = params, body = body)
+        except exceptions.TransportError as e:
+            metrics.es_finished(url, started, error = e)
+            raise
+        metrics.es_finished(url, started, resp)
+        return resp
+
+class MeasuredAsyncTransport(AsyncTransport):
+    '''
+    MeasuredTransport for the asyncio client.
+    '''
+    async def perform_request(self, method, url, headers = None, params = None, body = None):
+        started = metrics.es_started()
+        try:
+            resp = await super().perform_request(method, url, headers = headers, params = params, body = body)
+        except exceptions.TransportError as e:
+            metrics.es_finished(url, started, error = e)
+            raise
+        metrics.es_finished(url, started, resp)
+        return resp
+
+#----------Async Connection----------#
+class KeepAliveAIOHttpConnection(TimedConnectionMixin, AIOHttpConnection):
+    '''
+    AIOHttpConnection whose pooled connections honour a configurable keep-alive.
+
+    The stock connection builds its aiohttp connector with the default 15s keep-alive,
+    which makes a quiet search-api reopen TLS connections after every pause in traffic.
+    '''
+    def __init__(self, *args, keepalive_timeout = ES_KEEPALIVE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._keepalive_timeout = keepalive_timeout
+
+    async def _create_aiohttp_session(self):
+        if self.loop is None:
+            self.loop = get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers = self.headers,
+            skip_auto_headers = ("accept", "accept-encoding", "user-agent"),
+            auto_decompress = True,
+            loop = self.loop,
+            cookie_jar = aiohttp.DummyCookieJar(),
+            response_class = ESClientResponse,
+            connector = aiohttp.TCPConnector(
+                limit = self._limit,
+                keepalive_timeout = self._keepalive_timeout,
+                use_dns_cache = True,
+                enable_cleanup_closed = True,
+                ssl = self._ssl_context,
+            ),
+        )
+
+#----------Client Factories----------#
+def _client_kwargs(**overrides):
+    '''
+    Shared settings for the sync and async clients.
+
+    Args:
+        overrides: keyword arguments replacing the defaults (e.g. connection_class for benchmarks)
+    Return:
+        dict of keyword arguments for Elasticsearch / AsyncElasticsearch
+    '''
+    kwargs = {
+        'http_auth': (ES_USER, ES_PASSWORD),
+        'maxsize':   ES_POOL_MAXSIZE,
+        'timeout':   ES_TIMEOUT,
+    }
+    if ES_CA_CERTS and SEARCH_BACKEND != 'local':
+        kwargs['ssl_context'] = create_default_context(cafile = ES_CA_CERTS)
+    kwargs.update(overrides)
+    return kwargs
+
+def make_client(**overrides) -> Elasticsearch:
+    '''
+    Build the blocking client used by the sync routes.
+    '''
+    local = SEARCH_BACKEND == 'local'
+    overrides.setdefault('connection_class', TimedLocalConnection if local else TimedUrllib3HttpConnection)
+    overrides.setdefault('transport_class', MeasuredTransport)
+    return Elasticsearch(ES_HOSTS, **_client_kwargs(**overrides))
+
+def make_async_client(**overrides) -> AsyncElasticsearch:
+    '''
+    Build the asyncio client used by the async routes. The aiohttp session is opened lazily
+    on the first request, so this is safe to call outside of the event loop.
+    '''
+    local = SEARCH_BACKEND == 'local'
+    overrides.setdefault('connection_class', TimedAsyncLocalConnection if local else KeepAliveAIOHttpConnection)
+    overrides.setdefault('maxsize', ES_ASYNC_POOL_MAXSIZE)
+    overrides.setdefault('transport_class', MeasuredAsyncTransport)
+    return AsyncElasticsearch(ES_HOSTS, **_client_kwargs(**overrides))
+
+#----------Lazy Clients----------#
+class LazyClient:
+    '''
+    Stands for a client built on first use, so importing the search-api needs neither the
+    cluster nor its CA certificate. Attribute access is forwarded to the built client.
+    '''
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._build(), name)
+
+def build_clients() -> float:
+    '''
+    Build both clients now rather than on the first request.
+
+    Return:
+        seconds spent, mostly loading the CA certificate into the TLS contexts
+    '''
+    start = perf_counter()
+    for client in (es, aes):
+        if isinstance(client, LazyClient):
+            client._build()
+    return perf_counter() - start
+
+es  = LazyClient(make_client)
+aes = LazyClient(make_async_client)
@@ -0,0 +1,76 @@
+import json
+import os
+
+from elasticsearch import exceptions
+
+from es_client import ES_SEARCH_TIMEOUT
+from search_query import export_search, enough_hits
+
+#----------Export Settings----------#
+EXPORT_PAGE_SIZE  = int(os.getenv('EXPORT_PAGE_SIZE', 1000))    # documents fetched per search_after page
+EXPORT_KEEP_ALIVE = os.getenv('EXPORT_KEEP_ALIVE', '5m')         # point-in-time kept open between pages
+
+def hit_line(hit: dict) -> bytes:
+    '''
+    One NDJSON line of the export: the document, where it lives and its sort key.
+    '''
+    line = {'_index': hit['_index'], '_id': hit['_id'], '_source': hit['_source'], 'sort': hit['sort']}
+    return json.dumps(line, separators = (',', ':')).encode() + b'\n'
+
+async def close_pit(client, pit_id: str):
+    '''
+    Release a point-in-time, ignoring one that already expired.
+    '''
+    try:
+        await client.close_point_in_time(body = {'id': pit_id})
+    except exceptions.TransportError:
+        pass
+
+#----------Streaming Export----------#
+async def open_export(client, indices: list, keyword: str, phases: list, filters: dict, min_hits: int,
+                      after: list = None, page_size: int = EXPORT_PAGE_SIZE):
+    '''
+    Open a point-in-time over the indices and fetch the first page, so errors surface before
+    the response starts. Like /search/document/, the fuzzy phase only answers when the exact
+    one finds fewer than min_hits documents.
+
+    Args:
+        client: AsyncElasticsearch client
+        indices: concrete indices to export from
+        keyword, phases, filters: the search, see search_query.keyword_search
+        min_hits: fewest exact matches that answer without the fuzzy fallback
+        after: sort key of the last document already exported, to resume an export
+        page_size: documents fetched per page
+    Return:
+        (phase that answered, async iterator of NDJSON chunks, one per page)
+    '''
+    pit_id = (await client.open_point_in_time(index = ','.join(indices), keep_alive = EXPORT_KEEP_ALIVE))['id']
+    try:
+        for phase in phases:
+            s = export_search(keyword, phase, filters, pit_id, after, page_size, EXPORT_KEEP_ALIVE)
+            raw = await client.search(body = s.to_dict(), request_timeout = ES_SEARCH_TIMEOUT)
+            pit_id = raw['pit_id']
+            if enough_hits(raw, min_hits):
+                break
+    except BaseException:
+        await close_pit(client, pit_id)
+        raise
+    return phase, stream_export(client, raw, keyword, phase, filters, page_size)
+
+async def stream_export(client, raw: dict, keyword: str, phase: str, filters: dict, page_size: int):
+    '''
+    Yield the pages of an export one at a time, starting from an already fetched one, so
+    only a single page is held in memory however many documents match. The point-in-time
+    is closed when the export ends or the client goes away.
+    '''
+    try:
+        while True:
+            hits = raw['hits']['hits']
+            if hits:
+                yield b''.join(hit_line(hit) for hit in hits)
+            if len(hits) < page_size:
+                break
+            s = export_search(keyword, phase, filters, raw['pit_id'], hits[-1]['sort'], page_size, EXPORT_KEEP_ALIVE)
+            raw = await client.search(body = s.to_dict(), request_timeout = ES_SEARCH_TIMEOUT)
+    finally:
+        await close_pit(client, raw['pit_id'])
@@ -0,0 +1,410 @@
+import asyncio
+import functools
+import time
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from elasticsearch import exceptions
+
+import cache
+import coalesce
+import es_client
+from batch import SearchBatch, MAX_BATCH_QUERIES
+from cache import result_cache, facet_cache, cache_key, facet_key
+from deletes import delete_tasks, delete_query, check_throttle, delete_batches, delete_results, delete_response, \
+                    task_status, MAX_DELETE_IDS
+from embeddings import embedding_fields
+from es_client import ES_SEARCH_TIMEOUT
+from index_template import index_body, ensure_index, aensure_index, forget_index
+from indices import index_resolver, requested_indices
+from profiling import profile_sampler, profiled_search, aprofiled_search, check_profile, is_admin
+from search_query import keyword_search, plan_phases, enough_hits, page_response, empty_page, hit_list, \
+                         decode_cursor, query_hash, check_facets, add_facets, facet_response, PIT_KEEP_ALIVE
+from updates import UpdateBatch, check_update, needs_source, guard, updated_source, update_body, UPDATE_RETRIES, \
+                    MAX_UPDATE_DOCS
+from vectors import vector_store, vector_search, avector_search, check_mode
+
+#----------Elasticsearch Calls----------#
+# The request handling shared by the sync routes and their async variants. Each handler is a
+# generator yielding the elasticsearch calls it needs and receiving their responses; run()
+# drives it with the blocking client, arun() with the asyncio one. A call that raises has its
+# exception thrown back into the handler where it yielded.
+#
+# A call names a client method ("search", "indices.create", ...) or one of the helpers below,
+# which have a blocking and an asyncio version taking the client first.
+HELPERS = {
+    'resolve':          (index_resolver.resolve, index_resolver.aresolve),
+    'ensure_index':     (ensure_index, aensure_index),
+    'coalesced_search': (coalesce.search, coalesce.asearch),
+    'vector_search':    (vector_search, avector_search),
+    'profiled_search':  (profiled_search, aprofiled_search),
+    'settle_deletes':   (delete_tasks.settle, delete_tasks.asettle),
+    'embeddings':       (lambda client, docs: embedding_fields(docs),
+                         lambda client, docs: asyncio.to_thread(embedding_fields, docs)),   # off the event loop
+}
+
+def call(operation: str, *args, **kwargs) -> tuple:
+    return operation, args, kwargs
+
+def _target(client, operation: str, asynchronous: bool):
+    if operation in HELPERS:
+        return functools.partial(HELPERS[operation][asynchronous], client)
+    target = client
+    for name in operation.split('.'):
+        target = getattr(target, name)
+    return target
+
+def run(handler, client):
+    '''
+    Drive a handler with the blocking client.
+
+    Return:
+        the value the handler returns
+    '''
+    send, value = handler.send, None
+    while True:
+        try:
+            operation, args, kwargs = send(value)
+        except StopIteration as done:
+            return done.value
+        try:
+            send, value = handler.send, _target(client, operation, False)(*args, **kwargs)
+        except Exception as e:
+            send, value = handler.throw, e
+
+async def arun(handler, client):
+    '''
+    run() with the asyncio client.
+    '''
+    send, value = handler.send, None
+    while True:
+        try:
+            operation, args, kwargs = send(value)
+        except StopIteration as done:
+            return done.value
+        try:
+            send, value = handler.send, await _target(client, operation, True)(*args, **kwargs)
+        except Exception as e:
+            send, value = handler.throw, e
+
+#----------Shared Routes----------#
+class Routes:
+    '''
+    Routes defined once and mounted both on the app, answered with the blocking client from
+    the threadpool, and on the async router, answered with the asyncio client on the event loop.
+    An endpoint takes the request parameters and returns the handler answering them.
+    '''
+    def __init__(self):
+        self.endpoints = []     # (method, path, endpoint, route options) in definition order
+
+    def route(self, method: str, path: str, **options):
+        def register(endpoint):
+            self.endpoints.append((method, path, endpoint, options))
+            return endpoint
+        return register
+
+    def get(self, path: str, **options):
+        return self.route('GET', path, **options)
+
+    def post(self, path: str, **options):
+        return self.route('POST', path, **options)
+
+    def patch(self, path: str, **options):
+        return self.route('PATCH', path, **options)
+
+    def delete(self, path: str, **options):
+        return self.route('DELETE', path, **options)
+
+    def mount(self, router, prefix: str = '', asynchronous: bool = False):
+        '''
+        Add every route to `router`, under `prefix`.
+        '''
+        wrap = _async_route if asynchronous else _blocking_route
+        for method, path, endpoint, options in self.endpoints:
+            router.add_api_route(prefix + path, wrap(endpoint, options.get('status_code', 200)), methods = [method], **options)
+
+# Handlers return what elasticsearch answered or dicts built from it, which are JSON already:
+# the routes send it as is rather than through FastAPI's jsonable_encoder, whose walk over
+# every hit cost more than the rest of a search.
+def _blocking_route(endpoint, status_code: int):
+    @functools.wraps(endpoint)
+    def route(*args, **kwargs):
+        return JSONResponse(run(endpoint(*args, **kwargs), es_client.es), status_code = status_code)
+    return route
+
+def _async_route(endpoint, status_code: int):
+    @functools.wraps(endpoint)
+    async def route(*args, **kwargs):
+        return JSONResponse(await arun(endpoint(*args, **kwargs), es_client.aes), status_code = status_code)
+    return route
+
+#----------Search----------#
+def search(keyword: str, index: str, content_type: list, owner: list, application: list, version: list, size: int,
+           from_: int, exact_total: bool, deep: bool, cursor: str, match: str, min_hits: int, facets: list,
+           facet_size: int, mode: str, envelope: bool, profile: bool, x_admin_token: str):
+    '''
+    GET /search/document/, see main.search().
+    '''
+    if profile and not is_admin(x_admin_token):
+        raise HTTPException(status_code = 403, detail = 'Profiling requires an admin token')
+    try:
+        if (deep or cursor) and not envelope:
+            raise ValueError('Deep paging returns a cursor with each page, pass envelope=true')
+        if facets and not envelope:
+            raise ValueError('Facet counts are returned in the page envelope, pass envelope=true')
+        if profile and not envelope:
+            raise ValueError('The profile is returned in the page envelope, pass envelope=true')
+        filters = {'content_type': content_type, 'owner': owner, 'application': application, 'version': version}
+        query = query_hash(keyword, filters, index)
+        state = decode_cursor(cursor, query) if cursor else {'pit': None, 'after': None, 'phase': None}
+        phases = plan_phases(match, state['phase'], keyword)
+        first = keyword_search(keyword, phases[0], filters, size, from_, exact_total, state['pit'], state['after'])
+        facets = check_facets(facets)
+        check_mode(mode, keyword, deep or cursor, facets, from_, size)
+        if profile:
+            check_profile(mode, deep or cursor)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    pending = delete_tasks.due()
+    if pending:
+        yield call('settle_deletes', pending)
+    indices = [] if cursor else (yield call('resolve', requested_indices(index, content_type)))
+    if not cursor and not indices:
+        page = empty_page(size, from_)
+        return page if envelope else hit_list(page['hits'])
+    fkey = facet_key(indices, first, phases, min_hits, facets, facet_size) if facets and not cursor else None
+    counts = facet_cache.get(fkey) if fkey else None
+    started = time.monotonic()
+    if mode != 'keyword':
+        key = cache_key(indices, first.to_dict(), phases, min_hits, mode)
+        page = result_cache.get(key)
+        if page is None:
+            page = yield call('vector_search', indices, keyword, mode, filters, phases, min_hits, size, from_)
+            page = result_cache.put(key, indices, page, started)
+        return dict(page, facets = None) if envelope else hit_list(page['hits'])
+    if profile and profile_sampler.sample():
+        return (yield call('profiled_search', indices, keyword, phases, filters, size, from_, exact_total, min_hits,
+                           facets, facet_size))
+    if not deep and not cursor:
+        key = cache_key(indices, first.to_dict(), phases, min_hits)
+        page = result_cache.get(key)
+        if page is None:
+            for phase in phases:
+                s = keyword_search(keyword, phase, filters, size, from_, exact_total)
+                if fkey and counts is None:
+                    s = add_facets(s, facets, facet_size)
+                raw = yield call('coalesced_search', ','.join(indices), s.to_dict(), ignore_unavailable = True,
+                                 request_timeout = ES_SEARCH_TIMEOUT)
+                if enough_hits(raw, min_hits):
+                    break
+            page = result_cache.put(key, indices, page_response(raw, size, from_, phase), started)
+        elif fkey and counts is None:
+            # page cached but not its facets: count them without fetching hits again
+            s = add_facets(keyword_search(keyword, page['phase'], filters, 0, 0, exact_total), facets, facet_size)
+            raw = yield call('coalesced_search', ','.join(indices), s.to_dict(), ignore_unavailable = True,
+                             request_timeout = ES_SEARCH_TIMEOUT)
+        if fkey and counts is None:
+            counts = facet_cache.put(fkey, indices, facet_response(raw), started)
+        if not envelope:
+            return hit_list(page['hits'])
+        page = dict(page, facets = counts)
+        if profile:
+            page['profile'] = {'sampled': False}
+        return page
+    if state['pit'] is None:
+        state['pit'] = (yield call('open_point_in_time', index = ','.join(indices), keep_alive = PIT_KEEP_ALIVE))['id']
+    try:
+        for phase in phases:
+            s = keyword_search(keyword, phase, filters, size, from_, exact_total, state['pit'], state['after'])
+            if fkey and counts is None:
+                s = add_facets(s, facets, facet_size)
+            raw = yield call('search', body = s.to_dict(), request_timeout = ES_SEARCH_TIMEOUT)
+            state['pit'] = raw['pit_id']
+            if enough_hits(raw, min_hits):
+                break
+    except exceptions.NotFoundError as e:
+        raise HTTPException(status_code = 404, detail = f'Cursor expired, restart the search: {e}')
+    if fkey and counts is None:
+        counts = facet_cache.put(fkey, indices, facet_response(raw), started)
+    page = page_response(raw, size, from_, phase, query)
+    if page['cursor'] is None:
+        yield call('close_point_in_time', body = {'id': raw['pit_id']})
+    return dict(page, facets = counts)
+
+def search_batch(queries: list):
+    '''
+    POST /search/batch, see main.search_batch().
+    '''
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code = 400, detail = f'At most {MAX_BATCH_QUERIES} queries per batch')
+    batch = SearchBatch(queries)
+    pending = delete_tasks.due()
+    if pending:
+        yield call('settle_deletes', pending)
+    for entry in batch.unresolved():
+        entry.indices = yield call('resolve', entry.patterns)
+    for body in batch.rounds():
+        try:
+            batch.feed((yield call('msearch', body = body, request_timeout = ES_SEARCH_TIMEOUT)))
+        except exceptions.TransportError as e:
+            batch.fail(e)
+    return batch.response()
+
+#----------Index----------#
+def create_index(name: str):
+    '''
+    POST /index, see main.create_index().
+    '''
+    try:
+        resp = yield call('indices.create', index = name, body = index_body())
+    except exceptions.RequestError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    cache.invalidate(name)
+    index_resolver.invalidate(name)
+    return resp
+
+def delete_index(index: str):
+    '''
+    DELETE /index/{index}, see main.delete_index().
+    '''
+    try:
+        resp = yield call('indices.delete', index = index)
+    except exceptions.NotFoundError as e:
+        raise HTTPException(status_code = 404, detail = str(e))
+    forget_index(index)
+    vector_store.drop(index)
+    cache.invalidate(index)
+    index_resolver.invalidate(index)
+    return resp
+
+#----------Document----------#
+def index_doc(index: str, doc_id: str, doc: dict):
+    '''
+    POST /index/document, see main.index_doc().
+    '''
+    yield call('ensure_index', index)
+    embedding, = yield call('embeddings', [doc])
+    resp = yield call('index', index = index, id = doc_id, document = dict(doc, embedding = embedding))
+    vector_store.upsert(index, doc_id, embedding)
+    cache.invalidate(index)
+    index_resolver.invalidate(index)
+    return resp
+
+def update_doc(index: str, doc_id: str, changes: dict, if_seq_no: int, if_primary_term: int):
+    '''
+    PATCH /index/{index}/document/{doc_id}, see main.update_doc().
+    '''
+    try:
+        check_update(changes, if_seq_no, if_primary_term)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    for attempt in range(1, UPDATE_RETRIES + 1):
+        try:
+            current = (yield call('get', index = index, id = doc_id)) if needs_source(changes) else None
+            embedding = (yield call('embeddings', [updated_source(changes, current)]))[0] if current else None
+            resp = yield call('update', index = index, id = doc_id, body = update_body(changes, embedding),
+                              **guard(if_seq_no, if_primary_term, current))
+            break
+        except exceptions.NotFoundError as e:
+            raise HTTPException(status_code = 404, detail = str(e))
+        except exceptions.ConflictError as e:
+            if if_seq_no is not None or attempt == UPDATE_RETRIES:
+                raise HTTPException(status_code = 409, detail = str(e))
+    if embedding is not None:
+        vector_store.upsert(index, doc_id, embedding)
+    cache.invalidate(index)
+    return resp
+
+def update_docs(index: str, updates: list):
+    '''
+    PATCH /index/{index}/documents/bulk, see main.update_docs().
+    '''
+    if len(updates) > MAX_UPDATE_DOCS:
+        raise HTTPException(status_code = 400, detail = f'At most {MAX_UPDATE_DOCS} updates per request')
+    batch = UpdateBatch(index, updates)
+    for fetch in batch.rounds():
+        try:
+            if fetch is not None:
+                batch.feed_sources((yield call('mget', body = fetch)))
+                batch.feed_embeddings((yield call('embeddings', batch.sources())))
+            body = batch.bulk_body()
+            if body:
+                batch.feed((yield call('bulk', body = body)))
+        except exceptions.TransportError as e:
+            batch.fail(e)
+    cache.invalidate(index)
+    return batch.response()
+
+def delete_doc(index: str, doc_id: str):
+    '''
+    DELETE /index/{index}/document/{doc_id}, see main.delete_doc().
+    '''
+    try:
+        yield call('delete', index = index, id = doc_id)
+    except exceptions.NotFoundError as e:
+        raise HTTPException(status_code = 404, detail = str(e))
+    vector_store.remove(index, doc_id)
+    cache.invalidate(index)
+    print(f'Successfully deleted content_id: {doc_id} within "{index}" category')
+
+def delete_by_query(keyword: str, index: str, content_type: list, owner: list, application: list, version: list,
+                    match: str, requests_per_second: float, slices: str):
+    '''
+    DELETE /index/documents/query, see main.delete_by_query().
+    '''
+    filters = {'content_type': content_type, 'owner': owner, 'application': application, 'version': version}
+    try:
+        check_throttle(requests_per_second)
+        body = delete_query(keyword, match, filters)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    indices = yield call('resolve', requested_indices(index, content_type))
+    if not indices:
+        raise HTTPException(status_code = 404, detail = 'No index to delete from')
+    resp = yield call('delete_by_query', index = ','.join(indices), body = body, wait_for_completion = False,
+                      conflicts = 'proceed', slices = slices, requests_per_second = requests_per_second)
+    delete_tasks.track(resp['task'], indices)
+    for name in indices:
+        cache.invalidate(name)
+    return {'task': resp['task'], 'indices': indices}
+
+def delete_docs(index: str, ids: list):
+    '''
+    DELETE /index/{index}/documents/bulk, see main.delete_docs().
+    '''
+    if len(ids) > MAX_DELETE_IDS:
+        raise HTTPException(status_code = 400, detail = f'At most {MAX_DELETE_IDS} ids per request')
+    start = time.monotonic()
+    results = []
+    for batch, body in delete_batches(index, ids):
+        try:
+            results += delete_results(batch, (yield call('bulk', body = body)))
+        except exceptions.TransportError as e:
+            results += delete_results(batch, error = e)
+    for result in results:
+        if result.get('result') == 'deleted':
+            vector_store.remove(index, result['_id'])
+    cache.invalidate(index)
+    return delete_response(start, results)
+
+#----------Tasks----------#
+def get_task(task: str):
+    '''
+    GET /tasks/{task}, see main.get_task().
+    '''
+    try:
+        resp = yield call('tasks.get', task_id = task)
+    except exceptions.NotFoundError as e:
+        raise HTTPException(status_code = 404, detail = str(e))
+    return task_status(task, resp)
+
+def cancel_task(task: str):
+    '''
+    DELETE /tasks/{task}, see main.cancel_task().
+    '''
+    try:
+        yield call('tasks.cancel', task_id = task)
+        resp = yield call('tasks.get', task_id = task)
+    except exceptions.NotFoundError as e:
+        raise HTTPException(status_code = 404, detail = str(e))
+    return task_status(task, resp)
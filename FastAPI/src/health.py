@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+
+from elasticsearch import exceptions
+from starlette.concurrency import run_in_threadpool
+
+import es_client
+from index_template import install_template
+from indices import index_resolver, requested_indices
+
+#----------Probe Settings----------#
+# /healthz only says the process serves requests. /readyz also needs the startup warmup to
+# have finished (clients built, index template installed, pooled connections opened and every
+# registry index queried once) and elasticsearch to answer a ping.
+WARMUP_CONNECTIONS = int(os.getenv('WARMUP_CONNECTIONS', 4))    # pooled connections opened per client
+WARMUP_RETRY       = float(os.getenv('WARMUP_RETRY', 5))        # seconds between warmup attempts
+READY_CHECK_TTL    = float(os.getenv('READY_CHECK_TTL', 2))     # seconds a ping result is reused
+READY_TIMEOUT      = float(os.getenv('READY_TIMEOUT', 1))       # timeout of the readiness ping
+
+#----------Readiness----------#
+class Readiness:
+    '''
+    Startup progress and timings of the search-api, and the cached result of the last
+    elasticsearch ping.
+    '''
+    def __init__(self, clock = time.monotonic):
+        self._clock = clock
+        self.started = clock()
+        self.phases = {}            # warmup phase -> seconds of the successful attempt
+        self.indices = {}           # registry index -> milliseconds of its warmup query
+        self.attempts = 0
+        self.error = None
+        self.ready_after = None     # seconds from process start to the end of the warmup
+        self._ping = (None, False)  # (checked at, elasticsearch answered)
+
+    @property
+    def warm(self) -> bool:
+        return self.ready_after is not None
+
+    def uptime(self) -> float:
+        return self._clock() - self.started
+
+    async def check(self) -> bool:
+        '''
+        Ping elasticsearch, at most once per READY_CHECK_TTL seconds.
+        '''
+        checked, ok = self._ping
+        if checked is None or self._clock() - checked >= READY_CHECK_TTL:
+            try:
+                ok = await es_client.aes.ping(request_timeout = READY_TIMEOUT)
+            except exceptions.ElasticsearchException:
+                ok = False
+            self._ping = (self._clock(), ok)
+        return ok
+
+    def report(self) -> dict:
+        return {'uptime_seconds': round(self.uptime(), 3),
+                'ready_after_seconds': None if self.ready_after is None else round(self.ready_after, 3),
+                'warmup_attempts': self.attempts,
+                'warmup_seconds': {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+                'index_query_ms': self.indices,
+                'last_error': self.error}
+
+    def metric_lines(self) -> list:
+        '''
+        Exposition lines of the startup timings, for metrics.register_collector.
+        '''
+        lines = ['# HELP search_api_ready Whether the warmup finished.',
+                 '# TYPE search_api_ready gauge',
+                 f'search_api_ready {int(self.warm)}',
+                 '# HELP search_api_warmup_seconds Duration of each startup warmup phase.',
+                 '# TYPE search_api_warmup_seconds gauge']
+        lines += [f'search_api_warmup_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in self.phases.items()]
+        if self.ready_after is not None:
+            lines += ['# HELP search_api_ready_after_seconds Seconds from process start until ready.',
+                      '# TYPE search_api_ready_after_seconds gauge',
+                      f'search_api_ready_after_seconds {self.ready_after}']
+        return lines
+
+readiness = Readiness()
+
+#----------Warmup----------#
+async def _timed(phase: str, step):
+    start = time.perf_counter()
+    result = await step
+    readiness.phases[phase] = time.perf_counter() - start
+    return result
+
+async def _query_index(index: str):
+    start = time.perf_counter()
+    await es_client.aes.search(index = index, body = {'size': 0, 'track_total_hits': False},
+                               request_timeout = es_client.ES_SEARCH_TIMEOUT)
+    readiness.indices[index] = round((time.perf_counter() - start) * 1000, 2)
+
+async def warm_up():
+    '''
+    Get the search-api ready for its first request, retrying every WARMUP_RETRY seconds while
+    elasticsearch is unreachable:
+    - build the clients (and their TLS contexts)
+    - install the index template
+    - open WARMUP_CONNECTIONS pooled connections in both clients, so requests skip the handshake
+    - run a size 0 search against each registry index, which also caches the resolved indices
+    '''
+    while True:
+        readiness.attempts += 1
+        try:
+            readiness.phases['clients'] = await run_in_threadpool(es_client.build_clients)
+            await _timed('template', run_in_threadpool(install_template, es_client.es, requested_indices()))
+            await _timed('connections', asyncio.gather(
+                *(es_client.aes.info() for _ in range(WARMUP_CONNECTIONS)),
+                *(run_in_threadpool(es_client.es.info) for _ in range(WARMUP_CONNECTIONS))))
+            indices = await index_resolver.aresolve(es_client.aes, requested_indices())
+            await _timed('indices', asyncio.gather(*(_query_index(index) for index in indices)))
+        except (exceptions.ElasticsearchException, OSError) as e:
+            readiness.error = f'{type(e).__name__}: {e}'
+            print(f'Warmup attempt {readiness.attempts} failed, retrying in {WARMUP_RETRY}s: {readiness.error}')
+            await asyncio.sleep(WARMUP_RETRY)
+            continue
+        readiness.error = None
+        readiness.ready_after = readiness.uptime()
+        print(f'Ready after {readiness.ready_after:.3f}s: {readiness.report()["warmup_seconds"]}')
+        return
@@ -0,0 +1,105 @@
+import copy
+import json
+import os
+import threading
+
+from elasticsearch import exceptions
+
+#----------Template Settings----------#
+# registry_template.json is the single definition of the NewDocument mapping; it is also
+# mounted into the Mining container so both services create identical indices.
+TEMPLATE_NAME = os.getenv('INDEX_TEMPLATE_NAME', 'mlex-registry')
+TEMPLATE_PATH = os.getenv('INDEX_TEMPLATE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registry_template.json'))
+INDEX_SHARDS           = os.getenv('INDEX_SHARDS')             # overrides of the template defaults
+INDEX_REPLICAS         = os.getenv('INDEX_REPLICAS')
+INDEX_REFRESH_INTERVAL = os.getenv('INDEX_REFRESH_INTERVAL')
+
+def load_template(path: str = TEMPLATE_PATH) -> dict:
+    '''
+    Read the composable index template and apply the shard/replica/refresh overrides.
+    '''
+    with open(path) as f:
+        template = json.load(f)
+    settings = template['template']['settings']
+    for key, value in (('number_of_shards', INDEX_SHARDS), ('number_of_replicas', INDEX_REPLICAS),
+                       ('refresh_interval', INDEX_REFRESH_INTERVAL)):
+        if value:
+            settings[key] = value
+    return template
+
+TEMPLATE = load_template()
+
+def index_body() -> dict:
+    '''
+    Settings and mappings for creating a registry index explicitly.
+    '''
+    return copy.deepcopy(TEMPLATE['template'])
+
+def search_fields() -> list:
+    '''
+    Boosted fields searched by keyword queries, e.g. ["name^3", "description"].
+    '''
+    return list(TEMPLATE['template']['mappings']['_meta']['search_fields'])
+
+def text_fields() -> list:
+    '''
+    The boosted search fields analyzed as full text, the only ones phrase queries can run on.
+    '''
+    properties = TEMPLATE['template']['mappings']['properties']
+    return [field for field in search_fields() if properties[field.split('^')[0]]['type'] == 'text']
+
+#----------Installation----------#
+def install_template(client, index_patterns: list = None):
+    '''
+    Register (or update) the index template, so any matching index created later gets it.
+
+    Args:
+        client: blocking Elasticsearch client
+        index_patterns: index names/patterns to apply it to, defaults to the ones in the file
+    '''
+    template = copy.deepcopy(TEMPLATE)
+    if index_patterns:
+        template['index_patterns'] = index_patterns
+    return client.indices.put_index_template(name = TEMPLATE_NAME, body = template)
+
+_known_indices = set()
+_known_lock = threading.Lock()
+
+def ensure_index(client, index: str):
+    '''
+    Create `index` with the template mappings before its first write, instead of letting
+    elasticsearch create it with dynamic mapping. Indices already seen are skipped.
+    '''
+    if index in _known_indices:
+        return
+    try:
+        client.indices.create(index = index, body = index_body())
+    except exceptions.RequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+    with _known_lock:
+        _known_indices.add(index)
+
+async def aensure_index(client, index: str):
+    '''
+    ensure_index() with the asyncio client.
+    '''
+    if index in _known_indices:
+        return
+    try:
+        await client.indices.create(index = index, body = index_body())
+    except exceptions.RequestError as e:
+        if e.error != 'resource_already_exists_exception':
+            raise
+    with _known_lock:
+        _known_indices.add(index)
+
+def forget_index(index: str):
+    '''
+    Drop a deleted index (or comma separated list) from the known set.
+    '''
+    with _known_lock:
+        if '*' in index:
+            _known_indices.clear()
+        else:
+            _known_indices.difference_update(index.split(','))
@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from fnmatch import fnmatchcase
+
+from elasticsearch import exceptions
+
+#----------Registry Indices----------#
+# The Mining job writes one index per content_type; searches target only these by default.
+REGISTRY_CONTENT_TYPES = os.getenv('REGISTRY_CONTENT_TYPES', 'model,app,workflow').split(',')
+INDEX_PATTERN   = os.getenv('INDEX_PATTERN', '{content_type}')   # index name or alias of a content_type
+INDEX_CACHE_TTL = float(os.getenv('INDEX_CACHE_TTL', 30))        # seconds a resolved index set is reused
+
+def requested_indices(index: str = None, content_type: list = None) -> list:
+    '''
+    Index names/patterns a search asks for.
+
+    Args:
+        index: explicit comma separated index names, aliases or patterns
+        content_type: registry content types, mapped through INDEX_PATTERN
+    Return:
+        list of index names/patterns, the registry indices when neither is given
+    '''
+    if index:
+        return index.split(',')
+    return [INDEX_PATTERN.format(content_type = ct) for ct in (content_type or REGISTRY_CONTENT_TYPES)]
+
+#----------Index Resolution----------#
+class IndexResolver:
+    '''
+    Expands requested names, aliases and patterns to the concrete indices that exist, and keeps
+    the answer for INDEX_CACHE_TTL seconds so the lookup is off the hot path. Routes that may
+    create or delete an index call invalidate() with its name.
+    '''
+    def __init__(self, ttl: float = INDEX_CACHE_TTL, clock = time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._resolved = {}     # sorted patterns -> (expires at, concrete indices)
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: tuple):
+        with self._lock:
+            entry = self._resolved.get(key)
+            if entry is not None and entry[0] > self._clock():
+                return entry[1]
+            return None
+
+    def _store(self, key: tuple, aliases: dict) -> list:
+        concrete = sorted(aliases)
+        with self._lock:
+            self._resolved[key] = (self._clock() + self.ttl, concrete)
+        return concrete
+
+    def resolve(self, client, patterns: list) -> list:
+        '''
+        Resolve with the blocking client.
+
+        Return:
+            sorted list of concrete index names, empty when nothing matches
+        '''
+        key = tuple(sorted(patterns))
+        concrete = self._lookup(key)
+        if concrete is None:
+            try:
+                aliases = client.indices.get_alias(index = ','.join(key), ignore_unavailable = True, allow_no_indices = True)
+            except exceptions.NotFoundError:
+                aliases = {}
+            concrete = self._store(key, aliases)
+        return concrete
+
+    async def aresolve(self, client, patterns: list) -> list:
+        '''
+        Resolve with the asyncio client, see resolve().
+        '''
+        key = tuple(sorted(patterns))
+        concrete = self._lookup(key)
+        if concrete is None:
+            try:
+                aliases = await client.indices.get_alias(index = ','.join(key), ignore_unavailable = True, allow_no_indices = True)
+            except exceptions.NotFoundError:
+                aliases = {}
+            concrete = self._store(key, aliases)
+        return concrete
+
+    def invalidate(self, index: str):
+        '''
+        Forget every resolution whose patterns could match `index` (comma separated names allowed).
+        '''
+        names = index.split(',')
+        with self._lock:
+            stale = [key for key in self._resolved
+                     if any(fnmatchcase(name, pattern) or fnmatchcase(pattern, name) for name in names for pattern in key)]
+            for key in stale:
+                del self._resolved[key]
+
+index_resolver = IndexResolver()
@@ -0,0 +1,1082 @@
+import bisect
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from fnmatch import fnmatchcase
+from functools import cmp_to_key
+from urllib.parse import unquote
+
+from elasticsearch import Connection
+from elasticsearch._async.http_aiohttp import AsyncConnection
+
+#----------Local Backend Settings----------#
+# SEARCH_BACKEND=local (see es_client.py) answers the elasticsearch REST calls of the search-api
+# from this in-process engine, for development and CI boxes that cannot run the cluster.
+LOCAL_DATA_DIR = os.getenv('LOCAL_DATA_DIR', '')    # directory the indices persist to, empty keeps them in memory
+BM25_K1 = float(os.getenv('BM25_K1', 1.2))
+BM25_B  = float(os.getenv('BM25_B', 0.75))
+POSITION_GAP = 100      # position increment between the values of a multi-valued text field, as in elasticsearch
+
+INFO = {'name': 'local', 'cluster_name': 'search-api-local', 'version': {'number': '7.17.1', 'build_flavor': 'default'},
+        'tagline': 'You Know, for Search'}
+HEADERS = {'x-elastic-product': 'Elasticsearch', 'content-type': 'application/json'}
+SHARDS = {'total': 1, 'successful': 1, 'failed': 0}
+INDEXED_TYPES = {'text', 'keyword', 'long', 'integer', 'short', 'byte', 'double', 'float', 'boolean', 'date'}
+_TOKEN = re.compile(r'\w+')
+
+class LocalError(Exception):
+    '''
+    An error answered the way elasticsearch would: HTTP status plus an error type and reason.
+    '''
+    def __init__(self, status: int, type: str, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.body = {'error': {'root_cause': [{'type': type, 'reason': reason}], 'type': type, 'reason': reason},
+                     'status': status}
+
+def tokenize(text: str) -> list:
+    '''
+    Lowercased word tokens, roughly the standard analyzer.
+    '''
+    return _TOKEN.findall(text.lower())
+
+def bigrams(term: str) -> set:
+    padded = f'${term}$'
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    '''
+    Levenshtein distance of two terms, or limit + 1 as soon as it must exceed limit.
+    '''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def auto_edits(term: str, fuzziness) -> int:
+    '''
+    Edits allowed for a term: fuzziness "AUTO" allows 0 up to 2 characters, 1 up to 5, else 2.
+    '''
+    if fuzziness is None:
+        return 0
+    if str(fuzziness).upper().startswith('AUTO'):
+        return 0 if len(term) <= 2 else 1 if len(term) <= 5 else 2
+    return int(fuzziness)
+
+def split_boost(field: str) -> tuple:
+    name, _, boost = field.partition('^')
+    return name, float(boost) if boost else 1.0
+
+#----------Inverted Index----------#
+class LocalIndex:
+    '''
+    One index: stored documents plus positional postings of every indexed field, BM25 field
+    statistics, and a bigram index over the terms used to find fuzzy matching candidates.
+
+    Fields come from the index mappings ("text", "keyword" and their "fields" subfields);
+    with dynamic mapping, unmapped strings are indexed as text with a .keyword subfield
+    like elasticsearch does. Keyword fields index each value as a single term.
+    '''
+    def __init__(self, name: str, body: dict = None):
+        body = body or {}
+        self.name = name
+        self.settings = body.get('settings', {})
+        self.mappings = body.get('mappings', {})
+        self.dynamic = str(self.mappings.get('dynamic', True)).lower() != 'false'
+        self.fields = {}                # field -> (type, source path, indexed)
+        self._map_properties(self.mappings.get('properties', {}))
+        self.docs = {}                  # id -> [seq, version, seq_no, source]
+        self.postings = {}              # field -> term -> {id: [positions]}
+        self.lengths = {}               # field -> {id: number of terms}
+        self.total_lengths = Counter()  # field -> sum of lengths
+        self.grams = {}                 # bigram -> set of terms
+        self._sorted_terms = {}         # field -> sorted term list, rebuilt after writes
+        self.seq_no = -1
+
+    def _map_properties(self, properties: dict):
+        for name, spec in properties.items():
+            kind = spec.get('type', 'object')
+            self.fields[name] = (kind, name, kind in INDEXED_TYPES and spec.get('index', True) is not False)
+            for sub, subspec in spec.get('fields', {}).items():
+                subkind = subspec.get('type', 'keyword')
+                self.fields[f'{name}.{sub}'] = (subkind, name, subkind in INDEXED_TYPES and subspec.get('index', True) is not False)
+
+    def mapping_body(self) -> dict:
+        return {'settings': self.settings, 'mappings': self.mappings}
+
+    def _dynamic_fields(self, source: dict):
+        for name, value in source.items():
+            if name in self.fields or value is None:
+                continue
+            sample = value[0] if isinstance(value, list) and value else value
+            if isinstance(sample, str):
+                self.fields[name] = ('text', name, True)
+                self.fields[f'{name}.keyword'] = ('keyword', name, True)
+            elif isinstance(sample, (int, float, bool)):
+                self.fields[name] = ('keyword', name, True)
+
+    def values(self, source: dict, field: str) -> list:
+        '''
+        The values of a field in a document, for filters, aggregations and sorting.
+        '''
+        path = self.fields[field][1] if field in self.fields else field
+        value = source.get(path)
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+    def analyze(self, field: str, text) -> list:
+        '''
+        Terms of a value as the field indexes them.
+        '''
+        kind = self.fields.get(field, ('keyword',))[0]
+        if kind == 'text':
+            return tokenize(str(text))
+        return [json.dumps(text) if isinstance(text, bool) else str(text)]
+
+    def put(self, doc_id: str, source: dict, seq: int, version: int = None) -> str:
+        '''
+        Index or replace a document. Returns "created" or "updated".
+        '''
+        result = 'created'
+        if doc_id in self.docs:
+            version = version or self.docs[doc_id][1] + 1
+            self.remove(doc_id)
+            result = 'updated'
+        if self.dynamic:
+            self._dynamic_fields(source)
+        self.seq_no += 1
+        self.docs[doc_id] = [seq, version or 1, self.seq_no, source]
+        for field, (_, path, indexed) in self.fields.items():
+            if not indexed or path not in source:
+                continue
+            position, length = 0, 0
+            postings = self.postings.setdefault(field, {})
+            for value in self.values(source, field):
+                for term in self.analyze(field, value):
+                    entry = postings.get(term)
+                    if entry is None:
+                        entry = postings[term] = {}
+                        for gram in bigrams(term):
+                            self.grams.setdefault(gram, set()).add(term)
+                    entry.setdefault(doc_id, []).append(position)
+                    position += 1
+                    length += 1
+                position += POSITION_GAP
+            if length:
+                self.lengths.setdefault(field, {})[doc_id] = length
+                self.total_lengths[field] += length
+            self._sorted_terms.pop(field, None)
+        return result
+
+    def remove(self, doc_id: str) -> bool:
+        if doc_id not in self.docs:
+            return False
+        source = self.docs.pop(doc_id)[3]
+        for field, (_, path, indexed) in self.fields.items():
+            if not indexed or path not in source:
+                continue
+            postings = self.postings.get(field, {})
+            for value in self.values(source, field):
+                for term in self.analyze(field, value):
+                    entry = postings.get(term)
+                    if entry is not None:
+                        entry.pop(doc_id, None)
+                        if not entry:
+                            del postings[term]
+            length = self.lengths.get(field, {}).pop(doc_id, 0)
+            self.total_lengths[field] -= length
+            self._sorted_terms.pop(field, None)
+        return True
+
+    #----------Scoring----------#
+    def bm25(self, field: str, term: str) -> dict:
+        '''
+        BM25 score of every document containing the term in the field.
+        '''
+        entry = self.postings.get(field, {}).get(term)
+        if not entry:
+            return {}
+        lengths = self.lengths[field]
+        n = len(lengths)
+        idf = math.log(1 + (n - len(entry) + 0.5) / (len(entry) + 0.5))
+        avgdl = self.total_lengths[field] / n
+        scores = {}
+        for doc_id, positions in entry.items():
+            tf = len(positions)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_id] / avgdl)
+            scores[doc_id] = idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def fuzzy_terms(self, field: str, term: str, edits: int, prefix_length: int = 0, max_expansions: int = 50) -> list:
+        '''
+        Terms of the field within `edits` edits of `term`, as (term, weight) pairs. Candidates
+        come from the bigram index: an edit changes at most two of a term's bigrams, so a match
+        shares at least len(bigrams) - 2 * edits of them; only those are checked exactly.
+        '''
+        postings = self.postings.get(field, {})
+        if edits <= 0:
+            return [(term, 1.0)] if term in postings else []
+        grams = bigrams(term)
+        needed = len(grams) - 2 * edits
+        if needed > 0:
+            shared = Counter(candidate for gram in grams for candidate in self.grams.get(gram, ()))
+            candidates = [candidate for candidate, count in shared.items() if count >= needed]
+        else:
+            candidates = list(postings)
+        prefix = term[:prefix_length]
+        matches = []
+        for candidate in candidates:
+            if candidate not in postings or not candidate.startswith(prefix):
+                continue
+            distance = edit_distance(term, candidate, edits)
+            if distance <= edits:
+                matches.append((distance, -len(postings[candidate]), candidate))
+        matches.sort()
+        return [(candidate, 1.0 - distance / max(min(len(term), len(candidate)), 1))
+                for distance, _, candidate in matches[:max_expansions]]
+
+    def prefix_terms(self, field: str, prefix: str, max_expansions: int = 50) -> list:
+        terms = self._sorted_terms.get(field)
+        if terms is None:
+            terms = self._sorted_terms[field] = sorted(self.postings.get(field, {}))
+        start = bisect.bisect_left(terms, prefix)
+        found = []
+        for term in terms[start:]:
+            if not term.startswith(prefix) or len(found) >= max_expansions:
+                break
+            found.append(term)
+        return found
+
+    def phrase_docs(self, field: str, terms: list, last: list) -> dict:
+        '''
+        Documents where `terms` appear consecutively, followed by any of the `last` terms.
+        '''
+        postings = self.postings.get(field, {})
+        chain = [postings.get(term, {}) for term in terms]
+        tails = [postings.get(term, {}) for term in last]
+        candidates = set(chain[0]) if chain else set().union(*tails) if tails else set()
+        for entry in chain[1:]:
+            candidates &= set(entry)
+        matched = {}
+        for doc_id in candidates:
+            starts = set(chain[0][doc_id]) if chain else None
+            for offset, entry in enumerate(chain[1:], 1):
+                starts &= {p - offset for p in entry[doc_id]}
+            for term, entry in zip(last, tails):
+                if doc_id not in entry:
+                    continue
+                if starts is None or starts & {p - len(chain) for p in entry[doc_id]}:
+                    matched.setdefault(doc_id, []).append(term)
+        return matched
+
+    #----------Queries----------#
+    def match_all(self) -> dict:
+        return dict.fromkeys(self.docs, 1.0)
+
+    def evaluate(self, query: dict) -> dict:
+        '''
+        Evaluate a query DSL clause: document id -> score of every matching document.
+        '''
+        if not query:
+            return self.match_all()
+        (kind, params), = query.items()
+        handler = getattr(self, f'_q_{kind}', None)
+        if handler is None:
+            raise LocalError(400, 'parsing_exception', f'unknown query [{kind}] for the local backend')
+        return handler(params)
+
+    def _q_match_all(self, params):
+        return self.match_all()
+
+    def _q_match_none(self, params):
+        return {}
+
+    def _q_ids(self, params):
+        return {doc_id: 1.0 for doc_id in params.get('values', []) if doc_id in self.docs}
+
+    def _q_terms(self, params):
+        (field, values), = ((k, v) for k, v in params.items() if k != 'boost')
+        postings = self.postings.get(field, {})
+        matched = {}
+        for value in values:
+            term = str(value) if self.fields.get(field, ('',))[0] == 'text' else self.analyze(field, value)[0]
+            matched.update(dict.fromkeys(postings.get(term, {}), 1.0))
+        return matched
+
+    def _q_term(self, params):
+        (field, value), = params.items()
+        return self._q_terms({field: [value['value'] if isinstance(value, dict) else value]})
+
+    def _q_exists(self, params):
+        field = params['field']
+        return {doc_id: 1.0 for doc_id, doc in self.docs.items() if self.values(doc[3], field)}
+
+    def _q_match(self, params):
+        (field, spec), = params.items()
+        spec = spec if isinstance(spec, dict) else {'query': spec}
+        return self._q_multi_match(dict(spec, fields = [field]))
+
+    def _q_match_phrase_prefix(self, params):
+        (field, spec), = params.items()
+        spec = spec if isinstance(spec, dict) else {'query': spec}
+        return self._q_multi_match(dict(spec, fields = [field], type = 'phrase_prefix'))
+
+    def _q_multi_match(self, params):
+        fields = params.get('fields') or [name for name, (kind, _, _) in self.fields.items() if kind == 'text']
+        best = {}
+        for field in fields:
+            name, boost = split_boost(field)
+            for name in [f for f in self.fields if fnmatchcase(f, name)] if '*' in name else [name]:
+                for doc_id, score in self._field_match(name, params).items():
+                    if score * boost > best.get(doc_id, -1.0):
+                        best[doc_id] = score * boost
+        return best
+
+    def _field_match(self, field: str, params: dict) -> dict:
+        if field not in self.fields:
+            return {}
+        terms = self.analyze(field, params['query'])
+        if not terms:
+            return {}
+        if params.get('type') in ('phrase_prefix', 'phrase'):
+            last = terms[-1:] if params.get('type') == 'phrase' else \
+                   self.prefix_terms(field, terms[-1], params.get('max_expansions', 50))
+            matched = self.phrase_docs(field, terms[:-1], last)
+            scores = [self.bm25(field, term) for term in terms[:-1]]
+            tail = {term: self.bm25(field, term) for term in set(t for found in matched.values() for t in found)}
+            return {doc_id: sum(s[doc_id] for s in scores) + max(tail[t][doc_id] for t in found)
+                    for doc_id, found in matched.items()}
+        total, hits = {}, Counter()
+        for term in terms:
+            edits = auto_edits(term, params.get('fuzziness'))
+            expansions = self.fuzzy_terms(field, term, edits, params.get('prefix_length', 0), params.get('max_expansions', 50))
+            term_scores = {}
+            for candidate, weight in expansions:
+                for doc_id, score in self.bm25(field, candidate).items():
+                    if score * weight > term_scores.get(doc_id, 0.0):
+                        term_scores[doc_id] = score * weight
+            for doc_id, score in term_scores.items():
+                total[doc_id] = total.get(doc_id, 0.0) + score
+                hits[doc_id] += 1
+        if str(params.get('operator', 'or')).lower() == 'and':
+            return {doc_id: score for doc_id, score in total.items() if hits[doc_id] == len(terms)}
+        minimum = params.get('minimum_should_match')
+        if minimum is not None:
+            return {doc_id: score for doc_id, score in total.items() if hits[doc_id] >= int(minimum)}
+        return total
+
+    def _q_bool(self, params):
+        def clauses(name):
+            value = params.get(name, [])
+            return value if isinstance(value, list) else [value]
+        must, should, filters, must_not = clauses('must'), clauses('should'), clauses('filter'), clauses('must_not')
+        scores = None
+        for clause in must + filters:
+            matched = self.evaluate(clause)
+            scored = clause in must
+            if scores is None:
+                scores = {doc_id: (score if scored else 0.0) for doc_id, score in matched.items()}
+            else:
+                scores = {doc_id: score + (matched[doc_id] if scored else 0.0)
+                          for doc_id, score in scores.items() if doc_id in matched}
+        if should:
+            minimum = int(params.get('minimum_should_match', 0 if must or filters else 1))
+            counts, extra = Counter(), {}
+            for clause in should:
+                for doc_id, score in self.evaluate(clause).items():
+                    counts[doc_id] += 1
+                    extra[doc_id] = extra.get(doc_id, 0.0) + score
+            if scores is None:
+                scores = {doc_id: extra[doc_id] for doc_id in counts if counts[doc_id] >= minimum}
+            else:
+                scores = {doc_id: score + extra.get(doc_id, 0.0) for doc_id, score in scores.items()
+                          if counts[doc_id] >= minimum}
+        if scores is None:
+            scores = self.match_all() if not must_not else dict.fromkeys(self.docs, 0.0)
+        for clause in must_not:
+            for doc_id in self.evaluate(clause):
+                scores.pop(doc_id, None)
+        return scores
+
+    def _q_constant_score(self, params):
+        boost = params.get('boost', 1.0)
+        return dict.fromkeys(self.evaluate(params['filter']), boost)
+
+#----------Engine----------#
+def _compare(a, b) -> int:
+    if a == b:
+        return 0
+    if a is None:
+        return 1
+    if b is None:
+        return -1
+    try:
+        return -1 if a < b else 1
+    except TypeError:
+        return -1 if str(a) < str(b) else 1
+
+def _merge(source: dict, doc: dict) -> dict:
+    '''
+    A partial update applied to a source: objects are merged recursively, other values replaced.
+    '''
+    merged = dict(source)
+    for name, value in doc.items():
+        if isinstance(value, dict) and isinstance(merged.get(name), dict):
+            value = _merge(merged[name], value)
+        merged[name] = value
+    return merged
+
+def _filter_source(source: dict, spec, path: str = ''):
+    '''
+    Apply a search's _source option (False, a pattern, a list of patterns or
+    {"includes", "excludes"}) to a document source; patterns are dotted field paths.
+    '''
+    if spec is None or spec is True:
+        return source
+    if spec is False:
+        return None
+    if not isinstance(spec, dict):
+        spec = {'includes': [spec] if isinstance(spec, str) else spec}
+    includes = spec.get('includes') or spec.get('include') or []
+    excludes = spec.get('excludes') or spec.get('exclude') or []
+    includes, excludes = [includes] if isinstance(includes, str) else includes, [excludes] if isinstance(excludes, str) else excludes
+    filtered = {}
+    for name, value in source.items():
+        field = path + name
+        if any(fnmatchcase(field, pattern) or fnmatchcase(field, pattern + '.*') for pattern in excludes):
+            continue
+        if includes and not any(fnmatchcase(field, pattern) for pattern in includes):
+            nested = [pattern for pattern in includes if pattern.startswith(field + '.')]
+            if not nested or not isinstance(value, dict):
+                continue
+            value = _filter_source(value, {'includes': nested, 'excludes': excludes}, field + '.')
+        elif isinstance(value, dict) and any(pattern.startswith(field + '.') for pattern in excludes):
+            value = _filter_source(value, {'excludes': excludes}, field + '.')
+        filtered[name] = value
+    return filtered
+
+def _shard_profile(name: str, body: dict, nanos: int) -> dict:
+    '''
+    The profile of one index, shaped like an elasticsearch shard profile: the whole query
+    evaluation is reported as the query time, without a per-clause breakdown.
+    '''
+    query = body.get('query') or {'match_all': {}}
+    return {'id': f'[local][{name}][0]',
+            'searches': [{'query': [{'type': next(iter(query)), 'description': json.dumps(query),
+                                     'time_in_nanos': nanos, 'breakdown': {}, 'children': []}],
+                          'rewrite_time': 0,
+                          'collector': []}],
+            'aggregations': []}
+
+class LocalEngine:
+    '''
+    The indices of the local backend, answering the elasticsearch REST API calls the search-api
+    makes: index and document CRUD (with partial updates and seq_no guards), index templates,
+    alias resolution, search (with sort, search_after, track_total_hits and terms
+    aggregations), msearch, mget, bulk and point-in-time.
+
+    A point-in-time only pins the indices, not a snapshot of their documents. With a data
+    directory every write is appended to a per-index operation log, replayed (and compacted)
+    when the engine loads.
+    '''
+    def __init__(self, data_dir: str = LOCAL_DATA_DIR):
+        self.data_dir = data_dir
+        self.indices = {}
+        self.templates = {}
+        self.pits = {}                  # pit id -> (indices, expires at)
+        self.tasks = {}                 # task id -> finished task, as returned by the tasks API
+        self._seq = 0
+        self._logs = {}
+        self._lock = threading.RLock()
+        if data_dir:
+            self._load()
+
+    #----------Persistence----------#
+    def _index_dir(self, name: str) -> str:
+        return os.path.join(self.data_dir, name)
+
+    def _load(self):
+        os.makedirs(self.data_dir, exist_ok = True)
+        templates = os.path.join(self.data_dir, '_templates.json')
+        if os.path.exists(templates):
+            with open(templates) as f:
+                self.templates = json.load(f)
+        for name in sorted(os.listdir(self.data_dir)):
+            meta = os.path.join(self._index_dir(name), 'meta.json')
+            if not os.path.exists(meta):
+                continue
+            with open(meta) as f:
+                index = self.indices[name] = LocalIndex(name, json.load(f))
+            log = os.path.join(self._index_dir(name), 'ops.jsonl')
+            operations = 0
+            if os.path.exists(log):
+                with open(log) as f:
+                    for line in f:
+                        operations += 1
+                        try:
+                            op = json.loads(line)
+                        except ValueError:
+                            break       # torn last line of an interrupted write
+                        if op['op'] == 'index':
+                            self._seq += 1
+                            index.put(op['id'], op['doc'], self._seq)
+                        else:
+                            index.remove(op['id'])
+            if operations > 2 * len(index.docs) + 1000:
+                self._compact(index)
+
+    def _compact(self, index: LocalIndex):
+        path = os.path.join(self._index_dir(index.name), 'ops.jsonl')
+        self._close_log(index.name)
+        with open(path + '.tmp', 'w') as f:
+            for doc_id, (_, _, _, source) in index.docs.items():
+                f.write(json.dumps({'op': 'index', 'id': doc_id, 'doc': source}) + '\n')
+        os.replace(path + '.tmp', path)
+
+    def _close_log(self, name: str):
+        log = self._logs.pop(name, None)
+        if log is not None:
+            log.close()
+
+    def _log(self, name: str, op: dict):
+        if not self.data_dir:
+            return
+        log = self._logs.get(name)
+        if log is None:
+            log = self._logs[name] = open(os.path.join(self._index_dir(name), 'ops.jsonl'), 'a')
+        log.write(json.dumps(op, separators = (',', ':')) + '\n')
+        log.flush()
+
+    def _save_meta(self, index: LocalIndex):
+        if self.data_dir:
+            os.makedirs(self._index_dir(index.name), exist_ok = True)
+            with open(os.path.join(self._index_dir(index.name), 'meta.json'), 'w') as f:
+                json.dump(index.mapping_body(), f)
+
+    def _save_templates(self):
+        if self.data_dir:
+            with open(os.path.join(self.data_dir, '_templates.json'), 'w') as f:
+                json.dump(self.templates, f)
+
+    #----------Indices----------#
+    def resolve(self, expression: str, ignore_unavailable: bool = False, allow_no_indices: bool = True) -> list:
+        names = []
+        for part in (expression or '_all').split(','):
+            if part in ('_all', '*'):
+                names += sorted(self.indices)
+            elif '*' in part or '?' in part:
+                names += sorted(name for name in self.indices if fnmatchcase(name, part))
+            elif part in self.indices:
+                names.append(part)
+            elif not ignore_unavailable:
+                raise LocalError(404, 'index_not_found_exception', f'no such index [{part}]')
+        names = list(dict.fromkeys(names))
+        if not names and not allow_no_indices:
+            raise LocalError(404, 'index_not_found_exception', f'no such index [{expression}]')
+        return names
+
+    def create_index(self, name: str, body: dict = None) -> dict:
+        with self._lock:
+            if name in self.indices:
+                raise LocalError(400, 'resource_already_exists_exception', f'index [{name}] already exists')
+            if not body:
+                body = self._template_body(name)
+            index = self.indices[name] = LocalIndex(name, body)
+            self._save_meta(index)
+            return {'acknowledged': True, 'shards_acknowledged': True, 'index': name}
+
+    def _template_body(self, name: str) -> dict:
+        matching = [(template.get('priority', 0), template) for template in self.templates.values()
+                    if any(fnmatchcase(name, pattern) for pattern in template.get('index_patterns', []))]
+        if not matching:
+            return {}
+        return max(matching, key = lambda pair: pair[0])[1].get('template', {})
+
+    def _index_for_write(self, name: str) -> LocalIndex:
+        if name not in self.indices:
+            self.create_index(name)
+        return self.indices[name]
+
+    def delete_index(self, expression: str, ignore_unavailable: bool = False) -> dict:
+        with self._lock:
+            for name in self.resolve(expression, ignore_unavailable):
+                del self.indices[name]
+                self._close_log(name)
+                if self.data_dir:
+                    shutil.rmtree(self._index_dir(name), ignore_errors = True)
+            return {'acknowledged': True}
+
+    def put_template(self, name: str, body: dict) -> dict:
+        with self._lock:
+            self.templates[name] = body
+            self._save_templates()
+            return {'acknowledged': True}
+
+    #----------Documents----------#
+    @staticmethod
+    def _check_seq_no(index: LocalIndex, doc_id: str, if_seq_no, if_primary_term):
+        if if_seq_no is None and if_primary_term is None:
+            return
+        current = index.docs[doc_id][2] if doc_id in index.docs else None
+        if current != int(if_seq_no) or int(if_primary_term) != 1:
+            raise LocalError(409, 'version_conflict_engine_exception',
+                             f'[{doc_id}]: version conflict, required seqNo [{if_seq_no}], primary term [{if_primary_term}]. '
+                             f'current document has seqNo [{current}] and primary term [1]')
+
+    def index_doc(self, name: str, doc_id: str, source: dict, op_type: str = 'index',
+                  if_seq_no: int = None, if_primary_term: int = None) -> dict:
+        with self._lock:
+            index = self._index_for_write(name)
+            if op_type == 'create' and doc_id in index.docs:
+                raise LocalError(409, 'version_conflict_engine_exception', f'[{doc_id}]: version conflict, document already exists')
+            self._check_seq_no(index, doc_id, if_seq_no, if_primary_term)
+            self._seq += 1
+            result = index.put(doc_id, source, self._seq)
+            self._log(name, {'op': 'index', 'id': doc_id, 'doc': source})
+            return self._doc_result(index, doc_id, result)
+
+    def _doc_result(self, index: LocalIndex, doc_id: str, result: str) -> dict:
+        _, version, seq_no, _ = index.docs.get(doc_id, [None, 1, index.seq_no, None])
+        return {'_index': index.name, '_type': '_doc', '_id': doc_id, '_version': version, 'result': result,
+                '_shards': SHARDS, '_seq_no': seq_no, '_primary_term': 1}
+
+    def get_doc(self, name: str, doc_id: str) -> dict:
+        with self._lock:
+            index = self.indices.get(name)
+            if index is None:
+                raise LocalError(404, 'index_not_found_exception', f'no such index [{name}]')
+            if doc_id not in index.docs:
+                raise LocalError(404, 'not_found', f'document [{doc_id}] not found')
+            _, version, seq_no, source = index.docs[doc_id]
+            return {'_index': name, '_type': '_doc', '_id': doc_id, '_version': version, '_seq_no': seq_no,
+                    '_primary_term': 1, 'found': True, '_source': source}
+
+    def update_doc(self, name: str, doc_id: str, body: dict, if_seq_no: int = None, if_primary_term: int = None) -> dict:
+        '''
+        Partial update: merge body["doc"] into the stored source, a "noop" when nothing changes.
+        '''
+        with self._lock:
+            index = self.indices.get(name)
+            if index is None:
+                raise LocalError(404, 'index_not_found_exception', f'no such index [{name}]')
+            if doc_id not in index.docs:
+                raise LocalError(404, 'document_missing_exception', f'[{doc_id}]: document missing')
+            if 'doc' not in body:
+                raise LocalError(400, 'action_request_validation_exception', 'Validation Failed: 1: script or doc is missing;')
+            self._check_seq_no(index, doc_id, if_seq_no, if_primary_term)
+            current = index.docs[doc_id][3]
+            source = _merge(current, body['doc'])
+            if source == current:
+                return self._doc_result(index, doc_id, 'noop')
+            self._seq += 1
+            result = index.put(doc_id, source, self._seq)
+            self._log(name, {'op': 'index', 'id': doc_id, 'doc': source})
+            return self._doc_result(index, doc_id, result)
+
+    def mget(self, default_index: str, body: dict) -> dict:
+        docs = body.get('docs') or [{'_id': doc_id} for doc_id in body.get('ids', [])]
+        found = []
+        for doc in docs:
+            name = doc.get('_index', default_index)
+            try:
+                found.append(self.get_doc(name, doc['_id']))
+            except LocalError as e:
+                if e.status != 404 or e.body['error']['type'] != 'not_found':
+                    found.append({'_index': name, '_id': doc['_id'], 'error': e.body['error']})
+                else:
+                    found.append({'_index': name, '_type': '_doc', '_id': doc['_id'], 'found': False})
+        return {'docs': found}
+
+    def delete_doc(self, name: str, doc_id: str) -> dict:
+        with self._lock:
+            index = self.indices.get(name)
+            if index is None:
+                raise LocalError(404, 'index_not_found_exception', f'no such index [{name}]')
+            if not index.remove(doc_id):
+                raise LocalError(404, 'not_found', f'document [{doc_id}] not found')
+            index.seq_no += 1
+            self._log(name, {'op': 'delete', 'id': doc_id})
+            return dict(self._doc_result(index, doc_id, 'deleted'), _seq_no = index.seq_no)
+
+    def bulk(self, default_index: str, lines: list) -> dict:
+        start = time.perf_counter()
+        items = []
+        i = 0
+        while i < len(lines):
+            (action, meta), = lines[i].items()
+            i += 1
+            name, doc_id = meta.get('_index', default_index), meta.get('_id')
+            try:
+                if action in ('index', 'create'):
+                    source = lines[i]
+                    i += 1
+                    result = self.index_doc(name, doc_id or uuid.uuid4().hex, source, action)
+                    status = 201 if result['result'] == 'created' else 200
+                elif action == 'update':
+                    body = lines[i]
+                    i += 1
+                    result = self.update_doc(name, doc_id, body, meta.get('if_seq_no'), meta.get('if_primary_term'))
+                    status = 200
+                elif action == 'delete':
+                    try:
+                        result, status = self.delete_doc(name, doc_id), 200
+                    except LocalError as e:
+                        if e.body['error']['type'] != 'not_found':
+                            raise
+                        result, status = self._doc_result(self.indices[name], doc_id, 'not_found'), 404
+                else:
+                    raise LocalError(400, 'illegal_argument_exception', f'unsupported bulk action [{action}]')
+                items.append({action: dict(result, status = status)})
+            except LocalError as e:
+                items.append({action: {'_index': name, '_id': doc_id, 'status': e.status, 'error': e.body['error']}})
+        return {'took': int((time.perf_counter() - start) * 1000), 'errors': any('error' in next(iter(item.values())) for item in items),
+                'items': items}
+
+    #----------Search----------#
+    def open_pit(self, expression: str, keep_alive: str = '1m') -> dict:
+        with self._lock:
+            pit_id = uuid.uuid4().hex
+            self.pits[pit_id] = (self.resolve(expression), time.monotonic() + _seconds(keep_alive))
+            return {'id': pit_id}
+
+    def close_pit(self, pit_id: str) -> dict:
+        with self._lock:
+            found = self.pits.pop(pit_id, None) is not None
+            return {'succeeded': True, 'num_freed': int(found)}
+
+    def _pit_indices(self, pit: dict) -> list:
+        now = time.monotonic()
+        self.pits = {pit_id: entry for pit_id, entry in self.pits.items() if entry[1] > now}
+        entry = self.pits.get(pit['id'])
+        if entry is None:
+            raise LocalError(404, 'search_context_missing_exception', f'No search context found for id [{pit["id"]}]')
+        self.pits[pit['id']] = (entry[0], now + _seconds(pit.get('keep_alive', '1m')))
+        return entry[0]
+
+    def search(self, expression: str, body: dict, ignore_unavailable: bool = False) -> dict:
+        start = time.perf_counter()
+        body = body or {}
+        with self._lock:
+            names = self._pit_indices(body['pit']) if 'pit' in body else self.resolve(expression, ignore_unavailable)
+            matches, shards = [], []
+            for name in names:
+                started = time.perf_counter_ns()
+                matches += self._matches([name], body)
+                shards.append(_shard_profile(name, body, time.perf_counter_ns() - started))
+            resp = self._page(matches, body)
+            resp['took'] = int((time.perf_counter() - start) * 1000)
+            resp['_shards'] = {'total': len(names), 'successful': len(names), 'skipped': 0, 'failed': 0}
+            if body.get('profile'):
+                resp['profile'] = {'shards': shards}
+            if 'pit' in body:
+                resp['pit_id'] = body['pit']['id']
+            return resp
+
+    def _matches(self, names, body: dict, ignore_unavailable: bool = False) -> list:
+        '''
+        (score, index, document id) of the documents of some indices (a list, or an expression
+        to resolve) that match the query of a request body.
+        '''
+        if isinstance(names, str) or names is None:
+            names = self.resolve(names, ignore_unavailable)
+        matches = []
+        for name in names:
+            index = self.indices.get(name)
+            if index is not None:
+                matches += [(score, index, doc_id) for doc_id, score in index.evaluate(body.get('query')).items()]
+        return matches
+
+    def _page(self, matches: list, body: dict) -> dict:
+        sort = body.get('sort')
+        clauses = []
+        for clause in ([sort] if isinstance(sort, (str, dict)) else sort or ['_score']):
+            field, spec = (clause, {}) if isinstance(clause, str) else next(iter(clause.items()))
+            spec = spec if isinstance(spec, dict) else {'order': spec}
+            clauses.append((field, spec.get('order', 'desc' if field == '_score' else 'asc') == 'desc'))
+
+        def key(match):
+            score, index, doc_id = match
+            values = []
+            for field, _ in clauses:
+                if field == '_score':
+                    values.append(score)
+                elif field in ('_shard_doc', '_doc'):
+                    values.append(index.docs[doc_id][0])
+                elif field == '_id':
+                    values.append(doc_id)
+                else:
+                    found = index.values(index.docs[doc_id][3], field)
+                    values.append(found[0] if found else None)
+            return values
+
+        def compare(a, b):
+            for (_, descending), x, y in zip(clauses, a, b):
+                order = _compare(x, y)
+                if order:
+                    return -order if descending and x is not None and y is not None else order
+            return 0
+
+        # ties keep indexing order, like elasticsearch's doc id order within a shard
+        keyed = [(key(match), match[1].docs[match[2]][0], match) for match in matches]
+        keyed.sort(key = cmp_to_key(lambda a, b: compare(a[0], b[0]) or a[1] - b[1]))
+        total = len(keyed)
+        after = body.get('search_after')
+        if after is not None:
+            keyed = [item for item in keyed if compare(item[0], after) > 0]
+            offset = 0
+        else:
+            offset = body.get('from', 0)
+        size = body.get('size', 10)
+        source = body.get('_source')
+        hits = []
+        for values, _, (score, index, doc_id) in keyed[offset:offset + size]:
+            hit = {'_index': index.name, '_type': '_doc', '_id': doc_id, '_score': score,
+                   '_source': _filter_source(index.docs[doc_id][3], source)}
+            if hit['_source'] is None:
+                del hit['_source']
+            if sort:
+                hit['sort'] = values
+            hits.append(hit)
+        resp = {'timed_out': False, 'hits': {'max_score': max((m[0] for m in matches), default = None), 'hits': hits}}
+        track = body.get('track_total_hits', 10000)
+        if track is True:
+            resp['hits']['total'] = {'value': total, 'relation': 'eq'}
+        elif track is not False:
+            resp['hits']['total'] = {'value': min(total, track), 'relation': 'gte' if total > track else 'eq'}
+        if body.get('aggs') or body.get('aggregations'):
+            resp['aggregations'] = self._aggregate(body.get('aggs') or body.get('aggregations'), matches)
+        return resp
+
+    def _aggregate(self, aggs: dict, matches: list) -> dict:
+        results = {}
+        for name, agg in aggs.items():
+            if 'terms' not in agg:
+                raise LocalError(400, 'parsing_exception', f'only terms aggregations are supported, [{name}] is not one')
+            field, size = agg['terms']['field'], agg['terms'].get('size', 10)
+            counts = Counter()
+            for _, index, doc_id in matches:
+                counts.update(set(index.values(index.docs[doc_id][3], field)))
+            buckets = sorted(counts.items(), key = lambda item: (-item[1], str(item[0])))
+            results[name] = {'doc_count_error_upper_bound': 0,
+                             'sum_other_doc_count': sum(count for _, count in buckets[size:]),
+                             'buckets': [{'key': value, 'doc_count': count} for value, count in buckets[:size]]}
+        return results
+
+    def msearch(self, default_index: str, lines: list) -> dict:
+        start = time.perf_counter()
+        responses = []
+        for header, body in zip(lines[::2], lines[1::2]):
+            try:
+                resp = self.search(header.get('index', default_index), body, header.get('ignore_unavailable', False))
+                responses.append(dict(resp, status = 200))
+            except LocalError as e:
+                responses.append(dict(e.body))
+        return {'took': int((time.perf_counter() - start) * 1000), 'responses': responses}
+
+    def count(self, expression: str, body: dict, ignore_unavailable: bool = False) -> dict:
+        resp = self.search(expression, dict(body or {}, size = 0, track_total_hits = True), ignore_unavailable)
+        return {'count': resp['hits']['total']['value'], '_shards': resp['_shards']}
+
+    #----------Tasks----------#
+    def delete_by_query(self, expression: str, body: dict, wait_for_completion: bool = True,
+                        ignore_unavailable: bool = False, requests_per_second: float = -1) -> dict:
+        '''
+        Delete every matching document at once; slices and throttling have nothing to spread
+        in-process. Without wait_for_completion the result is kept as a finished task.
+        '''
+        start = time.perf_counter()
+        with self._lock:
+            matches = [(index.name, doc_id) for _, index, doc_id in self._matches(expression, body, ignore_unavailable)]
+            for name, doc_id in matches:
+                self.delete_doc(name, doc_id)
+        status = {'total': len(matches), 'updated': 0, 'created': 0, 'deleted': len(matches), 'batches': 1 if matches else 0,
+                  'version_conflicts': 0, 'noops': 0, 'retries': {'bulk': 0, 'search': 0}, 'throttled_millis': 0,
+                  'requests_per_second': requests_per_second, 'throttled_until_millis': 0}
+        resp = dict(status, took = int((time.perf_counter() - start) * 1000), timed_out = False, failures = [])
+        if wait_for_completion:
+            return resp
+        number = len(self.tasks) + 1
+        task_id = f'local:{number}'
+        self.tasks[task_id] = {'completed': True, 'response': resp,
+                               'task': {'node': 'local', 'id': number, 'type': 'transport',
+                                        'action': 'indices:data/write/delete/byquery', 'status': status,
+                                        'description': f'delete-by-query [{expression}]', 'cancellable': True,
+                                        'cancelled': False, 'running_time_in_nanos': int((time.perf_counter() - start) * 1e9)}}
+        return {'task': task_id}
+
+    def get_task(self, task_id: str) -> dict:
+        task = self.tasks.get(task_id)
+        if task is None:
+            raise LocalError(404, 'resource_not_found_exception', f'task [{task_id}] isn\'t running and hasn\'t stored its results')
+        return task
+
+    def cancel_task(self, task_id: str) -> dict:
+        self.get_task(task_id)
+        return {'nodes': {}}        # tasks finish before they are reported, nothing left to cancel
+
+def _seconds(keep_alive: str) -> float:
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    number, unit = re.fullmatch(r'(\d+)(ms|s|m|h|d)', str(keep_alive)).groups()
+    return int(number) * units[unit]
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> LocalEngine:
+    '''
+    The process-wide engine shared by the sync and async connections, loaded on first use.
+    '''
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = LocalEngine()
+        return _engine
+
+#----------REST Adapter----------#
+def _flag(params: dict, name: str) -> bool:
+    return str(params.get(name, 'false')).lower() == 'true'
+
+def _ndjson(body) -> list:
+    if isinstance(body, bytes):
+        body = body.decode()
+    return [json.loads(line) for line in (body or '').splitlines() if line.strip()]
+
+def handle(engine: LocalEngine, method: str, url: str, params: dict = None, body = None) -> tuple:
+    '''
+    Answer one elasticsearch REST call from the engine.
+
+    Return:
+        (HTTP status, response body dict, or None for HEAD requests)
+    '''
+    params = {name: value.decode() if isinstance(value, bytes) else str(value) for name, value in (params or {}).items()}
+    parts = [unquote(part) for part in url.split('?', 1)[0].split('/') if part]
+    endpoint = parts[-1] if parts and parts[-1].startswith('_') else None
+    if endpoint in ('_bulk', '_msearch'):
+        lines = _ndjson(body)
+        default = parts[0] if len(parts) > 1 else None
+        return 200, engine.bulk(default, lines) if endpoint == '_bulk' else engine.msearch(default, lines)
+    if isinstance(body, bytes):
+        body = body.decode()
+    body = json.loads(body) if body else {}
+    for name in ('size', 'from'):
+        if name in params:
+            body[name] = int(params[name])
+    ignore_unavailable = _flag(params, 'ignore_unavailable')
+    if not parts:
+        return (200, None) if method == 'HEAD' else (200, INFO)
+    if parts[0] == '_index_template' and len(parts) == 2:
+        return 200, engine.put_template(parts[1], body)
+    if parts[0] == '_cluster':
+        return 200, {'cluster_name': INFO['cluster_name'], 'status': 'green', 'timed_out': False}
+    if parts == ['_pit']:
+        return 200, engine.close_pit(body['id'])
+    if parts == ['_search']:
+        return 200, engine.search(None, body, ignore_unavailable)
+    if parts[0] == '_tasks' and len(parts) >= 2:
+        if endpoint == '_cancel':
+            return 200, engine.cancel_task(parts[1])
+        return 200, engine.get_task(parts[1])
+    if parts == ['_mget']:
+        return 200, engine.mget(None, body)
+    name = parts[0]
+    if len(parts) == 1:
+        if method == 'PUT':
+            return 200, engine.create_index(name, body)
+        if method == 'DELETE':
+            return 200, engine.delete_index(name, ignore_unavailable)
+        indices = engine.resolve(name, ignore_unavailable)
+        if method == 'HEAD':
+            return 200, None
+        return 200, {index: dict(engine.indices[index].mapping_body(), aliases = {}) for index in indices}
+    if endpoint == '_alias':
+        indices = engine.resolve(name, ignore_unavailable, params.get('allow_no_indices', 'true') != 'false')
+        return 200, {index: {'aliases': {}} for index in indices}
+    if endpoint == '_search':
+        return 200, engine.search(name, body, ignore_unavailable)
+    if endpoint == '_count':
+        return 200, engine.count(name, body, ignore_unavailable)
+    if endpoint == '_pit':
+        return 200, engine.open_pit(name, params.get('keep_alive', '1m'))
+    if endpoint == '_delete_by_query':
+        rps = float(params.get('requests_per_second', -1))
+        return 200, engine.delete_by_query(name, body, params.get('wait_for_completion', 'true') != 'false', ignore_unavailable, rps)
+    if endpoint == '_mget':
+        return 200, engine.mget(name, body)
+    if parts[1] == '_update' and len(parts) == 3:
+        return 200, engine.update_doc(name, parts[2], body, params.get('if_seq_no'), params.get('if_primary_term'))
+    if endpoint == '_refresh':
+        engine.resolve(name, ignore_unavailable)
+        return 200, {'_shards': SHARDS}
+    if parts[1] in ('_doc', '_create') and len(parts) <= 3:
+        doc_id = parts[2] if len(parts) == 3 else uuid.uuid4().hex
+        if method in ('PUT', 'POST'):
+            op_type = 'create' if parts[1] == '_create' or params.get('op_type') == 'create' else 'index'
+            result = engine.index_doc(name, doc_id, body, op_type, params.get('if_seq_no'), params.get('if_primary_term'))
+            return (201 if result['result'] == 'created' else 200), result
+        if method == 'DELETE':
+            return 200, engine.delete_doc(name, doc_id)
+        result = engine.get_doc(name, doc_id)
+        return 200, None if method == 'HEAD' else result
+    raise LocalError(400, 'illegal_argument_exception', f'{method} {url} is not supported by the local backend')
+
+class _LocalRequests:
+    '''
+    perform_request of the local connections: the engine answers instead of an HTTP round trip,
+    and failures raise the same TransportError subclasses an elasticsearch response would.
+    '''
+    def _answer(self, method, url, params, body, ignore):
+        start = time.perf_counter()
+        try:
+            status, data = handle(self.engine, method, url, params, body)
+        except LocalError as e:
+            status, data = e.status, e.body
+        raw = json.dumps(data) if data is not None else ''
+        duration = time.perf_counter() - start
+        if not (200 <= status < 300) and status not in ignore:
+            self.log_request_fail(method, url, url, body, duration, status, raw)
+            self._raise_error(status, raw)
+        self.log_request_success(method, url, url, body, status, raw, duration)
+        return status, HEADERS, raw
+
+class LocalConnection(_LocalRequests, Connection):
+    '''
+    elasticsearch-py connection answering from the local engine instead of over HTTP, so the
+    unchanged Elasticsearch client (and every route built on it) runs on the local backend.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = get_engine()
+
+    def perform_request(self, method, url, params = None, body = None, timeout = None, ignore = (), headers = None):
+        return self._answer(method, url, params, body, ignore)
+
+    def close(self):
+        pass
+
+class AsyncLocalConnection(_LocalRequests, AsyncConnection):
+    '''
+    LocalConnection for the asyncio client. The engine is in-process, so requests run inline.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = get_engine()
+
+    async def perform_request(self, method, url, params = None, body = None, timeout = None, ignore = (), headers = None):
+        return self._answer(method, url, params, body, ignore)
+
+    async def close(self):
+        pass
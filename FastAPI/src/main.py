@@ -1,39 +1,38 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from elasticsearch import Elasticsearch, exceptions
-from elasticsearch_dsl import Search, Index, Document
-from ssl import create_default_context
-
-#----------Elastic Authentication----------#
-cert = create_default_context(cafile = '/app/fastapi/src/certs/ca/ca.crt')
-es = Elasticsearch('https://es01:9200',
-                    http_auth=('elastic','elastic'),
-                    ssl_context=cert)
-
-#----------Global Varibles----------#
-API_URL_PREFIX = '/api/v0'
-KEYS = ["name", "version", "type", "uri", "application", "reference", "description", "content_type", "content_id", "owner"]
-#----------Classes----------#
-class NewIndex(BaseModel):
-    index: str
-
-class NewDocument(BaseModel):
-    name: str
-    version: str
-    type: str
-    uri: str
-    application: list
-    reference: str
-    description: str
-    content_type: str
-    content_id: str
-    owner: str
+import asyncio
+import json
+from typing import List, Optional
+
+from fastapi import Body, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from elasticsearch import exceptions
+
+import admission
+import async_routes
+import cache
+import es_client
+import handlers
+import health
+import metrics
+from bulk import bulk_ingest, BULK_BATCH_DOCS, BULK_MAX_IN_FLIGHT
+from cache import result_cache, facet_cache
+from coalesce import single_flight
+from deletes import DELETE_REQUESTS_PER_SECOND, DELETE_SLICES
+from export import open_export, EXPORT_PAGE_SIZE
+from health import readiness
+from indices import index_resolver, requested_indices
+from models import API_URL_PREFIX, NewIndex, NewDocument, DocumentPatch
+from profiling import PROFILES
+from search_query import plan_phases, MAX_PAGE_SIZE, FUZZY_MIN_HITS, FACET_SIZE
 
 #----------Fast API Setup----------#
 app = FastAPI(  openapi_url ="/api/lbl-mlexchange/openapi.json",
                 docs_url    ="/api/lbl-mlexchange/docs",
                 redoc_url   ="/api/lbl-mlexchange/redoc",
              )
+app.router.route_class = admission.AdmittedRoute
+# Routes defined with @routes are served both here and, through the asyncio client,
+# under API_URL_PREFIX + '/async' (see async_routes.py)
+routes = handlers.Routes()
 
 # Core HTTP Methods:
 # GET : ask app to get something and return it to you
@@ -41,21 +40,219 @@ app = FastAPI(  openapi_url ="/api/lbl-mlexchange/openapi.json",
 # PUT: update something already in the database
 # DELETE: get rid of the information
 
+#----------Lifecycle----------#
+@app.on_event('startup')
+async def start_warmup():
+    '''
+    Warm up in the background, so the app starts serving /healthz even while elasticsearch is
+    unreachable: build the clients, install the registry index template (so indices created by
+    any client get explicit mappings), open pooled connections and query each registry index.
+    '''
+    app.state.warmup = asyncio.ensure_future(health.warm_up())
+
+@app.on_event('shutdown')
+async def stop_warmup():
+    app.state.warmup.cancel()
+
+@app.get('/healthz', include_in_schema = False)
+def healthz() -> dict:
+    '''
+    Liveness: the process answers, whatever the state of elasticsearch.
+    '''
+    return {'status': 'ok', 'uptime_seconds': round(readiness.uptime(), 3)}
+
+@app.get('/readyz', include_in_schema = False)
+async def readyz():
+    '''
+    Readiness: the warmup finished and elasticsearch answers a ping. Reports the startup
+    timings either way, with status 503 while not ready.
+    '''
+    if not readiness.warm:
+        status = 'warming up'
+    elif not await readiness.check():
+        status = 'elasticsearch unavailable'
+    else:
+        status = 'ready'
+    return JSONResponse(dict(readiness.report(), status = status), status_code = 200 if status == 'ready' else 503)
+
 #----------GET----------#
-@app.get(API_URL_PREFIX + '/search/document/', tags = ['Keyword'])
-def search(keyword: str) -> list: 
+@routes.get('/search/document/', tags = ['Keyword'])
+def search(keyword: Optional[str] = None,
+           index: Optional[str] = None,
+           content_type: Optional[List[str]] = Query(None),
+           owner: Optional[List[str]] = Query(None),
+           application: Optional[List[str]] = Query(None),
+           version: Optional[List[str]] = Query(None),
+           size: int = Query(10, ge = 1, le = MAX_PAGE_SIZE),
+           from_: int = Query(0, alias = 'from', ge = 0),
+           exact_total: bool = False,
+           deep: bool = False,
+           cursor: Optional[str] = None,
+           match: str = Query('auto', regex = '^(auto|exact|fuzzy)$'),
+           min_hits: int = Query(FUZZY_MIN_HITS, ge = 1, le = MAX_PAGE_SIZE),
+           facets: Optional[List[str]] = Query(None),
+           facet_size: int = Query(FACET_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+           mode: str = Query('keyword', regex = '^(keyword|semantic|hybrid)$'),
+           envelope: bool = False,
+           profile: bool = False,
+           x_admin_token: Optional[str] = Header(None)):
     '''
-    Search the keyword within documents stored in elastic.
+    Search the keyword within documents stored in elastic, optionally narrowed by structured
+    filters. Filters are exact matches; repeating one ORs its values, different filters are AND-ed.
 
     Args:
-        keyword: the keyword used to put into a search query
+        keyword: the keyword used to put into a search query, omit it to only filter
+        index: comma separated indices, aliases or patterns to search instead of the registry indices
+        content_type: registry content types to search (repeatable), defaults to all of them
+        owner: owners to filter on (repeatable)
+        application: applications to filter on (repeatable)
+        version: versions to filter on (repeatable)
+        size: number of documents per page
+        from_: offset of the first document, for shallow paging (from + size <= 10000)
+        exact_total: count every match, otherwise the total is exact only up to a bound
+        deep: page with a point-in-time cursor instead of an offset, requires envelope
+        cursor: cursor returned with the previous page of a deep search
+        match: "auto" runs an exact/phrase-prefix query first and falls back to fuzzy
+               matching below min_hits matches, "exact" and "fuzzy" force one phase
+        min_hits: fewest exact matches that answer without the fuzzy fallback
+        facets: fields to count matches by (repeatable): content_type, owner, application or version.
+                Counts are cached apart from the hits, so paging does not recompute them,
+                and are only returned with the first page of a deep search. Requires envelope
+        facet_size: number of values counted per facet
+        mode: "keyword" ranks by BM25 text matching, "semantic" by similarity between the embeddings
+              of the keyword and of the documents (nearest neighbours), "hybrid" fuses both rankings.
+              Semantic and hybrid searches page with from and size only and return no facets
+        envelope: return the page envelope (hits as elasticsearch returns them, total, shards, phase,
+                  facets and cursor) instead of the list of documents
+        profile: return the elasticsearch profile and a server-side timing breakdown of the search
+                 (query build, elasticsearch round trip, hit conversion, JSON encoding). Admins only,
+                 for shallow keyword-mode searches, requires envelope. Requests that are not sampled
+                 are answered as usual, with a profile that only says sampled false
+        x_admin_token: admin token required by profile
     Return:
-        list of documents matching the search query, with order associated with ranking score.
+        list of documents matching the search query, with order associated with ranking score,
+        or with envelope the page of those documents, the total number of matches, the shards
+        searched, the phase that answered, the facet counts and, for deep searches, the cursor
+        of the next page.
+        if the cursor is malformed, the offset too deep, a facet unknown, an option unsupported
+        by the mode or deep paging, facets or a profile are asked without envelope -> 400 error
+        if profile is requested without an admin token                            -> 403 error
+        if the cursor has expired                                                   -> 404 error
     '''
-    resp = Search().using(es).query("multi_match", query = keyword, fuzziness = "AUTO").extra(track_total_hits = True).execute()
-    return list(resp)
+    return handlers.search(keyword, index, content_type, owner, application, version, size, from_, exact_total,
+                           deep, cursor, match, min_hits, facets, facet_size, mode, envelope, profile, x_admin_token)
 
-@app.post(API_URL_PREFIX + '/index', status_code=201, tags = ['Index'])
+@routes.post('/search/batch', tags = ['Keyword'])
+def search_batch(queries: List[dict] = Body(...)):
+    '''
+    Run several keyword searches in one elasticsearch msearch round trip (a second one only
+    for the queries falling back to fuzzy matching).
+
+    Args:
+        queries: list of search queries, each with the parameters of /search/document/
+                 except the deep paging ones (deep, cursor, envelope)
+
+    Return:
+        number of queries, number of failed queries and one result per query in request order:
+        the page envelope of /search/document/ with status 200, or a status and error for that
+        query alone
+        if more than MAX_BATCH_QUERIES queries are sent -> 400 error
+    '''
+    return handlers.search_batch(queries)
+
+@app.get(API_URL_PREFIX + '/search/export', tags = ['Keyword'])
+async def export(keyword: Optional[str] = None,
+                 index: Optional[str] = None,
+                 content_type: Optional[List[str]] = Query(None),
+                 owner: Optional[List[str]] = Query(None),
+                 application: Optional[List[str]] = Query(None),
+                 version: Optional[List[str]] = Query(None),
+                 match: str = Query('auto', regex = '^(auto|exact|fuzzy)$'),
+                 min_hits: int = Query(FUZZY_MIN_HITS, ge = 1, le = MAX_PAGE_SIZE),
+                 after: Optional[str] = None,
+                 page_size: int = Query(EXPORT_PAGE_SIZE, ge = 1, le = 10000)):
+    '''
+    Stream every document matching a search (or every document of the indices, without keyword
+    and filters) as NDJSON, read page by page through a point-in-time.
+
+    Args:
+        keyword, index, content_type, owner, application, version, match, min_hits:
+            the search, as for /search/document/
+        after: JSON sort key ("sort" of the last line received) to resume an interrupted export,
+               together with match set to the X-Export-Phase header of the first response
+        page_size: documents fetched from elasticsearch per page
+
+    Return:
+        NDJSON stream, one {"_index", "_id", "_source", "sort"} line per document, ordered by
+        content_type and content_id; the answering phase is sent in the X-Export-Phase header
+        if after is malformed, or given without match for a keyword -> 400 error
+        if an index does not exist                                  -> 404 error
+    '''
+    try:
+        resume = json.loads(after) if after else None
+        if resume is not None and not isinstance(resume, list):
+            raise ValueError('after must be a JSON list of sort values')
+        if resume is not None and keyword and match == 'auto':
+            raise ValueError('Pass match=exact or match=fuzzy (the X-Export-Phase header) to resume an export')
+        phases = plan_phases(match, None, keyword)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    filters = {'content_type': content_type, 'owner': owner, 'application': application, 'version': version}
+    indices = await index_resolver.aresolve(es_client.aes, requested_indices(index, content_type))
+    if not indices:
+        return StreamingResponse(iter(()), media_type = 'application/x-ndjson')
+    try:
+        phase, chunks = await open_export(es_client.aes, indices, keyword, phases, filters, min_hits, resume, page_size)
+    except exceptions.RequestError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    except exceptions.NotFoundError as e:
+        raise HTTPException(status_code = 404, detail = str(e))
+    return StreamingResponse(chunks, media_type = 'application/x-ndjson', headers = {'X-Export-Phase': str(phase or '')})
+
+@app.get(API_URL_PREFIX + '/search/cache', tags = ['Keyword'])
+def cache_stats() -> dict:
+    '''
+    Report the search result and facet cache counters, and how many identical concurrent
+    searches shared one elasticsearch call.
+
+    Return:
+        for "pages" and "facets": current size and capacity, hits, misses, hit ratio,
+        evictions, expirations and invalidations;
+        for "coalescing": searches in flight, searches sent to elasticsearch (leaders)
+        and searches that waited for an identical one instead (coalesced)
+    '''
+    return {'pages': result_cache.stats(), 'facets': facet_cache.stats(), 'coalescing': single_flight.stats()}
+
+@app.get('/metrics', include_in_schema = False)
+def prometheus_metrics():
+    '''
+    Route latency and in-flight requests, elasticsearch call timings split into took, network
+    and serialization, elasticsearch errors by type, and the cache and coalescing counters,
+    in the Prometheus text format.
+    '''
+    return PlainTextResponse(metrics.render(), media_type = 'text/plain; version=0.0.4')
+
+def cache_metrics() -> list:
+    '''
+    Exposition lines of the result caches and the search coalescing counters.
+    '''
+    lines = ['# HELP search_api_cache_lookups_total Search cache lookups by cache and result.',
+             '# TYPE search_api_cache_lookups_total counter']
+    for name, stats in (('pages', result_cache.stats()), ('facets', facet_cache.stats())):
+        lines.append(f'search_api_cache_lookups_total{{cache="{name}",result="hit"}} {stats["hits"]}')
+        lines.append(f'search_api_cache_lookups_total{{cache="{name}",result="miss"}} {stats["misses"]}')
+    stats = single_flight.stats()
+    lines += ['# HELP search_api_searches_coalesced_total Searches that waited for an identical in-flight one.',
+              '# TYPE search_api_searches_coalesced_total counter',
+              f'search_api_searches_coalesced_total {stats["coalesced"]}']
+    return lines
+
+metrics.register_collector(cache_metrics)
+metrics.register_collector(readiness.metric_lines)
+metrics.register_collector(PROFILES.render)
+metrics.register_collector(admission.metric_lines)
+
+@routes.post('/index', status_code=201, tags = ['Index'])
 def create_index(req: NewIndex):
     '''
     Create a new index for elasticsearch.
@@ -67,14 +264,9 @@ def create_index(req: NewIndex):
         if index being created successfully -> response body 
         if index already exists             -> 400 error
     '''
-    try:
-        resp = Index(req.index).create(using = es)
-    except exceptions.RequestError as e:
-        raise HTTPException(status_code = 400, detail = str(e))
-    else:
-        return resp
+    return handlers.create_index(req.index)
     
-@app.post(API_URL_PREFIX + '/index/document', status_code=201, tags = ['Document'])
+@routes.post('/index/document', status_code=201, tags = ['Document'])
 def index_doc(index: str, doc_id: str, doc: NewDocument):
     '''
     Insert a document to the index.
@@ -87,14 +279,79 @@ def index_doc(index: str, doc_id: str, doc: NewDocument):
     Return:
         response body, creat/update will be indicated
     '''
-    resp = es.index(index = index, id = doc_id, document = dict(doc))
+    return handlers.index_doc(index, doc_id, dict(doc))
+
+@app.post(API_URL_PREFIX + '/index/documents/bulk', tags = ['Document'])
+async def bulk_index_docs(request: Request,
+                          index: Optional[str] = None,
+                          batch_size: int = Query(BULK_BATCH_DOCS, ge = 1, le = 10000),
+                          max_in_flight: int = Query(BULK_MAX_IN_FLIGHT, ge = 1, le = 16)):
+    '''
+    Insert documents streamed as NDJSON, one NewDocument per line. The body is read
+    incrementally and forwarded to elasticsearch in bounded bulk batches.
+
+    Args:
+        request: streamed NDJSON body
+        index: index for every document, defaults to each document's content_type
+        batch_size: number of documents per bulk request
+        max_in_flight: number of bulk requests sent concurrently
+
+    Return:
+        number of items and failures, and per-item results (line number, _index, _id,
+        status and result or error) in line order
+    '''
+    resp = await bulk_ingest(es_client.aes, request.stream(), index, batch_size, max_in_flight)
+    for name in {result['_index'] for result in resp['results'] if '_index' in result}:
+        cache.invalidate(name)
+        index_resolver.invalidate(name)
     return resp
 
 #----------PUT----------#
+@routes.patch('/index/{index}/document/{doc_id}', tags = ['Document'])
+def update_doc(index: str, doc_id: str, doc: DocumentPatch,
+               if_seq_no: Optional[int] = Query(None, ge = 0),
+               if_primary_term: Optional[int] = Query(None, ge = 1)):
+    '''
+    Update some fields of a document without sending the whole document again.
+
+    Args:
+        index: the index where document resides
+        doc_id: the id of the document to be updated
+        doc: the fields to change (from request body)
+        if_seq_no: only update the document while it is at this sequence number, as returned
+                   by the write that produced the version being edited, so concurrent edits
+                   are not overwritten
+        if_primary_term: primary term returned with if_seq_no
+
+    Return:
+        response body, "updated" or "noop" will be indicated, with the new _seq_no and _primary_term
+        if no field changes or only one of if_seq_no, if_primary_term is given -> 400 error
+        if document id or index does not exist                               -> 404 error
+        if the document changed since if_seq_no                              -> 409 error
+    '''
+    changes = doc.dict(exclude_unset = True, exclude_none = True)
+    return handlers.update_doc(index, doc_id, changes, if_seq_no, if_primary_term)
 
+@routes.patch('/index/{index}/documents/bulk', tags = ['Document'])
+def update_docs(index: str, updates: List[dict] = Body(...)):
+    '''
+    Update some fields of many documents of an index with bulk requests, e.g. to reassign
+    the owner of a set of documents.
+
+    Args:
+        index: the index where the documents reside
+        updates: list of {"id", "doc", "if_seq_no", "if_primary_term"}, doc holding the fields
+                 to change and the optional guards working as for a single update
+
+    Return:
+        number of items and failures, and one result per update in request order:
+        _id, status and result with the new _seq_no and _primary_term, or an error
+        if more than MAX_UPDATE_DOCS updates are sent -> 400 error
+    '''
+    return handlers.update_docs(index, updates)
 
 #----------DELETE----------#
-@app.delete(API_URL_PREFIX + '/index/{index}', status_code=204, tags = ['Index'])
+@routes.delete('/index/{index}', status_code=204, tags = ['Index'])
 def delete_index(index: str):
     '''
     Delete an index.
@@ -106,14 +363,9 @@ def delete_index(index: str):
         if index being deleted successfully -> response body 
         if index does not exist             -> 404 error
     '''
-    try:
-        resp = Index(index).delete(using = es)
-    except exceptions.NotFoundError as e:
-        raise HTTPException(status_code = 404, detail = str(e))
-    else:
-        return resp
+    return handlers.delete_index(index)
 
-@app.delete(API_URL_PREFIX + '/index/{index}/document/{doc_id}', status_code = 200, tags = ['Document'])
+@routes.delete('/index/{index}/document/{doc_id}', status_code = 200, tags = ['Document'])
 def delete_doc(index: str, doc_id: str):
     '''
     Delete the document within the index.
@@ -126,8 +378,84 @@ def delete_doc(index: str, doc_id: str):
         if document being deleted successfully -> HTTP 204 Status Code
         if document id or index does not exist -> 404 error
     '''
-    try:
-        resp = Document().delete(using = es, index = index, id = doc_id)
-    except exceptions.NotFoundError as e:
-        raise HTTPException(status_code = 404, detail = str(e))
-    return print(f'Successfully deleted content_id: {doc_id} within "{index}" category')
\ No newline at end of file
+    return handlers.delete_doc(index, doc_id)
+
+@routes.delete('/index/documents/query', status_code = 202, tags = ['Document'])
+def delete_by_query(keyword: Optional[str] = None,
+                    index: Optional[str] = None,
+                    content_type: Optional[List[str]] = Query(None),
+                    owner: Optional[List[str]] = Query(None),
+                    application: Optional[List[str]] = Query(None),
+                    version: Optional[List[str]] = Query(None),
+                    match: str = Query('exact', regex = '^(exact|fuzzy)$'),
+                    requests_per_second: float = Query(DELETE_REQUESTS_PER_SECOND, ge = -1),
+                    slices: str = Query(DELETE_SLICES, regex = '^(auto|[1-9][0-9]*)$')):
+    '''
+    Start deleting every document a search with the same keyword and filters would return,
+    as a background task. Poll /tasks/{task} for its progress, or cancel it there.
+
+    Args:
+        keyword, index, content_type, owner, application, version: the search, as for /search/document/
+        match: query phase matching the keyword, "exact" (default) or "fuzzy"
+        requests_per_second: documents deleted per second, to throttle the task, -1 disables throttling
+        slices: number of slices deleting in parallel, "auto" for one per shard
+
+    Return:
+        the task id and the indices deleted from
+        if neither keyword nor filter is given,
+        or requests_per_second is neither positive nor -1 -> 400 error
+        if no index matches                               -> 404 error
+    '''
+    return handlers.delete_by_query(keyword, index, content_type, owner, application, version, match,
+                                    requests_per_second, slices)
+
+@routes.delete('/index/{index}/documents/bulk', tags = ['Document'])
+def delete_docs(index: str, ids: List[str] = Body(...)):
+    '''
+    Delete many documents of an index by id, with bulk requests.
+
+    Args:
+        index: the index where the documents reside
+        ids: ids of the documents to be deleted (from request body)
+
+    Return:
+        number of items, deleted documents and failures, and one result per id in request
+        order: _id, status and result ("deleted" or "not_found") or error
+        if more than MAX_DELETE_IDS ids are sent -> 400 error
+    '''
+    return handlers.delete_docs(index, ids)
+
+#----------Tasks----------#
+@routes.get('/tasks/{task}', tags = ['Document'])
+def get_task(task: str):
+    '''
+    Progress of a delete-by-query task.
+
+    Args:
+        task: the task id returned when the deletion started
+
+    Return:
+        whether the task completed or was cancelled, the documents it deletes, deleted so far
+        and progress (their ratio), version conflicts, batches, throttle and failures
+        if the task is unknown -> 404 error
+    '''
+    return handlers.get_task(task)
+
+@routes.delete('/tasks/{task}', tags = ['Document'])
+def cancel_task(task: str):
+    '''
+    Cancel a delete-by-query task and all its slices. Documents already deleted stay deleted.
+
+    Args:
+        task: the task id returned when the deletion started
+
+    Return:
+        the progress of the task, see GET /tasks/{task}
+        if the task is unknown -> 404 error
+    '''
+    return handlers.cancel_task(task)
+
+#----------Routes----------#
+routes.mount(app.router, API_URL_PREFIX)
+routes.mount(async_routes.router, asynchronous = True)
+app.include_router(async_routes.router, prefix = API_URL_PREFIX + '/async')
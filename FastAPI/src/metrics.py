@@ -0,0 +1,189 @@
+import bisect
+import re
+import threading
+from contextvars import ContextVar
+from time import perf_counter
+
+from elasticsearch import exceptions
+from fastapi.routing import APIRoute
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+#----------Metric Settings----------#
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#----------Metric Types----------#
+# Plain in-process counters rendered in the Prometheus text format on /metrics. Recording
+# is a dict lookup and a few additions under a lock, a microsecond or two per request.
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            lines += [f'{self.name}{_labels(self.labels, key)} {value}' for key, value in sorted(self._values.items())]
+        return lines
+
+class Gauge(Counter):
+    def dec(self, *labels):
+        self.inc(*labels, value = -1)
+
+    def render(self) -> list:
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._series = {}       # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+#----------Registry----------#
+REQUEST_SECONDS = Histogram('search_api_request_duration_seconds',
+                            'Time until a route returned its response.', ('method', 'route', 'status'))
+IN_FLIGHT       = Gauge('search_api_requests_in_flight', 'Requests currently being handled.', ('method', 'route'))
+ES_SECONDS      = Histogram('search_api_es_duration_seconds',
+                            'Elasticsearch calls as seen by the client, retries included.', ('endpoint',))
+ES_TOOK         = Histogram('search_api_es_took_seconds',
+                            'Time elasticsearch reported spending on the request (took).', ('endpoint',))
+ES_NETWORK      = Histogram('search_api_es_network_seconds',
+                            'HTTP round trip minus took: network, queueing and the HTTP layer.', ('endpoint',))
+ES_OVERHEAD     = Histogram('search_api_es_serialization_seconds',
+                            'Client time outside the HTTP round trip: body serialization and response parsing.', ('endpoint',))
+ES_ERRORS       = Counter('search_api_es_errors_total', 'Failed elasticsearch calls by error type.', ('endpoint', 'type'))
+
+METRICS = [REQUEST_SECONDS, IN_FLIGHT, ES_SECONDS, ES_TOOK, ES_NETWORK, ES_OVERHEAD, ES_ERRORS]
+_collectors = []
+
+def register_collector(collect):
+    '''
+    Add a callable returning extra exposition lines, for state owned by other modules.
+    '''
+    _collectors.append(collect)
+
+def render() -> str:
+    '''
+    Every metric in the Prometheus text exposition format (version 0.0.4).
+    '''
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for collect in _collectors:
+        lines += collect()
+    return '\n'.join(lines) + '\n'
+
+#----------Route Instrumentation----------#
+class InstrumentedRoute(APIRoute):
+    '''
+    APIRoute recording latency and in-flight requests under the route's path template, so
+    /index/{index} is one series however many indices exist. Streamed responses are timed
+    until the response object is returned, not until the last chunk is sent.
+    '''
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def instrumented_handler(request):
+            method = request.method
+            IN_FLIGHT.inc(method, route)
+            start = perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except StarletteHTTPException as e:
+                status = e.status_code
+                raise
+            finally:
+                REQUEST_SECONDS.observe(perf_counter() - start, method, route, status)
+                IN_FLIGHT.dec(method, route)
+        return instrumented_handler
+
+#----------Elasticsearch Instrumentation----------#
+# The connection classes of es_client report the duration of the HTTP round trip here; the
+# transport reads it back within the same call (thread or task), so no lookup is shared.
+_round_trip = ContextVar('es_round_trip', default = None)
+_ERROR_TYPE = re.compile(r'[a-z_]+')
+
+def record_round_trip(duration: float):
+    _round_trip.set(duration)
+
+def es_endpoint(url: str) -> str:
+    '''
+    Low cardinality name of an elasticsearch API path: its last "_" segment, e.g. "_search".
+    '''
+    for part in reversed(url.split('?', 1)[0].split('/')):
+        if part.startswith('_'):
+            return part
+    return 'index' if url.strip('/') else 'info'
+
+def es_error_type(error: Exception) -> str:
+    '''
+    The elasticsearch error type of a failed call (e.g. "index_not_found_exception"), or the
+    client exception name when elasticsearch did not answer with one.
+    '''
+    kind = getattr(error, 'error', None)
+    if isinstance(error, exceptions.ConnectionError) or not isinstance(kind, str) or not _ERROR_TYPE.fullmatch(kind):
+        kind = type(error).__name__
+    return kind
+
+def es_started():
+    _round_trip.set(None)
+    return perf_counter()
+
+def es_finished(url: str, started: float, resp = None, error: Exception = None):
+    '''
+    Split one elasticsearch call into took, network and client serialization time, or count
+    its error by type (the elasticsearch error type, or the client exception name).
+    '''
+    total = perf_counter() - started
+    endpoint = es_endpoint(url)
+    ES_SECONDS.observe(total, endpoint)
+    if error is not None:
+        ES_ERRORS.inc(endpoint, es_error_type(error))
+        return
+    round_trip = _round_trip.get()
+    if round_trip is None:
+        return
+    ES_OVERHEAD.observe(max(total - round_trip, 0.0), endpoint)
+    took = resp.get('took') if isinstance(resp, dict) else None
+    if isinstance(took, (int, float)):
+        ES_TOOK.observe(took / 1000, endpoint)
+        ES_NETWORK.observe(max(round_trip - took / 1000, 0.0), endpoint)
@@ -0,0 +1,72 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+from search_query import MAX_PAGE_SIZE, FUZZY_MIN_HITS, FACET_SIZE
+
+#----------Global Varibles----------#
+API_URL_PREFIX = '/api/v0'
+KEYS = ["name", "version", "type", "uri", "application", "reference", "description", "content_type", "content_id", "owner"]
+
+#----------Classes----------#
+class NewIndex(BaseModel):
+    index: str
+
+class NewDocument(BaseModel):
+    name: str
+    version: str
+    type: str
+    uri: str
+    application: list
+    reference: str
+    description: str
+    content_type: str
+    content_id: str
+    owner: str
+
+class DocumentPatch(BaseModel):
+    '''
+    Fields of a partial document update; content_type and content_id identify the document
+    and cannot change.
+    '''
+    name: Optional[str] = None
+    version: Optional[str] = None
+    type: Optional[str] = None
+    uri: Optional[str] = None
+    application: Optional[list] = None
+    reference: Optional[str] = None
+    description: Optional[str] = None
+    owner: Optional[str] = None
+
+    class Config:
+        extra = 'forbid'
+
+class DocumentUpdate(BaseModel):
+    '''
+    One item of a bulk partial update.
+    '''
+    id: str
+    doc: DocumentPatch
+    if_seq_no: Optional[int] = Field(None, ge = 0)
+    if_primary_term: Optional[int] = Field(None, ge = 1)
+
+class SearchQuery(BaseModel):
+    '''
+    One query of a batch search, with the parameters of /search/document/ (shallow paging only).
+    '''
+    keyword: Optional[str] = None
+    index: Optional[str] = None
+    content_type: Optional[List[str]] = None
+    owner: Optional[List[str]] = None
+    application: Optional[List[str]] = None
+    version: Optional[List[str]] = None
+    size: int = Field(10, ge = 1, le = MAX_PAGE_SIZE)
+    from_: int = Field(0, alias = 'from', ge = 0)
+    exact_total: bool = False
+    match: str = Field('auto', regex = '^(auto|exact|fuzzy)$')
+    min_hits: int = Field(FUZZY_MIN_HITS, ge = 1, le = MAX_PAGE_SIZE)
+    facets: Optional[List[str]] = None
+    facet_size: int = Field(FACET_SIZE, ge = 1, le = MAX_PAGE_SIZE)
+
+    class Config:
+        allow_population_by_field_name = True
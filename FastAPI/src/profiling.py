@@ -0,0 +1,174 @@
+import hmac
+import json
+import os
+import random
+import threading
+import time
+
+from es_client import ES_SEARCH_TIMEOUT
+from metrics import Counter
+from search_query import keyword_search, add_facets, enough_hits, page_response, facet_response
+
+#----------Profile Settings----------#
+# ?profile=true sends the search with elasticsearch's profile flag and times every step of the
+# request on the server. Profiled searches skip the cache and coalescing and cost far more than
+# plain ones, so only admins may ask for them, and only a sample of those requests is profiled:
+# each one with probability PROFILE_SAMPLE_RATE, and at most PROFILE_PER_MINUTE of them.
+PROFILE_ADMIN_TOKENS = [token for token in os.getenv('PROFILE_ADMIN_TOKENS', '').split(',') if token]  # empty disables profiling
+PROFILE_SAMPLE_RATE  = float(os.getenv('PROFILE_SAMPLE_RATE', 1.0))
+PROFILE_PER_MINUTE   = float(os.getenv('PROFILE_PER_MINUTE', 10))
+
+PROFILES = Counter('search_api_profiles_total', 'Search profiling requests by outcome.', ('outcome',))
+
+#----------Admission----------#
+def is_admin(token: str) -> bool:
+    '''
+    True when the token is one of PROFILE_ADMIN_TOKENS.
+    '''
+    return token is not None and any(hmac.compare_digest(token, admin) for admin in PROFILE_ADMIN_TOKENS)
+
+def check_profile(mode: str, deep: bool):
+    '''
+    Raise:
+        ValueError when the search cannot be profiled
+    '''
+    if mode != 'keyword' or deep:
+        raise ValueError('Only shallow searches with mode=keyword can be profiled')
+
+class Sampler:
+    '''
+    Picks the profiling requests that are actually profiled: each with probability rate,
+    within a token bucket refilled with per_minute tokens a minute.
+    '''
+    def __init__(self, rate: float = PROFILE_SAMPLE_RATE, per_minute: float = PROFILE_PER_MINUTE,
+                 clock = time.monotonic, draw = random.random):
+        self.rate, self.per_minute = rate, per_minute
+        self._clock, self._draw = clock, draw
+        self._tokens = per_minute
+        self._refilled = clock()
+        self._lock = threading.Lock()
+
+    def sample(self) -> bool:
+        if self._draw() >= self.rate:
+            PROFILES.inc('not_sampled')
+            return False
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.per_minute, self._tokens + (now - self._refilled) * self.per_minute / 60)
+            self._refilled = now
+            sampled = self._tokens >= 1
+            if sampled:
+                self._tokens -= 1
+        PROFILES.inc('profiled' if sampled else 'over_budget')
+        return sampled
+
+profile_sampler = Sampler()
+
+#----------Profile----------#
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+def shard_summary(es_profile: dict) -> list:
+    '''
+    Per-shard totals of an elasticsearch profile: query, rewrite (where fuzzy and prefix terms
+    are expanded), collector and aggregation time, in milliseconds.
+    '''
+    shards = []
+    for shard in es_profile.get('shards', []):
+        searches = shard.get('searches', [])
+        shards.append({'id': shard.get('id'),
+                       'query_ms': sum(q.get('time_in_nanos', 0) for s in searches for q in s.get('query', [])) / 1e6,
+                       'rewrite_ms': sum(s.get('rewrite_time', 0) for s in searches) / 1e6,
+                       'collector_ms': sum(c.get('time_in_nanos', 0) for s in searches for c in s.get('collector', [])) / 1e6,
+                       'aggregations_ms': sum(a.get('time_in_nanos', 0) for a in shard.get('aggregations', [])) / 1e6})
+    return shards
+
+class Profile:
+    '''
+    Server-side timing breakdown of one search request: building the query, each elasticsearch
+    round trip (split into the took elasticsearch reports and the rest), converting the hits
+    into the page and encoding the page as JSON.
+    '''
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.timings = {'build': 0.0, 'convert': 0.0, 'encode': 0.0}
+        self.searches = []
+
+    def timed(self, step: str, started: float):
+        self.timings[step] += time.perf_counter() - started
+
+    def search(self, phase: str, raw: dict, started: float):
+        round_trip = time.perf_counter() - started
+        self.searches.append({'phase': phase,
+                              'round_trip_ms': _ms(round_trip),
+                              'took_ms': raw.get('took'),
+                              'network_ms': _ms(max(round_trip - raw.get('took', 0) / 1000, 0)),
+                              'shards': raw.get('_shards', {}).get('total'),
+                              'hits': len(raw['hits']['hits']),
+                              'shard_profile': shard_summary(raw.get('profile', {})),
+                              'es_profile': raw.get('profile')})
+
+    def finish(self, page: dict) -> dict:
+        '''
+        The page with its profile, after timing its JSON encoding.
+        '''
+        started = time.perf_counter()
+        json.dumps(page, ensure_ascii = False, allow_nan = False, separators = (',', ':'))
+        self.timed('encode', started)
+        es_ms = sum(search['round_trip_ms'] for search in self.searches)
+        breakdown = {f'{step}_ms': _ms(seconds) for step, seconds in self.timings.items()}
+        return dict(page, profile = {'sampled': True,
+                                     'total_ms': _ms(time.perf_counter() - self._start),
+                                     'es_round_trip_ms': round(es_ms, 3),
+                                     **breakdown,
+                                     'searches': self.searches})
+
+def _profile_body(profile: Profile, keyword: str, phase: str, filters: dict, size: int, from_: int,
+                  exact_total: bool, facets: list, facet_size: int) -> dict:
+    started = time.perf_counter()
+    s = keyword_search(keyword, phase, filters, size, from_, exact_total)
+    if facets:
+        s = add_facets(s, facets, facet_size)
+    body = s.extra(profile = True).to_dict()
+    profile.timed('build', started)
+    return body
+
+def _profile_page(profile: Profile, raw: dict, size: int, from_: int, phase: str, facets: list) -> dict:
+    started = time.perf_counter()
+    page = dict(page_response(raw, size, from_, phase), facets = facet_response(raw) if facets else None)
+    profile.timed('convert', started)
+    return profile.finish(page)
+
+def profiled_search(client, indices: list, keyword: str, phases: list, filters: dict, size: int, from_: int,
+                    exact_total: bool, min_hits: int, facets: list, facet_size: int) -> dict:
+    '''
+    Run a shallow keyword search with elasticsearch profiling, bypassing the cache and coalescing.
+
+    Return:
+        the search page, with a "profile" holding the timing breakdown and, per query phase
+        sent, the elasticsearch profile and its per-shard totals
+    '''
+    profile = Profile()
+    for phase in phases:
+        body = _profile_body(profile, keyword, phase, filters, size, from_, exact_total, facets, facet_size)
+        started = time.perf_counter()
+        raw = client.search(index = ','.join(indices), body = body, ignore_unavailable = True, request_timeout = ES_SEARCH_TIMEOUT)
+        profile.search(phase, raw, started)
+        if enough_hits(raw, min_hits):
+            break
+    return _profile_page(profile, raw, size, from_, phase, facets)
+
+async def aprofiled_search(client, indices: list, keyword: str, phases: list, filters: dict, size: int, from_: int,
+                           exact_total: bool, min_hits: int, facets: list, facet_size: int) -> dict:
+    '''
+    profiled_search() with the asyncio client.
+    '''
+    profile = Profile()
+    for phase in phases:
+        body = _profile_body(profile, keyword, phase, filters, size, from_, exact_total, facets, facet_size)
+        started = time.perf_counter()
+        raw = await client.search(index = ','.join(indices), body = body, ignore_unavailable = True, request_timeout = ES_SEARCH_TIMEOUT)
+        profile.search(phase, raw, started)
+        if enough_hits(raw, min_hits):
+            break
+    return _profile_page(profile, raw, size, from_, phase, facets)
@@ -0,0 +1,292 @@
+import base64
+import hashlib
+import json
+import os
+
+from elasticsearch_dsl import Search, Q
+
+from index_template import search_fields, text_fields
+
+#----------Paging Settings----------#
+MAX_PAGE_SIZE     = int(os.getenv('MAX_PAGE_SIZE', 100))
+MAX_RESULT_WINDOW = int(os.getenv('MAX_RESULT_WINDOW', 10000))  # matches index.max_result_window
+TOTAL_HITS_BOUND  = int(os.getenv('TOTAL_HITS_BOUND', 1000))    # totals are exact up to this many hits
+PIT_KEEP_ALIVE    = os.getenv('PIT_KEEP_ALIVE', '1m')
+
+#----------Query Planner Settings----------#
+# A keyword is first matched exactly (all terms, or as a phrase prefix); the fuzzy multi_match,
+# the most expensive query shape, only runs when that returns fewer than FUZZY_MIN_HITS hits.
+PHASES                = ('exact', 'fuzzy')
+FUZZY_MIN_HITS        = int(os.getenv('FUZZY_MIN_HITS', 3))
+FUZZY_PREFIX_LENGTH   = int(os.getenv('FUZZY_PREFIX_LENGTH', 1))     # leading characters that must match exactly
+FUZZY_MAX_EXPANSIONS  = int(os.getenv('FUZZY_MAX_EXPANSIONS', 20))   # terms a fuzzy term may expand to (ES: 50)
+PREFIX_MAX_EXPANSIONS = int(os.getenv('PREFIX_MAX_EXPANSIONS', 20))  # terms the last phrase word may expand to
+
+#----------Filter Settings----------#
+# Structured filters run in the bool query's filter context: they are not scored and
+# elasticsearch caches them as bitsets. Fields are the keyword fields of registry_template.json.
+FILTER_FIELDS = {
+    'owner':        'owner.keyword',
+    'content_type': 'content_type',
+    'application':  'application.keyword',
+    'version':      'version',
+}
+SEARCH_FIELDS = search_fields()     # boosted fields of the index template
+PHRASE_FIELDS = text_fields()
+
+FACET_SIZE = int(os.getenv('FACET_SIZE', 10))   # buckets returned per facet
+
+#----------Export Settings----------#
+# Exports are sorted on the registry document key rather than the score, so a sort key
+# returned by one export stays meaningful for resuming it later under a new point-in-time.
+EXPORT_SORT = [{'content_type': {'unmapped_type': 'keyword'}}, {'content_id': {'unmapped_type': 'keyword'}}, {'_shard_doc': 'asc'}]
+
+#----------Cursors----------#
+def query_hash(keyword: str, filters: dict, index: str) -> str:
+    '''
+    Short hash of the keyword, filters and index of a search, stored in its cursors so a cursor
+    cannot be replayed against a different search. Repeated filter values are order independent.
+    '''
+    query = {'keyword': keyword or None, 'index': index or None,
+             'filters': {name: sorted(values) for name, values in filters.items() if values}}
+    return hashlib.sha1(json.dumps(query, sort_keys = True, separators = (',', ':')).encode()).hexdigest()[:16]
+
+def encode_cursor(pit_id: str, after: list, phase: str, query: str = None) -> str:
+    '''
+    Pack a point-in-time id, the sort values of the last hit, the query phase that answered
+    the first page and the query_hash of the search into an opaque cursor.
+    '''
+    raw = json.dumps({'pit': pit_id, 'after': after, 'phase': phase, 'query': query}, separators = (',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str, query: str = None) -> dict:
+    '''
+    Unpack a cursor produced by encode_cursor.
+
+    Args:
+        cursor: the cursor returned with the previous page
+        query: query_hash of the search the cursor is sent with
+    Return:
+        dict with "pit", "after" and "phase" keys
+    Raise:
+        ValueError if the cursor is malformed or was issued for another search
+    '''
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        state, issued = {'pit': state['pit'], 'after': state['after'], 'phase': state['phase']}, state['query']
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {e}')
+    if state['phase'] is not None and state['phase'] not in PHASES:
+        raise ValueError(f'Invalid cursor: unknown phase {state["phase"]}')
+    if issued != query:
+        raise ValueError('Invalid cursor: it was issued for a different search')
+    return state
+
+#----------Query Planner----------#
+def plan_phases(match: str = 'auto', phase: str = None, keyword: str = 'keyword') -> list:
+    '''
+    Query phases to try, in order.
+
+    Args:
+        match: "auto" (exact, then fuzzy on too few hits), "exact" or "fuzzy"
+        phase: phase recorded in a deep paging cursor, which later pages must keep using
+        keyword: the searched keyword, a filter-only search has a single phase None
+    Return:
+        list of phase names
+    '''
+    if not keyword:
+        return [None]
+    if phase is not None:
+        return [phase]
+    if match == 'auto':
+        return list(PHASES)
+    if match not in PHASES:
+        raise ValueError(f'Unknown match mode: {match}')
+    return [match]
+
+def phase_query(keyword: str, phase: str) -> Q:
+    '''
+    The query of one phase: every term present or the keyword as a phrase prefix for "exact",
+    a multi_match with bounded fuzzy expansion for "fuzzy".
+    '''
+    if phase == 'exact':
+        return Q('bool', minimum_should_match = 1, should = [
+            Q('multi_match', query = keyword, fields = SEARCH_FIELDS, operator = 'and'),
+            Q('multi_match', query = keyword, fields = PHRASE_FIELDS, type = 'phrase_prefix', max_expansions = PREFIX_MAX_EXPANSIONS),
+        ])
+    return Q('multi_match', query = keyword, fields = SEARCH_FIELDS, fuzziness = 'AUTO',
+             prefix_length = FUZZY_PREFIX_LENGTH, max_expansions = FUZZY_MAX_EXPANSIONS)
+
+def enough_hits(raw: dict, min_hits: int) -> bool:
+    '''
+    True when a phase found enough documents to answer without falling back.
+    '''
+    total = raw['hits'].get('total')
+    return (total['value'] if total else len(raw['hits']['hits'])) >= min_hits
+
+#----------Query Builders----------#
+# Shared by the sync routes in main.py and the async routes in async_routes.py, so both
+# variants always send exactly the same request body to elasticsearch.
+def filter_clauses(filters: dict) -> list:
+    '''
+    Compile structured filters into terms queries: values of one field are OR-ed, fields are AND-ed.
+
+    Args:
+        filters: dict of FILTER_FIELDS name -> list of accepted values (None or empty to skip)
+    Return:
+        list of Q objects for the bool filter clause
+    '''
+    return [Q('terms', **{FILTER_FIELDS[name]: values}) for name, values in sorted(filters.items()) if values]
+
+def matching_search(keyword: str, phase: str = 'fuzzy', filters: dict = None) -> Search:
+    '''
+    The query and filters of a keyword search, without paging. The stored embedding is left
+    out of the returned documents.
+    '''
+    s = Search().source(excludes = ['embedding'])
+    if keyword:
+        s = s.query(phase_query(keyword, phase))
+    for clause in filter_clauses(filters or {}):
+        s = s.filter(clause)
+    return s
+
+def keyword_search(keyword: str, phase: str = 'fuzzy', filters: dict = None, size: int = 10, from_: int = 0,
+                   exact_total: bool = False, pit_id: str = None, after: list = None) -> Search:
+    '''
+    Build the keyword search request.
+
+    Args:
+        keyword: the keyword used to put into a search query, None to only filter
+        phase: query phase, see phase_query
+        filters: structured filters, see filter_clauses
+        size: number of hits per page
+        from_: offset of the first hit, only used for shallow (offset) paging
+        exact_total: count every matching document instead of stopping at TOTAL_HITS_BOUND
+        pit_id: point-in-time to page through with search_after (deep paging)
+        after: sort values of the last hit of the previous page
+    Return:
+        unbound Search object, send .to_dict() through the sync or async client
+    Raise:
+        ValueError if an offset page reaches past MAX_RESULT_WINDOW
+    '''
+    s = matching_search(keyword, phase, filters)
+    if pit_id is None:
+        if from_ + size > MAX_RESULT_WINDOW:
+            raise ValueError(f'from + size must not exceed {MAX_RESULT_WINDOW}, use deep=true to page further')
+        s = s.extra(from_ = from_, size = size)
+    else:
+        # PIT searches are sorted on score with the shard doc as tie breaker, so every
+        # page is a constant-cost seek past the last sort key instead of a growing offset.
+        s = s.sort('_score', {'_shard_doc': 'asc'}).extra(size = size, pit = {'id': pit_id, 'keep_alive': PIT_KEEP_ALIVE})
+        if after is not None:
+            s = s.extra(search_after = after)
+    if after is not None:
+        total = False                           # already reported with the first page
+    elif exact_total:
+        total = True
+    else:
+        total = TOTAL_HITS_BOUND
+    return s.extra(track_total_hits = total)
+
+def export_search(keyword: str, phase: str, filters: dict, pit_id: str, after: list = None,
+                  size: int = 1000, keep_alive: str = PIT_KEEP_ALIVE) -> Search:
+    '''
+    Build one page of an export: every matching document in EXPORT_SORT order, read
+    through a point-in-time and continued with search_after.
+
+    Args:
+        keyword, phase, filters: the search, see keyword_search
+        pit_id: point-in-time of the export
+        after: sort values of the last exported document, None for the first page
+        size: documents per page
+        keep_alive: how long the point-in-time is kept open after this page
+    Return:
+        unbound Search object
+    '''
+    s = matching_search(keyword, phase, filters).sort(*EXPORT_SORT)
+    s = s.extra(size = size, pit = {'id': pit_id, 'keep_alive': keep_alive}, track_total_hits = False)
+    if after is not None:
+        s = s.extra(search_after = after)
+    return s
+
+#----------Facets----------#
+def check_facets(facets: list) -> list:
+    '''
+    Validate and normalize requested facet names.
+
+    Return:
+        sorted list of unique facet names (empty when none were requested)
+    Raise:
+        ValueError for a name that is not one of FILTER_FIELDS
+    '''
+    unknown = set(facets or []) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f'Unknown facets: {sorted(unknown)}, expected any of {sorted(FILTER_FIELDS)}')
+    return sorted(set(facets or []))
+
+def add_facets(s: Search, facets: list, facet_size: int = FACET_SIZE) -> Search:
+    '''
+    Attach one terms aggregation per facet to a search, so counts come back in the same request.
+    '''
+    s = s._clone()
+    for name in facets:
+        s.aggs.bucket(name, 'terms', field = FILTER_FIELDS[name], size = facet_size)
+    return s
+
+def facet_response(raw: dict) -> dict:
+    '''
+    Facet counts of a raw response: facet name -> list of {"value", "count"} buckets.
+    '''
+    return {name: [{'value': bucket['key'], 'count': bucket['doc_count']} for bucket in agg['buckets']]
+            for name, agg in raw.get('aggregations', {}).items()}
+
+#----------Response Formatting----------#
+def page_response(raw: dict, size: int, from_: int = 0, phase: str = 'fuzzy', query: str = None) -> dict:
+    '''
+    Turn a raw elasticsearch search response into the search-api page.
+
+    Args:
+        raw: response body returned by es.search
+        size: requested page size
+        from_: requested offset (shallow paging only)
+        phase: query phase that produced the response
+        query: query_hash of the search, stored in the cursor
+    Return:
+        dict with the ranked hits, the total (relation "gte" when it is a lower bound),
+        the shards searched, the phase that answered, and for deep paging the cursor of the
+        next page (None once exhausted)
+    '''
+    hits = raw['hits']['hits']
+    page = {'hits': hits, 'total': raw['hits'].get('total'), 'size': size, 'from': from_, 'cursor': None,
+            'shards': raw['_shards'], 'phase': phase}
+    if 'pit_id' in raw:
+        page['from'] = None
+        if len(hits) == size:
+            page['cursor'] = encode_cursor(raw['pit_id'], hits[-1]['sort'], phase, query)
+    return page
+
+def hit_list(hits: list) -> list:
+    '''
+    Hits of a search response, in the list shape the search route answers with by default:
+    what elasticsearch_dsl Hit objects encode to, {"_d_": source, "meta": {"_d_": metadata}}.
+    Built from plain dicts, since encoding Hit objects costs more than the rest of a request.
+
+    Args:
+        hits: hits of the search response body
+    Return:
+        list of hits, with order associated with ranking score
+    '''
+    converted = []
+    for hit in hits:
+        meta = {key.lstrip('_'): value for key, value in hit.items() if key not in ('_source', '_fields')}
+        if 'type' in meta:
+            meta['doc_type'] = meta.pop('type')
+        converted.append({'_d_': dict(hit.get('_source', {}), **hit.get('fields', {})), 'meta': {'_d_': meta}})
+    return converted
+
+def empty_page(size: int, from_: int = 0) -> dict:
+    '''
+    The page returned without calling elasticsearch when no target index exists.
+    '''
+    return {'hits': [], 'total': {'value': 0, 'relation': 'eq'}, 'size': size, 'from': from_, 'cursor': None,
+            'shards': {'total': 0, 'successful': 0, 'skipped': 0, 'failed': 0}, 'phase': None, 'facets': None}
@@ -0,0 +1,204 @@
+import os
+import time
+
+from elasticsearch import exceptions
+from pydantic import ValidationError
+
+from embeddings import EMBED_FIELDS
+from models import DocumentUpdate
+from vectors import vector_store
+
+#----------Update Settings----------#
+# Updates changing an embedded field read the document first, to embed its new text, and are
+# then guarded by the seq_no read. When the caller sent no guard of its own, a conflict with
+# a concurrent write just means reading again, up to UPDATE_RETRIES times.
+UPDATE_RETRIES   = int(os.getenv('UPDATE_RETRIES', 3))
+MAX_UPDATE_DOCS  = int(os.getenv('MAX_UPDATE_DOCS', 1000))     # documents accepted per bulk update
+
+#----------Partial Updates----------#
+def check_update(changes: dict, if_seq_no: int = None, if_primary_term: int = None):
+    '''
+    Validate a partial update.
+
+    Raise:
+        ValueError when no field changes, or only one of if_seq_no / if_primary_term is given
+    '''
+    if not changes:
+        raise ValueError('No field to update')
+    if (if_seq_no is None) != (if_primary_term is None):
+        raise ValueError('if_seq_no and if_primary_term must be given together')
+
+def needs_source(changes: dict) -> bool:
+    '''
+    True when the update changes a field the embedding covers.
+    '''
+    return any(field in changes for field in EMBED_FIELDS)
+
+def guard(if_seq_no: int = None, if_primary_term: int = None, current: dict = None) -> dict:
+    '''
+    The concurrency parameters of an update: the caller's seq_no guard, else the one of the
+    document version read to embed it, else let elasticsearch retry conflicting updates.
+    '''
+    if if_seq_no is not None:
+        return {'if_seq_no': if_seq_no, 'if_primary_term': if_primary_term}
+    if current is not None:
+        return {'if_seq_no': current['_seq_no'], 'if_primary_term': current['_primary_term']}
+    return {'retry_on_conflict': UPDATE_RETRIES}
+
+def updated_source(changes: dict, current: dict) -> dict:
+    '''
+    The document read to embed it, with the update applied.
+    '''
+    return dict(current['_source'], **changes)
+
+def update_body(changes: dict, embedding: dict = None) -> dict:
+    '''
+    The partial update request body, carrying the new embedding of a document read first.
+    '''
+    doc = dict(changes)
+    if embedding is not None:
+        doc['embedding'] = embedding
+    return {'doc': doc}
+
+#----------Bulk Updates----------#
+class _Item:
+    def __init__(self, update: DocumentUpdate):
+        self.id = update.id
+        self.changes = update.doc.dict(exclude_unset = True, exclude_none = True)
+        self.if_seq_no = update.if_seq_no
+        self.if_primary_term = update.if_primary_term
+        self.current = None
+        self.embedding = None
+        self.attempts = 0
+
+class UpdateBatch:
+    '''
+    Partial updates of many documents of one index in bulk requests, e.g. reassigning the
+    owner of a set of documents.
+
+    Each round reads (mget) the documents whose embedded fields change and embeds their new
+    text, then sends one bulk request with an update action per document. Items guarded by the caller's if_seq_no /
+    if_primary_term fail with 409 on a conflict; the others go into another round, up to
+    UPDATE_RETRIES. An item that fails validation or in elasticsearch only fails its own
+    result entry.
+
+    The routes send every mget body yielded by rounds() (None when no document has to be read)
+    and pass the response to feed_sources(), embed the sources() and pass the embedding fields
+    to feed_embeddings(), then send bulk_body() with bulk and pass the response to feed(), or
+    an exception of either request to fail().
+    '''
+    def __init__(self, index: str, updates: list):
+        self._start = time.monotonic()
+        self.index = index
+        self.results = [None] * len(updates)
+        self._items = {}
+        self._round = []
+        for i, raw in enumerate(updates):
+            doc_id = raw.get('id') if isinstance(raw, dict) else None
+            try:
+                item = _Item(DocumentUpdate.parse_obj(raw))
+                check_update(item.changes, item.if_seq_no, item.if_primary_term)
+            except ValidationError as e:
+                errors = [{k: v for k, v in error.items() if k != 'ctx'} for error in e.errors()]
+                self.results[i] = {'_id': doc_id, 'status': 400, 'error': errors}
+                continue
+            except ValueError as e:
+                self.results[i] = {'_id': doc_id, 'status': 400, 'error': str(e)}
+                continue
+            self._items[i] = item
+
+    def _finish(self, i: int, result: dict):
+        self.results[i] = result
+        del self._items[i]
+
+    def rounds(self):
+        '''
+        Yield the mget body of each round, None when no document has to be read first.
+        '''
+        while self._items:
+            self._round = list(self._items)
+            fetch = [self._items[i].id for i in self._round if needs_source(self._items[i].changes)]
+            yield {'docs': [{'_index': self.index, '_id': doc_id} for doc_id in fetch]} if fetch else None
+
+    def feed_sources(self, resp: dict):
+        '''
+        Consume the mget response of the current round.
+        '''
+        docs = {doc['_id']: doc for doc in resp['docs']}
+        for i in list(self._round):
+            item = self._items[i]
+            doc = docs.get(item.id)
+            if doc is None:
+                continue
+            if 'error' in doc or not doc.get('found'):
+                self._round.remove(i)
+                self._finish(i, {'_id': item.id, 'status': 404, 'error': doc.get('error') or 'document missing'})
+            else:
+                item.current = doc
+
+    def _read(self) -> list:
+        return [self._items[i] for i in self._round if self._items[i].current is not None]
+
+    def sources(self) -> list:
+        '''
+        The documents of the current round read to be embedded, with their update applied.
+        '''
+        return [updated_source(item.changes, item.current) for item in self._read()]
+
+    def feed_embeddings(self, embeddings: list):
+        '''
+        Consume the embedding fields of sources(), in the same order.
+        '''
+        for item, embedding in zip(self._read(), embeddings):
+            item.embedding = embedding
+
+    def bulk_body(self) -> list:
+        '''
+        The bulk request of the current round, empty when every item already failed.
+        '''
+        body = []
+        for i in self._round:
+            item = self._items[i]
+            action = dict(guard(item.if_seq_no, item.if_primary_term, item.current), _index = self.index, _id = item.id)
+            body.append({'update': action})
+            body.append(update_body(item.changes, item.embedding))
+        return body
+
+    def feed(self, resp: dict):
+        '''
+        Consume the bulk response of the current round.
+        '''
+        for i, result in zip(list(self._round), resp['items']):
+            item = self._items[i]
+            result = result['update']
+            item.attempts += 1
+            retry = result['status'] == 409 and item.if_seq_no is None and item.attempts < UPDATE_RETRIES
+            if retry:
+                item.current = item.embedding = None
+                continue
+            entry = {'_id': item.id, 'status': result['status']}
+            if 'error' in result:
+                entry['error'] = result['error']
+            else:
+                entry.update(result = result['result'], _seq_no = result.get('_seq_no'), _primary_term = result.get('_primary_term'))
+                if item.embedding is not None:
+                    vector_store.upsert(self.index, item.id, item.embedding)
+            self._finish(i, entry)
+
+    def fail(self, e: exceptions.TransportError):
+        '''
+        Fail every item of the current round after the mget or bulk request itself failed.
+        '''
+        status = e.status_code if isinstance(e.status_code, int) else 503
+        for i in self._round:
+            if i in self._items:
+                self._finish(i, {'_id': self._items[i].id, 'status': status, 'error': str(e)})
+
+    def response(self) -> dict:
+        '''
+        The batch response: one result per update, in request order.
+        '''
+        return {'took': int((time.monotonic() - self._start) * 1000),
+                'items': len(self.results),
+                'errors': sum(1 for result in self.results if 'error' in result),
+                'results': self.results}
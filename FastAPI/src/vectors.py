@@ -0,0 +1,452 @@
+import asyncio
+import os
+import threading
+import time
+from fnmatch import fnmatchcase
+
+import numpy as np
+from elasticsearch_dsl import Search
+
+from coalesce import single_flight
+from embeddings import embedder, doc_text, EMBED_FIELDS
+from es_client import ES_SEARCH_TIMEOUT
+from search_query import keyword_search, filter_clauses, enough_hits, empty_page, PIT_KEEP_ALIVE
+
+#----------Vector Search Settings----------#
+# Documents carry their embedding in the stored "embedding" field (not indexed by elasticsearch).
+# Each index's vectors are loaded once into an in-process matrix and kept current by the write
+# routes; documents written behind the API's back (the Mining job) show up after VECTOR_REFRESH.
+VECTOR_CANDIDATES = int(os.getenv('VECTOR_CANDIDATES', 200))   # nearest neighbours ranked per search
+VECTOR_MAX_CANDIDATES = int(os.getenv('VECTOR_MAX_CANDIDATES', 10000))  # limit when filters drop most of them
+VECTOR_MIN_SCORE  = float(os.getenv('VECTOR_MIN_SCORE', 0.1))   # cosine similarity below which a document is no match
+VECTOR_REFRESH    = float(os.getenv('VECTOR_REFRESH', 300))     # seconds before an index's vectors are reloaded
+VECTOR_IVF_MIN    = int(os.getenv('VECTOR_IVF_MIN', 20000))     # vectors before exact search switches to IVF
+VECTOR_NPROBE     = int(os.getenv('VECTOR_NPROBE', 8))          # IVF lists scanned per query
+VECTOR_LOAD_PAGE  = int(os.getenv('VECTOR_LOAD_PAGE', 1000))    # documents read per page while loading
+RRF_K             = int(os.getenv('RRF_K', 60))                 # rank constant of reciprocal rank fusion
+_LOAD_FIELDS = list(EMBED_FIELDS) + ['embedding']
+
+#----------Vector Index----------#
+class VectorIndex:
+    '''
+    The unit-length vectors of one elasticsearch index, so cosine similarity is a dot product.
+
+    Below VECTOR_IVF_MIN vectors a query is scored against every row with one matrix product,
+    which is exact. Larger indices also keep an IVF (inverted file) partition: rows are
+    assigned to the nearest of about sqrt(n) k-means centroids and a query only scores the rows
+    of its VECTOR_NPROBE nearest lists, trading a little recall for a much smaller product. The
+    partition is retrained whenever the number of vectors doubled or halved since training.
+
+    Searches run on a snapshot(), outside the lock of the VectorStore. A snapshot shares the
+    arrays of the index and the next write copies them first, so taking one costs nothing
+    and writes never show through a search in progress.
+    '''
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._vectors = np.zeros((64, dim), dtype = np.float32)
+        self._keys = []                 # row -> document id
+        self._rows = {}                 # document id -> row
+        self._centroids = None          # IVF centroids, None while searching exactly
+        self._lists = np.zeros(64, dtype = np.int32)    # row -> IVF list
+        self._trained = 0
+        self._shared = False            # a snapshot reads the arrays, copy them before writing
+        self.version = 0                # writes so far
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _own(self):
+        if self._shared:
+            self._vectors, self._lists, self._keys = self._vectors.copy(), self._lists.copy(), list(self._keys)
+            self._shared = False
+        self.version += 1
+
+    def upsert(self, doc_id: str, vector):
+        self._own()
+        row = self._rows.get(doc_id)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._vectors):
+                self._vectors = np.concatenate([self._vectors, np.zeros_like(self._vectors)])
+                self._lists = np.concatenate([self._lists, np.zeros_like(self._lists)])
+            self._keys.append(doc_id)
+            self._rows[doc_id] = row
+        self._vectors[row] = vector
+        if self._centroids is not None:
+            self._lists[row] = int(np.argmax(self._centroids @ self._vectors[row]))
+
+    def remove(self, doc_id: str):
+        '''
+        Drop a document, moving the last row into its place.
+        '''
+        if doc_id not in self._rows:
+            return
+        self._own()
+        row = self._rows.pop(doc_id)
+        last = len(self._keys) - 1
+        if row != last:
+            self._vectors[row], self._lists[row] = self._vectors[last], self._lists[last]
+            self._keys[row] = self._keys[last]
+            self._rows[self._keys[row]] = row
+        self._keys.pop()
+
+    def train(self, iterations: int = 10, seed: int = 0):
+        '''
+        Fit the IVF centroids with k-means on (a sample of) the current vectors, or go back
+        to exact search below VECTOR_IVF_MIN vectors.
+        '''
+        n = len(self._keys)
+        self._trained = n
+        if n < VECTOR_IVF_MIN:
+            self._centroids = None
+            return
+        vectors = self._vectors[:n]
+        rng = np.random.default_rng(seed)
+        k = int(np.sqrt(n))
+        sample = vectors[rng.choice(n, min(n, 64 * k), replace = False)]
+        centroids = sample[rng.choice(len(sample), k, replace = False)]
+        for _ in range(iterations):
+            assigned = np.argmax(sample @ centroids.T, axis = 1)
+            for j in range(k):
+                members = sample[assigned == j]
+                if len(members):
+                    centroids[j] = members.sum(axis = 0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis = 1, keepdims = True), 1e-12)
+        lists = np.zeros_like(self._lists)
+        for start in range(0, n, 65536):
+            stop = min(start + 65536, n)
+            lists[start:stop] = np.argmax(vectors[start:stop] @ centroids.T, axis = 1)
+        self._centroids, self._lists = centroids, lists
+
+    def stale(self) -> bool:
+        '''
+        Whether the IVF partition no longer fits the number of vectors.
+        '''
+        n = len(self._keys)
+        return n >= 2 * self._trained or n < self._trained // 2 or (self._centroids is None) != (n < VECTOR_IVF_MIN)
+
+    def snapshot(self) -> 'VectorIndex':
+        '''
+        A read-only view of the index as it is now, searchable while the index is written.
+        '''
+        view = object.__new__(VectorIndex)
+        view.__dict__.update(self.__dict__)
+        self._shared = True
+        return view
+
+    def adopt(self, view: 'VectorIndex'):
+        '''
+        Keep the partition a snapshot trained while it was searched, unless the index was
+        written since.
+        '''
+        if view.version == self.version and (view._trained != self._trained or view._centroids is not self._centroids):
+            self._centroids, self._lists, self._trained = view._centroids, view._lists, view._trained
+
+    def search(self, query: np.ndarray, k: int) -> list:
+        '''
+        The k most similar documents.
+
+        Return:
+            list of (document id, cosine similarity), most similar first
+        '''
+        n = len(self._keys)
+        if self.stale():
+            self.train()
+        if self._centroids is None:
+            rows = None
+            scores = self._vectors[:n] @ query
+        else:
+            probe = np.argpartition(-(self._centroids @ query), min(VECTOR_NPROBE, len(self._centroids)) - 1)[:VECTOR_NPROBE]
+            rows = np.flatnonzero(np.isin(self._lists[:n], probe))
+            scores = self._vectors[rows] @ query
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind = 'stable')]
+        return [(self._keys[i if rows is None else rows[i]], float(scores[i])) for i in top]
+
+#----------Vector Store----------#
+def _vector(source: dict):
+    '''
+    The stored vector of a document when it was embedded by the current model, else None.
+    '''
+    embedding = source.get('embedding')
+    if isinstance(embedding, dict) and embedding.get('model') == embedder.name:
+        return embedding.get('vector')
+    return None
+
+def _load_search(pit_id: str, after: list = None) -> dict:
+    s = Search().source(_LOAD_FIELDS).sort('_shard_doc')
+    s = s.extra(size = VECTOR_LOAD_PAGE, pit = {'id': pit_id, 'keep_alive': PIT_KEEP_ALIVE}, track_total_hits = False)
+    if after is not None:
+        s = s.extra(search_after = after)
+    return s.to_dict()
+
+class VectorStore:
+    '''
+    The VectorIndex of every index searched semantically, loaded on first use. Documents
+    without a vector of the current embedder (written by the Mining job, or embedded by an
+    earlier model) are embedded while loading.
+    '''
+    def __init__(self):
+        self._indices = {}          # index name -> VectorIndex
+        self._lock = threading.Lock()
+
+    def _fresh(self, index: str):
+        with self._lock:
+            vectors = self._indices.get(index)
+        if vectors is not None and time.monotonic() - vectors.loaded_at < VECTOR_REFRESH:
+            return vectors
+        return None
+
+    def _fill(self, index: str, pages: list) -> VectorIndex:
+        vectors = VectorIndex(embedder.dim)
+        missing = []
+        for hits in pages:
+            for hit in hits:
+                vector = _vector(hit['_source'])
+                if vector is None:
+                    missing.append(hit)
+                else:
+                    vectors.upsert(hit['_id'], vector)
+        for start in range(0, len(missing), 256):
+            batch = missing[start:start + 256]
+            for hit, vector in zip(batch, embedder.embed([doc_text(hit['_source']) for hit in batch])):
+                vectors.upsert(hit['_id'], vector)
+        vectors.train()
+        with self._lock:
+            self._indices[index] = vectors
+        return vectors
+
+    def _load(self, client, index: str) -> VectorIndex:
+        pit_id = client.open_point_in_time(index = index, keep_alive = PIT_KEEP_ALIVE)['id']
+        pages, after = [], None
+        try:
+            while True:
+                raw = client.search(body = _load_search(pit_id, after), request_timeout = ES_SEARCH_TIMEOUT)
+                pit_id, hits = raw['pit_id'], raw['hits']['hits']
+                pages.append(hits)
+                if len(hits) < VECTOR_LOAD_PAGE:
+                    break
+                after = hits[-1]['sort']
+        finally:
+            client.close_point_in_time(body = {'id': pit_id})
+        return self._fill(index, pages)
+
+    async def _aload(self, client, index: str) -> VectorIndex:
+        pit_id = (await client.open_point_in_time(index = index, keep_alive = PIT_KEEP_ALIVE))['id']
+        pages, after = [], None
+        try:
+            while True:
+                raw = await client.search(body = _load_search(pit_id, after), request_timeout = ES_SEARCH_TIMEOUT)
+                pit_id, hits = raw['pit_id'], raw['hits']['hits']
+                pages.append(hits)
+                if len(hits) < VECTOR_LOAD_PAGE:
+                    break
+                after = hits[-1]['sort']
+        finally:
+            await client.close_point_in_time(body = {'id': pit_id})
+        return await asyncio.to_thread(self._fill, index, pages)
+
+    def get(self, client, index: str) -> VectorIndex:
+        '''
+        The vectors of an index, (re)loaded with the blocking client when missing or stale.
+        Concurrent loads of one index are coalesced.
+        '''
+        return self._fresh(index) or single_flight.do(('vectors', index), lambda: self._load(client, index))
+
+    async def aget(self, client, index: str) -> VectorIndex:
+        '''
+        get() with the asyncio client.
+        '''
+        return self._fresh(index) or await single_flight.ado(('vectors', index), lambda: self._aload(client, index))
+
+    def upsert(self, index: str, doc_id: str, embedding: dict):
+        '''
+        Record the vector of a document just written, when its index is loaded.
+        '''
+        with self._lock:
+            vectors = self._indices.get(index)
+            if vectors is not None:
+                vectors.upsert(doc_id, embedding['vector'])
+
+    def remove(self, index: str, doc_id: str):
+        with self._lock:
+            vectors = self._indices.get(index)
+            if vectors is not None:
+                vectors.remove(doc_id)
+
+    def drop(self, index: str):
+        '''
+        Forget the vectors of a deleted index (a name or a pattern).
+        '''
+        with self._lock:
+            for name in [name for name in self._indices if fnmatchcase(name, index)]:
+                del self._indices[name]
+
+    def nearest(self, loaded: list, query: np.ndarray, k: int) -> list:
+        '''
+        The k nearest documents over several loaded indices, at least VECTOR_MIN_SCORE similar.
+        The lock is only held to take snapshots of the indices, which are searched (and their
+        partition retrained when stale) without it.
+
+        Args:
+            loaded: list of (index name, VectorIndex)
+        Return:
+            list of ((index, document id), similarity), most similar first
+        '''
+        with self._lock:
+            views = [(index, vectors, vectors.snapshot()) for index, vectors in loaded]
+        found = []
+        for index, vectors, view in views:
+            stale = view.stale()
+            found += [((index, doc_id), score) for doc_id, score in view.search(query, k) if score >= VECTOR_MIN_SCORE]
+            if stale:
+                with self._lock:
+                    vectors.adopt(view)
+        return sorted(found, key = lambda item: -item[1])[:k]
+
+vector_store = VectorStore()
+
+#----------Semantic and Hybrid Search----------#
+def check_mode(mode: str, keyword: str, deep: bool, facets: list, from_: int, size: int):
+    '''
+    Validate the options of a semantic or hybrid search.
+
+    Raise:
+        ValueError when the search cannot run in that mode
+    '''
+    if mode == 'keyword':
+        return
+    if not keyword:
+        raise ValueError(f'mode={mode} needs a keyword')
+    if deep:
+        raise ValueError(f'mode={mode} pages with from and size, not deep paging')
+    if facets:
+        raise ValueError(f'facets are not computed with mode={mode}')
+    if from_ + size > VECTOR_CANDIDATES:
+        raise ValueError(f'from + size must not exceed {VECTOR_CANDIDATES} with mode={mode}')
+
+def rrf(*rankings: list, k: int = RRF_K) -> dict:
+    '''
+    Reciprocal rank fusion: each ranking adds 1 / (k + rank) to the score of its keys.
+    '''
+    fused = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return fused
+
+def fetch_search(keys: list, filters: dict) -> dict:
+    '''
+    Fetch candidate documents by id, dropping those the structured filters exclude.
+    '''
+    s = Search().filter('ids', values = sorted({doc_id for _, doc_id in keys}))
+    for clause in filter_clauses(filters):
+        s = s.filter(clause)
+    return s.source(excludes = ['embedding']).extra(size = len(keys), track_total_hits = False).to_dict()
+
+def ranked_page(raw: dict, scores: dict, size: int, from_: int, mode: str, complete: bool) -> dict:
+    '''
+    The page of a semantic or hybrid search: the fetched candidates ordered by score, in the
+    shape of search_query.page_response. Totals are lower bounds unless every document was ranked.
+    '''
+    hits = [dict(hit, _score = scores[(hit['_index'], hit['_id'])])
+            for hit in raw['hits']['hits'] if (hit['_index'], hit['_id']) in scores]
+    hits.sort(key = lambda hit: -hit['_score'])
+    return {'hits': hits[from_:from_ + size], 'total': {'value': len(hits), 'relation': 'eq' if complete else 'gte'},
+            'size': size, 'from': from_, 'cursor': None, 'shards': raw['_shards'], 'phase': mode}
+
+def _bm25_body(keyword: str, phase: str, filters: dict) -> dict:
+    return keyword_search(keyword, phase, filters, VECTOR_CANDIDATES).source(False).to_dict()
+
+def _fuse(nearest: list, k: int, raw: dict = None) -> tuple:
+    '''
+    Scores of the candidates: their similarity, or their RRF score when a keyword ranking
+    (the raw BM25 response of a hybrid search) is fused in.
+
+    Args:
+        nearest: the k nearest documents, see VectorStore.nearest
+    Return:
+        (dict of (index, document id) -> score, True when no candidate was cut off)
+    '''
+    complete = len(nearest) < k
+    if raw is None:
+        return dict(nearest), complete
+    ranking = [(hit['_index'], hit['_id']) for hit in raw['hits']['hits']]
+    return rrf([key for key, _ in nearest], ranking), complete and len(ranking) < VECTOR_CANDIDATES
+
+def _widen(raw: dict, k: int, complete: bool, wanted: int) -> int:
+    '''
+    The number of neighbours to rank again when the structured filters left fewer than
+    `wanted` of the fetched candidates, or None when the page can be answered.
+    '''
+    if complete or len(raw['hits']['hits']) >= wanted or k >= VECTOR_MAX_CANDIDATES:
+        return None
+    return min(2 * k, VECTOR_MAX_CANDIDATES)
+
+def vector_search(client, indices: list, keyword: str, mode: str, filters: dict, phases: list,
+                  min_hits: int, size: int, from_: int) -> dict:
+    '''
+    Answer a semantic search by nearest neighbours of the keyword's embedding, or a hybrid one
+    by fusing those with the keyword (BM25) ranking. Candidates are fetched back from
+    elasticsearch by id, which applies the structured filters after the neighbour search;
+    when they leave less than the page, twice as many neighbours are ranked and fetched, up
+    to VECTOR_MAX_CANDIDATES.
+
+    Args:
+        client: Elasticsearch client
+        indices: concrete indices to search
+        keyword: the searched text
+        mode: "semantic" or "hybrid"
+        filters, phases, min_hits: the keyword search, see /search/document/
+        size, from_: the page
+    Return:
+        page of documents, see ranked_page
+    '''
+    loaded = [(index, vector_store.get(client, index)) for index in indices]
+    query = embedder.embed([keyword])[0]
+    bm25 = None
+    if mode == 'hybrid':
+        for phase in phases:
+            bm25 = client.search(index = ','.join(indices), body = _bm25_body(keyword, phase, filters),
+                                 ignore_unavailable = True, request_timeout = ES_SEARCH_TIMEOUT)
+            if enough_hits(bm25, min_hits):
+                break
+    k = VECTOR_CANDIDATES
+    while k:
+        scores, complete = _fuse(vector_store.nearest(loaded, query, k), k, bm25)
+        if not scores:
+            return dict(empty_page(size, from_), phase = mode)
+        raw = client.search(index = ','.join(indices), body = fetch_search(list(scores), filters),
+                            ignore_unavailable = True, request_timeout = ES_SEARCH_TIMEOUT)
+        k = _widen(raw, k, complete, from_ + size)
+    return ranked_page(raw, scores, size, from_, mode, complete)
+
+async def avector_search(client, indices: list, keyword: str, mode: str, filters: dict, phases: list,
+                         min_hits: int, size: int, from_: int) -> dict:
+    '''
+    vector_search() with the asyncio client. Embedding the keyword and ranking the neighbours
+    run in a worker thread, off the event loop.
+    '''
+    loaded = [(index, await vector_store.aget(client, index)) for index in indices]
+    query = (await asyncio.to_thread(embedder.embed, [keyword]))[0]
+    bm25 = None
+    if mode == 'hybrid':
+        for phase in phases:
+            bm25 = await client.search(index = ','.join(indices), body = _bm25_body(keyword, phase, filters),
+                                       ignore_unavailable = True, request_timeout = ES_SEARCH_TIMEOUT)
+            if enough_hits(bm25, min_hits):
+                break
+    k = VECTOR_CANDIDATES
+    while k:
+        nearest = await asyncio.to_thread(vector_store.nearest, loaded, query, k)
+        scores, complete = _fuse(nearest, k, bm25)
+        if not scores:
+            return dict(empty_page(size, from_), phase = mode)
+        raw = await client.search(index = ','.join(indices), body = fetch_search(list(scores), filters),
+                                  ignore_unavailable = True, request_timeout = ES_SEARCH_TIMEOUT)
+        k = _widen(raw, k, complete, from_ + size)
+    return ranked_page(raw, scores, size, from_, mode, complete)
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+# clients built by the tests must not look for the cluster's CA certificate
+os.environ.setdefault('ES_CA_CERTS', '')
+
+import standin
+from handlers import run, arun
+
+@pytest.fixture(scope = 'session')
+def app():
+    '''
+    The search-api with its clients backed by the stand-in elasticsearch of the benchmarks.
+    '''
+    standin.StandInConnection.latency = 0
+    standin.AsyncStandInConnection.latency = 0
+    return standin.import_app()
+
+@pytest.fixture
+def request_app(app):
+    '''
+    Return:
+        function sending one request to the app and returning (status code, decoded JSON body)
+    '''
+    def send(method: str, path: str, query: str = '', body = None):
+        chunks = () if body is None else (json.dumps(body).encode(),)
+        status, data = asyncio.run(standin.asgi_request(app, method, path, query, chunks))
+        return status, json.loads(data) if data else None
+    return send
+
+#----------Fake Clients----------#
+class Client:
+    '''
+    Records the calls it gets and answers them from `replies`, raising the exceptions.
+    '''
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = []
+        self.indices = self
+        self.tasks = self
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            self.calls.append((name, kwargs))
+            reply = self.replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+        return method
+
+class AsyncClient(Client):
+    def __getattr__(self, name):
+        method = super().__getattr__(name)
+
+        async def amethod(*args, **kwargs):
+            return method(*args, **kwargs)
+        return amethod
+
+def drive(handler_factory, *replies):
+    '''
+    Run the handler with the blocking and with the asyncio client, which must agree.
+    '''
+    result = run(handler_factory(), Client(*replies))
+    assert asyncio.run(arun(handler_factory(), AsyncClient(*replies))) == result
+    return result
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.requests import Request
+
+import admission
+from admission import AdmittedRoute, Budget, Overloaded, route_budget
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_slots_within_the_limit():
+    async def main():
+        budget = Budget('read', 2, queue = 4, client_queue = 4, wait = 1)
+        await budget.acquire('a')
+        await budget.acquire('b')
+        assert (budget.active, budget.waiting) == (2, 0)
+        budget.release()
+        budget.release()
+        assert budget.active == 0
+    run(main())
+
+def test_freed_slots_go_round_robin_across_clients():
+    async def main():
+        budget = Budget('read', 1, queue = 8, client_queue = 8, wait = 1)
+        await budget.acquire('a')
+        order = []
+
+        async def request(client: str, name: str):
+            await budget.acquire(client)
+            order.append(name)
+        tasks = []
+        for client, name in (('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1'), ('c', 'c1')):
+            tasks.append(asyncio.ensure_future(request(client, name)))
+            await settle()
+        assert budget.waiting == 5
+        for _ in tasks:
+            budget.release()
+            await settle()
+        await asyncio.gather(*tasks)
+        return order, budget.active
+    order, active = run(main())
+    assert order == ['a1', 'b1', 'c1', 'a2', 'a3']
+    assert active == 1
+
+def test_full_queues_are_shed():
+    async def main():
+        budget = Budget('write', 1, queue = 3, client_queue = 2, wait = 1)
+        await budget.acquire('a')
+        waiting = [asyncio.ensure_future(budget.acquire(client)) for client in ('a', 'a')]
+        await settle()
+        with pytest.raises(Overloaded) as client_full:
+            await budget.acquire('a')
+        waiting.append(asyncio.ensure_future(budget.acquire('b')))
+        await settle()
+        with pytest.raises(Overloaded) as queue_full:
+            await budget.acquire('c')
+        for _ in waiting:
+            budget.release()
+        await asyncio.gather(*waiting)
+        return client_full.value.reason, queue_full.value.reason
+    assert run(main()) == ('client_queue_full', 'queue_full')
+
+def test_wait_timeout_leaves_the_queue():
+    async def main():
+        budget = Budget('read', 1, queue = 4, client_queue = 4, wait = 0.01)
+        await budget.acquire('a')
+        with pytest.raises(Overloaded) as timeout:
+            await budget.acquire('b')
+        assert (budget.active, budget.waiting) == (1, 0)
+        budget.release()
+        assert budget.active == 0
+        return timeout.value.reason
+    assert run(main()) == 'wait_timeout'
+
+def test_cancelled_waiter_gives_its_turn_away():
+    async def main():
+        budget = Budget('read', 1, queue = 4, client_queue = 4, wait = 1)
+        await budget.acquire('a')
+        cancelled = asyncio.ensure_future(budget.acquire('b'))
+        served = asyncio.ensure_future(budget.acquire('c'))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        assert budget.waiting == 1
+        budget.release()
+        await served
+        assert budget.active == 1
+    run(main())
+
+def test_admit_answers_429_and_releases():
+    async def main():
+        budget = Budget('read', 1, queue = 0, client_queue = 1, wait = 1)
+        async with budget.admit('a'):
+            assert budget.active == 1
+            with pytest.raises(HTTPException) as shed:
+                async with budget.admit('b'):
+                    pass
+        assert budget.active == 0
+        return shed.value
+    shed = run(main())
+    assert shed.status_code == 429 and 'Retry-After' in shed.headers
+
+#----------Routes----------#
+def test_route_budgets():
+    assert route_budget('/api/v0/search/document/', {'GET'}) == 'read'
+    assert route_budget('/api/v0/search/batch', {'POST'}) == 'read'
+    assert route_budget('/api/v0/index/{index}/documents/bulk', {'PATCH'}) == 'write'
+    assert route_budget('/api/v0/async/search/export', {'GET'}) == 'export'
+    assert route_budget('/metrics', {'GET'}) is None
+
+def test_streamed_response_holds_its_slot_until_sent(monkeypatch):
+    budget = Budget('export', 1, queue = 0, client_queue = 1, wait = 1)
+    monkeypatch.setitem(admission.budgets, 'export', budget)
+    held = []
+
+    async def lines():
+        held.append(budget.active)
+        yield b'{}\n'
+
+    async def export():
+        return StreamingResponse(lines())
+    handler = AdmittedRoute('/search/export', export).get_route_handler()
+    scope = {'type': 'http', 'method': 'GET', 'path': '/search/export', 'headers': [], 'query_string': b'',
+             'client': ('127.0.0.1', 0)}
+
+    async def main():
+        response = await handler(Request(scope))
+        assert budget.active == 1
+        with pytest.raises(HTTPException) as shed:     # a second export is shed while the first streams
+            await handler(Request(scope))
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(1)
+
+        async def send(message):
+            sent.append(message['type'])
+        await response(scope, receive, send)
+        return shed.value.status_code, sent
+    assert run(main()) == (429, ['http.response.start', 'http.response.body', 'http.response.body'])
+    assert held == [1] and budget.active == 0
@@ -0,0 +1,86 @@
+import pytest
+
+from elasticsearch import exceptions
+
+import handlers
+from batch import SearchBatch
+from cache import ResultCache
+from conftest import Client
+
+PREFIXES = ['/api/v0', '/api/v0/async']
+
+def raw(total: int) -> dict:
+    hits = [{'_id': str(i), '_source': {}} for i in range(min(total, 10))]
+    return {'hits': {'hits': hits, 'total': {'value': total, 'relation': 'eq'}}, '_shards': {'total': 1}}
+
+def resolve(client, patterns: list) -> list:
+    return ['model']
+
+async def aresolve(client, patterns: list) -> list:
+    return ['model']
+
+@pytest.fixture(autouse = True)
+def caches(monkeypatch):
+    monkeypatch.setattr('batch.result_cache', ResultCache(maxsize = 0))
+    monkeypatch.setattr('batch.facet_cache', ResultCache(maxsize = 0))
+    monkeypatch.setitem(handlers.HELPERS, 'resolve', (resolve, aresolve))
+
+def msearch(*rounds) -> list:
+    return [{'responses': responses} for responses in rounds]
+
+#----------Batch Planning----------#
+def test_results_keep_request_order():
+    queries = [{'keyword': 'unet'}, {'keyword': 'tomography', 'size': 5}]
+    client = Client(*msearch([raw(5), raw(3)]))
+    resp = handlers.run(handlers.search_batch(queries), client)
+    assert (resp['items'], resp['errors']) == (2, 0)
+    assert [len(result['hits']) for result in resp['results']] == [5, 3]
+    assert [result['phase'] for result in resp['results']] == ['exact', 'exact']
+    body = client.calls[0][1]['body']
+    assert body[0] == {'index': 'model', 'ignore_unavailable': True}
+    assert body[3]['size'] == 5
+
+def test_only_fallbacks_take_a_second_round():
+    queries = [{'keyword': 'unet'}, {'keyword': 'tomograhpy'}, {'keyword': 'seg', 'match': 'fuzzy'}]
+    client = Client(*msearch([raw(5), raw(1), raw(0)], [raw(4)]))
+    resp = handlers.run(handlers.search_batch(queries), client)
+    assert [result['phase'] for result in resp['results']] == ['exact', 'fuzzy', 'fuzzy']
+    assert [result['total']['value'] for result in resp['results']] == [5, 4, 0]
+    assert len(client.calls) == 2 and len(client.calls[1][1]['body']) == 2
+
+def test_errors_only_fail_their_query():
+    queries = [{'keyword': 'unet', 'size': 0}, {'keyword': 'unet', 'deep': True, 'facets': ['name']},
+               {'keyword': 'x'}, {'keyword': 'y'}]
+    error = {'error': {'type': 'search_phase_execution_exception'}, 'status': 400}
+    resp = handlers.run(handlers.search_batch(queries), Client(*msearch([error, raw(3)])))
+    assert [result['status'] for result in resp['results']] == [400, 400, 400, 200]
+    assert 'Unknown facets' in resp['results'][1]['error']
+    assert resp['errors'] == 3
+
+def test_failed_msearch_fails_its_round():
+    queries = [{'keyword': 'unet'}, {'keyword': 'tomograhpy'}]
+    down = exceptions.ConnectionError('N/A', 'elasticsearch down', None)
+    resp = handlers.run(handlers.search_batch(queries), Client(*msearch([raw(5), raw(0)]), down))
+    assert [result['status'] for result in resp['results']] == [200, 503]
+
+def test_cached_pages_skip_msearch(monkeypatch):
+    monkeypatch.setattr('batch.result_cache', ResultCache(maxsize = 8))
+    client = Client(*msearch([raw(5)]))
+    first = handlers.run(handlers.search_batch([{'keyword': 'unet'}]), client)
+    second = handlers.run(handlers.search_batch([{'keyword': 'unet'}]), client)
+    assert len(client.calls) == 1 and second['results'] == first['results']
+
+def test_no_indices():
+    batch = SearchBatch([{'keyword': 'unet', 'index': 'missing'}])
+    for entry in batch.unresolved():
+        entry.indices = []
+    assert list(batch.rounds()) == []
+    assert batch.response()['results'][0]['hits'] == []
+
+#----------Route----------#
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_batch_route(request_app, prefix):
+    status, resp = request_app('POST', prefix + '/search/batch', body = [{'keyword': 'model'}, {'keyword': 'typo', 'size': 3}])
+    assert status == 200
+    assert [(len(result['hits']), result['phase']) for result in resp['results']] == [(10, 'exact'), (3, 'fuzzy')]
+    assert request_app('POST', prefix + '/search/batch', body = [{}] * 51)[0] == 400
@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import pytest
+from elasticsearch import exceptions
+
+from bulk import iter_lines, bulk_ingest
+from index_template import forget_index
+from standin import asgi_request
+
+#----------Helpers----------#
+async def _chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+def lines(data: bytes, size: int, max_line_bytes: int = 100) -> list:
+    async def collect():
+        return [line async for line in iter_lines(_chunks(data, size), max_line_bytes)]
+    return asyncio.run(collect())
+
+def document(i: int, **fields) -> dict:
+    doc = {'name': f'model {i}', 'version': '1', 'type': 'x', 'uri': 'u', 'application': [], 'reference': 'r',
+           'description': 'd', 'content_type': 'model', 'content_id': f'model-{i}', 'owner': 'o'}
+    return dict(doc, **fields)
+
+def ndjson(docs: list) -> bytes:
+    return b''.join(json.dumps(doc).encode() + b'\n' for doc in docs)
+
+class BulkClient:
+    '''
+    Answers bulk requests, failing the calls listed in `fail` (1-based), and records
+    the largest number of requests awaiting a response at once and the indices created.
+    '''
+    def __init__(self, fail = ()):
+        self.fail = fail
+        self.calls = []
+        self.in_flight = self.peak = 0
+        self.indices = self
+        self.created = []
+
+    async def create(self, index: str, body: dict):
+        self.created.append(index)
+
+    async def bulk(self, body: list):
+        self.calls.append(body)
+        call = len(self.calls)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        if call in self.fail:
+            raise exceptions.ConnectionError('N/A', 'elasticsearch down', None)
+        return {'errors': False, 'items': [{'index': {'_index': action['index']['_index'], '_id': action['index']['_id'],
+                                                      'status': 201, 'result': 'created'}} for action in body[::2]]}
+
+def ingest(client, data: bytes, **kwargs) -> dict:
+    return asyncio.run(bulk_ingest(client, _chunks(data, 7), **kwargs))
+
+#----------NDJSON Stream----------#
+@pytest.mark.parametrize('size', [1, 3, 64])
+def test_iter_lines_any_chunking(size):
+    assert lines(b'a\nbc\n\nd', size) == [(1, b'a'), (2, b'bc'), (3, b''), (4, b'd')]
+
+def test_iter_lines_drops_long_lines():
+    assert lines(b'short\n' + b'x' * 30 + b'\nnext\n', 4, max_line_bytes = 10) == [(1, b'short'), (2, None), (3, b'next')]
+
+#----------Bulk Requests----------#
+def test_bulk_batches():
+    client = BulkClient()
+    resp = ingest(client, ndjson([document(i) for i in range(25)]), batch_docs = 10, max_in_flight = 2)
+    assert [len(body) // 2 for body in client.calls] == [10, 10, 5]
+    assert client.peak <= 2
+    assert (resp['items'], resp['errors']) == (25, 0)
+    assert [result['line'] for result in resp['results']] == list(range(1, 26))
+    assert resp['results'][0] == {'line': 1, '_index': 'model', '_id': 'model-0', 'status': 201, 'result': 'created'}
+
+def test_bulk_index_parameter():
+    resp = ingest(BulkClient(), ndjson([document(0)]), index = 'registry')
+    assert resp['results'][0]['_index'] == 'registry'
+
+def test_bulk_reports_invalid_lines():
+    data = ndjson([document(0)]) + b'{"name": "no other field"}\nnot json\n\n' + ndjson([document(1)])
+    resp = ingest(BulkClient(), data)
+    assert [(result['line'], result['status']) for result in resp['results']] == [(1, 201), (2, 400), (3, 400), (5, 201)]
+    assert resp['errors'] == 2
+
+def test_bulk_failed_request_fails_its_batch_only():
+    resp = ingest(BulkClient(fail = (1,)), ndjson([document(i) for i in range(4)]), batch_docs = 2)
+    assert [result['status'] for result in resp['results']] == [503, 503, 201, 201]
+
+def test_bulk_creates_indices_from_the_template():
+    forget_index('*')
+    client = BulkClient()
+    ingest(client, ndjson([document(i, content_type = ct) for i, ct in enumerate(['model', 'app', 'model'])]), batch_docs = 2)
+    assert sorted(client.created) == ['app', 'model']
+
+def test_bulk_failed_index_creation_fails_its_batch():
+    forget_index('*')
+    client = BulkClient()
+
+    async def create(index: str, body: dict):
+        raise exceptions.ConnectionError('N/A', 'elasticsearch down', None)
+    client.create = create
+    resp = ingest(client, ndjson([document(i) for i in range(2)]))
+    assert [result['status'] for result in resp['results']] == [503, 503]
+    assert client.calls == []
+
+#----------Route----------#
+def test_bulk_route(app):
+    data = ndjson([document(i) for i in range(3)])
+    status, body = asyncio.run(asgi_request(app, 'POST', '/api/v0/index/documents/bulk', 'batch_size=2', [data[:50], data[50:]]))
+    assert status == 200
+    assert json.loads(body)['items'] == 3
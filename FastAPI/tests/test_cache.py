@@ -0,0 +1,168 @@
+import pytest
+
+import handlers
+from cache import ResultCache, cache_key, facet_key
+from conftest import Client
+from handlers import run
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+def test_cache_key_is_normalized():
+    assert cache_key(['b', 'a'], {'size': 10, 'query': {}}) == cache_key(['a', 'b'], {'query': {}, 'size': 10})
+    assert cache_key(['a'], {'size': 10}) != cache_key(['a'], {'size': 20})
+    assert cache_key(['a'], {}, 'exact') != cache_key(['a'], {}, 'fuzzy')
+
+def test_hit_and_miss(clock):
+    cache = ResultCache(maxsize = 4, ttl = 60, refresh_grace = 1, clock = clock)
+    assert cache.get('k') is None
+    assert cache.put('k', ['model'], {'hits': []}, clock()) == {'hits': []}
+    assert cache.get('k') == {'hits': []}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_lru_eviction(clock):
+    cache = ResultCache(maxsize = 2, ttl = 60, refresh_grace = 1, clock = clock)
+    cache.put('a', ['model'], 1, clock())
+    cache.put('b', ['model'], 2, clock())
+    cache.get('a')                          # b is now the least recently used
+    cache.put('c', ['model'], 3, clock())
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.evictions == 1
+
+def test_ttl_expiry(clock):
+    cache = ResultCache(maxsize = 4, ttl = 60, refresh_grace = 1, clock = clock)
+    cache.put('k', ['model'], 1, clock())
+    clock.now += 59
+    assert cache.get('k') == 1
+    clock.now += 1
+    assert cache.get('k') is None
+    assert cache.expirations == 1
+
+def test_disabled(clock):
+    cache = ResultCache(maxsize = 0, ttl = 60, refresh_grace = 1, clock = clock)
+    assert cache.put('k', ['model'], 1, clock()) == 1
+    assert cache.get('k') is None
+
+def test_invalidate_drops_overlapping_entries(clock):
+    cache = ResultCache(maxsize = 8, ttl = 60, refresh_grace = 1, clock = clock)
+    cache.put('model', ['model'], 1, clock())
+    cache.put('app', ['app'], 2, clock())
+    cache.put('both', ['app', 'model'], 3, clock())
+    cache.put('pattern', ['mod*'], 4, clock())
+    clock.now += 5
+    cache.invalidate('model')
+    assert [cache.get(key) for key in ('model', 'app', 'both', 'pattern')] == [None, 2, None, None]
+    assert cache.invalidations == 3
+
+def test_no_store_for_searches_racing_a_write(clock):
+    cache = ResultCache(maxsize = 8, ttl = 60, refresh_grace = 1.5, clock = clock)
+    started = clock()
+    clock.now += 1
+    cache.invalidate('model')
+    # started before the write became searchable: may hold stale hits
+    cache.put('k', ['model'], 1, started)
+    assert cache.get('k') is None
+    # other indices are unaffected
+    cache.put('other', ['app'], 2, started)
+    assert cache.get('other') == 2
+    # a search starting once the refresh grace passed is stored again
+    clock.now += 2
+    cache.put('k', ['model'], 1, clock())
+    assert cache.get('k') == 1
+
+def test_stats(clock):
+    cache = ResultCache(maxsize = 8, ttl = 60, refresh_grace = 1, clock = clock)
+    cache.put('k', ['model'], 1, clock())
+    cache.get('k')
+    cache.get('missing')
+    stats = cache.stats()
+    assert (stats['size'], stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 1, 0.5)
+
+#----------Search Handler----------#
+RAW = {'hits': {'hits': [], 'total': {'value': 0, 'relation': 'eq'}}, '_shards': {'total': 1}}
+FACETS = dict(RAW, aggregations = {'owner': {'buckets': [{'key': 'lbnl', 'doc_count': 4}]}})
+
+@pytest.fixture
+def facets(clock, monkeypatch):
+    facets = ResultCache(maxsize = 8, ttl = 60, refresh_grace = 1, clock = clock)
+    monkeypatch.setattr('cache.facet_cache', facets)
+    monkeypatch.setattr(handlers, 'facet_cache', facets)
+    return facets
+
+@pytest.fixture
+def cache(clock, facets, monkeypatch):
+    cache = ResultCache(maxsize = 8, ttl = 60, refresh_grace = 1, clock = clock)
+    monkeypatch.setattr('cache.result_cache', cache)
+    monkeypatch.setattr(handlers, 'result_cache', cache)
+    monkeypatch.setattr(handlers.time, 'monotonic', clock)
+    monkeypatch.setitem(handlers.HELPERS, 'resolve', (lambda client, patterns: ['model'], None))
+    return cache
+
+def search(client, keyword: str = 'model', **kwargs):
+    args = dict(index = None, content_type = None, owner = None, application = None, version = None, size = 10,
+                from_ = 0, exact_total = False, deep = False, cursor = None, match = 'fuzzy', min_hits = 1,
+                facets = None, facet_size = 10, mode = 'keyword', envelope = True, profile = False,
+                x_admin_token = None)
+    return run(handlers.search(keyword, **dict(args, **kwargs)), client)
+
+def test_search_pages_are_cached(cache):
+    client = Client(RAW)
+    assert search(client) == search(client)
+    assert len(client.calls) == 1
+    search(Client(RAW), size = 20)          # other paging, other entry
+    assert cache.stats()['size'] == 2
+
+def test_writes_invalidate_cached_pages(cache, clock):
+    search(Client(RAW))
+    clock.now += 5
+    run(handlers.index_doc('model', '1', {}), Client({'result': 'created'}))
+    client = Client(RAW, RAW)
+    search(client)
+    clock.now += 5
+    search(client)
+    # the first search after the write ran within the refresh grace and was not stored
+    assert len(client.calls) == 2
+
+def test_deep_pages_are_not_cached(cache):
+    client = Client({'id': 'pit'}, dict(RAW, pit_id = 'pit'), {})
+    search(client, deep = True)
+    assert [name for name, _ in client.calls] == ['open_point_in_time', 'search', 'close_point_in_time']
+    assert cache.stats()['size'] == 0
+
+#----------Facets----------#
+def test_facet_key_ignores_paging():
+    first = handlers.keyword_search('model', 'fuzzy', None, 10, 0)
+    later = handlers.keyword_search('model', 'fuzzy', None, 10, 40)
+    assert facet_key(['model'], first, ['fuzzy'], 1, ['owner'], 10) == facet_key(['model'], later, ['fuzzy'], 1, ['owner'], 10)
+    assert facet_key(['model'], first, ['fuzzy'], 1, ['owner'], 10) != facet_key(['model'], first, ['fuzzy'], 1, ['owner'], 5)
+
+def test_facets_are_requested_with_the_page(cache, facets):
+    client = Client(FACETS)
+    page = search(client, facets = ['owner'])
+    assert page['facets'] == {'owner': [{'value': 'lbnl', 'count': 4}]}
+    assert client.calls[0][1]['body']['aggs'] == {'owner': {'terms': {'field': 'owner.keyword', 'size': 10}}}
+    # the next page reuses the counts and does not aggregate again
+    client = Client(RAW)
+    assert search(client, from_ = 10, facets = ['owner'])['facets'] == page['facets']
+    assert 'aggs' not in client.calls[0][1]['body']
+
+def test_facets_of_a_cached_page(cache, facets):
+    search(Client(RAW))
+    client = Client(FACETS)
+    assert search(client, facets = ['owner'])['facets'] == {'owner': [{'value': 'lbnl', 'count': 4}]}
+    body = client.calls[0][1]['body']
+    assert body['size'] == 0 and 'aggs' in body     # counts only, the hits come from the cache
+
+def test_writes_invalidate_facets(cache, facets):
+    search(Client(FACETS), facets = ['owner'])
+    run(handlers.delete_doc('model', '1'), Client({'result': 'deleted'}))
+    assert facets.stats()['size'] == 0 and cache.stats()['size'] == 0
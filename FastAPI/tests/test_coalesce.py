@@ -0,0 +1,131 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import coalesce
+from coalesce import SingleFlight
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+def test_do_shares_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {'hits': []}
+    results = []
+    threads = [threading.Thread(target = lambda: results.append(flight.do('k', fn))) for _ in range(8)]
+    threads[0].start()
+    wait_until(lambda: flight.stats()['in_flight'] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    wait_until(lambda: flight.stats()['coalesced'] == 7)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{'hits': []}] * 8
+    assert flight.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 7}
+
+def test_do_keeps_nothing_once_done():
+    flight = SingleFlight()
+    assert flight.do('k', lambda: 1) == 1
+    assert flight.do('k', lambda: 2) == 2
+    assert flight.do('other', lambda: 3) == 3
+    assert flight.stats()['leaders'] == 3
+
+def test_do_shares_the_error():
+    flight = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError('es down')
+
+    def caller():
+        try:
+            flight.do('k', fn)
+        except RuntimeError as e:
+            errors.append(e)
+    threads = [threading.Thread(target = caller) for _ in range(3)]
+    threads[0].start()
+    wait_until(lambda: flight.stats()['in_flight'] == 1)
+    for thread in threads[1:]:
+        thread.start()
+    wait_until(lambda: flight.stats()['coalesced'] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3 and len({id(e) for e in errors}) == 1
+    assert flight.do('k', lambda: 'retried') == 'retried'
+
+def test_ado_shares_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'hits': []}
+
+    async def main():
+        return await asyncio.gather(*(flight.ado('k', fn) for _ in range(8)))
+    assert asyncio.run(main()) == [{'hits': []}] * 8
+    assert len(calls) == 1
+    assert flight.stats() == {'in_flight': 0, 'leaders': 1, 'coalesced': 7}
+
+def test_ado_cancelled_caller_does_not_cancel_the_others():
+    flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    async def main():
+        first = asyncio.ensure_future(flight.ado('k', fn))
+        second = asyncio.ensure_future(flight.ado('k', fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+    assert asyncio.run(main()) == 'done'
+
+class Client:
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+
+    def search(self, index: str, body: dict, **params):
+        self.calls += 1
+        self.release.wait(5)
+        return {'index': index, 'body': body}
+
+@pytest.mark.parametrize('enabled, calls', [(True, 1), (False, 4)])
+def test_search_switch(monkeypatch, enabled, calls):
+    monkeypatch.setattr(coalesce, 'SEARCH_COALESCE', enabled)
+    monkeypatch.setattr(coalesce, 'single_flight', SingleFlight())
+    client = Client()
+    threads = [threading.Thread(target = coalesce.search, args = (client, 'model', {'query': {}})) for _ in range(4)]
+    threads[0].start()
+    wait_until(lambda: client.calls == 1)
+    for thread in threads[1:]:
+        thread.start()
+    if enabled:
+        wait_until(lambda: coalesce.single_flight.stats()['coalesced'] == 3)
+    else:
+        wait_until(lambda: client.calls == 4)
+    client.release.set()
+    for thread in threads:
+        thread.join()
+    assert client.calls == calls
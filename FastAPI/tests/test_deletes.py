@@ -0,0 +1,132 @@
+import pytest
+from elasticsearch import Elasticsearch, exceptions
+from fastapi import HTTPException
+
+import deletes
+import handlers
+import local_backend
+from cache import ResultCache
+from conftest import Client
+from deletes import DeleteTasks, check_throttle, delete_query, delete_results, delete_tasks
+from handlers import run
+from local_backend import LocalConnection, LocalEngine
+
+DOCS = {'1': {'name': 'Image segmentation', 'owner': 'former member', 'content_type': 'model', 'content_id': '1'},
+        '2': {'name': 'Image classification', 'owner': 'team', 'content_type': 'model', 'content_id': '2'}}
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def es(monkeypatch):
+    '''
+    Blocking client on a local engine holding DOCS in model, with no pending delete task.
+    '''
+    engine = LocalEngine(data_dir = '')
+    for doc_id, doc in DOCS.items():
+        engine.index_doc('model', doc_id, doc)
+    monkeypatch.setattr(local_backend, '_engine', engine)
+    monkeypatch.setattr(delete_tasks, '_indices', {})
+    monkeypatch.setattr(delete_tasks, '_checked', float('-inf'))
+    return Elasticsearch(['http://local:9200'], connection_class = LocalConnection)
+
+def status(handler, client) -> int:
+    with pytest.raises(HTTPException) as e:
+        run(handler, client)
+    return e.value.status_code
+
+def delete_by_query(client, keyword: str = None, owner: list = None, requests_per_second: float = 500):
+    return run(handlers.delete_by_query(keyword, None, ['model'], owner, None, None, 'exact', requests_per_second,
+                                        'auto'), client)
+
+#----------Delete by Query----------#
+def test_check_throttle():
+    check_throttle(100)
+    check_throttle(-1)
+    for rate in (0, -0.5, -2):
+        with pytest.raises(ValueError):
+            check_throttle(rate)
+
+def test_delete_query_needs_a_keyword_or_filter():
+    with pytest.raises(ValueError):
+        delete_query(None, 'exact', {'owner': None, 'version': []})
+    assert delete_query(None, 'exact', {'owner': ['team']})['query']
+
+def test_delete_by_query_task(es):
+    started = delete_by_query(es, owner = ['former member'], requests_per_second = -1)
+    assert started['indices'] == ['model']
+    progress = run(handlers.get_task(started['task']), es)
+    assert progress['completed'] and progress['deleted'] == progress['total'] == 1 and progress['progress'] == 1.0
+    assert progress['requests_per_second'] == -1
+    assert sorted(local_backend._engine.indices['model'].docs) == ['2']
+    assert run(handlers.cancel_task(started['task']), es)['completed']
+    assert status(handlers.get_task('local:99'), es) == 404
+
+def test_delete_by_query_errors(es):
+    assert status(handlers.delete_by_query(None, 'model', None, None, None, None, 'exact', 500, 'auto'), es) == 400
+    assert status(handlers.delete_by_query('x', 'model', None, None, None, None, 'exact', 0, 'auto'), es) == 400
+    assert status(handlers.delete_by_query('x', 'missing', None, None, None, None, 'exact', 500, 'auto'), es) == 404
+
+#----------Pending Tasks----------#
+def test_pending_tasks_are_checked_once_per_interval(monkeypatch):
+    dropped = []
+    monkeypatch.setattr(deletes.cache, 'invalidate', dropped.append)
+    monkeypatch.setattr(deletes.vector_store, 'drop', dropped.append)
+    clock = Clock()
+    tasks = DeleteTasks(check_interval = 1, clock = clock)
+    assert tasks.due() == []
+    tasks.track('node:1', ['model'])
+    tasks.track('node:2', ['app'])
+    assert tasks.due() == ['node:1', 'node:2']
+    assert tasks.due() == []
+    missing = exceptions.NotFoundError(404, 'resource_not_found_exception', {})
+    client = Client({'completed': False}, missing)
+    tasks.settle(client, ['node:1', 'node:2'])
+    assert client.calls == [('get', {'task_id': 'node:1'}), ('get', {'task_id': 'node:2'})]
+    assert dropped == ['app', 'app']
+    clock.now = 1
+    assert tasks.due() == ['node:1']
+    tasks.settle(Client(exceptions.ConnectionError('N/A', 'refused', None)), ['node:1'])
+    tasks.settle(Client({'completed': True}), ['node:1'])
+    assert dropped == ['app', 'app', 'model', 'model']
+    clock.now = 2
+    assert tasks.due() == []
+
+def test_search_settles_completed_tasks(es, monkeypatch):
+    monkeypatch.setattr('cache.result_cache', ResultCache(maxsize = 8, ttl = 60, refresh_grace = 0))
+    monkeypatch.setattr(handlers, 'result_cache', deletes.cache.result_cache)
+    args = dict(index = None, content_type = ['model'], owner = None, application = None, version = None, size = 10,
+                from_ = 0, exact_total = False, deep = False, cursor = None, match = 'exact', min_hits = 1,
+                facets = None, facet_size = 10, mode = 'keyword', envelope = False, profile = False,
+                x_admin_token = None)
+    assert [hit['_d_']['content_id'] for hit in run(handlers.search('image', **args), es)] == ['1', '2']
+    # a task started elsewhere in this process and never polled
+    task = es.delete_by_query(index = 'model', body = delete_query(None, 'exact', {'owner': ['former member']}),
+                              wait_for_completion = False)['task']
+    delete_tasks.track(task, ['model'])
+    assert [hit['_d_']['content_id'] for hit in run(handlers.search('image', **args), es)] == ['2']
+    assert delete_tasks._indices == {}
+
+#----------Bulk Delete----------#
+def test_bulk_delete(es):
+    resp = run(handlers.delete_docs('model', ['1', 'missing']), es)
+    assert (resp['items'], resp['deleted'], resp['errors']) == (2, 1, 0)
+    assert [(result['_id'], result['status'], result['result']) for result in resp['results']] == \
+           [('1', 200, 'deleted'), ('missing', 404, 'not_found')]
+    assert status(handlers.delete_docs('model', ['1'] * (handlers.MAX_DELETE_IDS + 1)), es) == 400
+
+def test_failed_bulk_request_fails_its_ids():
+    error = exceptions.ConnectionError('N/A', 'refused', None)
+    assert [result['status'] for result in delete_results(['1', '2'], error = error)] == [503, 503]
+
+#----------Routes----------#
+@pytest.mark.parametrize('prefix', ['/api/v0', '/api/v0/async'])
+def test_delete_route_validation(request_app, prefix):
+    assert request_app('DELETE', prefix + '/index/documents/query', 'owner=team&requests_per_second=0')[0] == 400
+    assert request_app('DELETE', prefix + '/index/documents/query', 'owner=team&requests_per_second=-2')[0] == 422
+    assert request_app('DELETE', prefix + '/index/documents/query', 'owner=team&slices=0')[0] == 422
+    assert request_app('DELETE', prefix + '/index/documents/query')[0] == 400
@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+import pytest
+from elasticsearch import exceptions
+
+from conftest import AsyncClient
+from export import open_export
+from search_query import export_search, EXPORT_SORT
+from standin import asgi_request
+
+def page(ids: list, pit: str = 'pit') -> dict:
+    hits = [{'_index': 'model', '_id': str(i), '_source': {'content_id': str(i)}, 'sort': ['model', str(i), i]} for i in ids]
+    return {'hits': {'hits': hits}, 'pit_id': pit}
+
+def export(client, phases: list = ('exact', 'fuzzy'), min_hits: int = 1, page_size: int = 2, after: list = None):
+    async def collect():
+        phase, chunks = await open_export(client, ['model'], 'unet', list(phases), {}, min_hits, after, page_size)
+        return phase, [chunk async for chunk in chunks]
+    return asyncio.run(collect())
+
+#----------Export Query----------#
+def test_export_search():
+    body = export_search('unet', 'exact', {'owner': ['lbnl']}, 'pit', ['model', '4', 9], 500).to_dict()
+    assert body['sort'] == EXPORT_SORT
+    assert (body['size'], body['search_after'], body['track_total_hits']) == (500, ['model', '4', 9], False)
+    assert body['query']['bool']['filter'] == [{'terms': {'owner.keyword': ['lbnl']}}]
+
+#----------Streaming Export----------#
+def test_export_streams_every_page():
+    client = AsyncClient({'id': 'pit'}, page([0, 1]), page([2, 3], 'pit-2'), page([4], 'pit-3'), {})
+    phase, chunks = export(client)
+    assert phase == 'exact'
+    lines = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+    assert [line['_id'] for line in lines] == ['0', '1', '2', '3', '4']
+    assert [name for name, _ in client.calls] == ['open_point_in_time', 'search', 'search', 'search', 'close_point_in_time']
+    assert client.calls[2][1]['body']['search_after'] == ['model', '1', 1]
+    assert client.calls[-1][1]['body'] == {'id': 'pit-3'}
+
+def test_export_falls_back_to_fuzzy():
+    client = AsyncClient({'id': 'pit'}, page([]), page([0]), {})
+    assert export(client, min_hits = 1)[0] == 'fuzzy'
+
+def test_export_resumes_after_a_sort_key():
+    client = AsyncClient({'id': 'pit'}, page([5]), {})
+    export(client, phases = ['fuzzy'], after = ['model', '4', 4])
+    assert client.calls[1][1]['body']['search_after'] == ['model', '4', 4]
+
+def test_failed_first_page_closes_the_pit():
+    client = AsyncClient({'id': 'pit'}, exceptions.NotFoundError(404, 'index_not_found_exception', {}), {})
+    with pytest.raises(exceptions.NotFoundError):
+        export(client)
+    assert client.calls[-1] == ('close_point_in_time', {'body': {'id': 'pit'}})
+
+#----------Route----------#
+def test_export_route(app):
+    status, body = asyncio.run(asgi_request(app, 'GET', '/api/v0/search/export', 'content_type=model&page_size=10'))
+    assert status == 200
+    assert [json.loads(line)['_id'] for line in body.splitlines()] == [str(i) for i in range(25)]
+    status, body = asyncio.run(asgi_request(app, 'GET', '/api/v0/search/export', 'content_type=model&after=[1.0,19]'))
+    assert [json.loads(line)['_id'] for line in body.splitlines()] == [str(i) for i in range(20, 25)]
+
+@pytest.mark.parametrize('query', ['after=3', 'keyword=unet&after=[1.0,3]'])
+def test_export_rejects(request_app, query):
+    assert request_app('GET', '/api/v0/search/export', query)[0] == 400
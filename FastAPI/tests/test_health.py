@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from elasticsearch import exceptions
+
+import es_client
+import health
+from health import Readiness
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+class Cluster:
+    '''
+    Async client answering the warmup and the readiness ping, down for its first `down` calls.
+    '''
+    def __init__(self, down: int = 0):
+        self.down = down
+        self.calls = []
+
+    async def _answer(self, name: str, reply):
+        self.calls.append(name)
+        if self.down:
+            self.down -= 1
+            raise exceptions.ConnectionError('N/A', 'refused', None)
+        return reply
+
+    def ping(self, **kwargs):
+        return self._answer('ping', True)
+
+    def info(self, **kwargs):
+        return self._answer('info', {})
+
+    def search(self, index: str, **kwargs):
+        return self._answer('search ' + index, {})
+
+class Resolver:
+    async def aresolve(self, client, patterns: list) -> list:
+        return ['model', 'app']
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(health, 'readiness', Readiness(clock = clock))
+    return clock
+
+#----------Readiness----------#
+def test_ping_is_cached(clock, monkeypatch):
+    cluster = Cluster()
+    monkeypatch.setattr(es_client, 'aes', cluster)
+    assert asyncio.run(health.readiness.check())
+    assert asyncio.run(health.readiness.check())
+    assert cluster.calls == ['ping']
+    clock.now = health.READY_CHECK_TTL
+    cluster.down = 1
+    assert not asyncio.run(health.readiness.check())
+    assert cluster.calls == ['ping', 'ping']
+
+def test_report_and_metrics(clock):
+    readiness = health.readiness
+    clock.now = 2
+    assert readiness.report()['ready_after_seconds'] is None
+    assert 'search_api_ready 0' in readiness.metric_lines()
+    readiness.phases['template'] = 0.25
+    readiness.ready_after = 1.5
+    assert readiness.warm and readiness.report()['uptime_seconds'] == 2
+    lines = readiness.metric_lines()
+    assert 'search_api_ready 1' in lines
+    assert 'search_api_warmup_seconds{phase="template"} 0.25' in lines
+    assert 'search_api_ready_after_seconds 1.5' in lines
+
+#----------Warmup----------#
+def test_warm_up_retries_until_the_cluster_answers(clock, monkeypatch):
+    cluster = Cluster(down = 1)
+    templates = []
+    monkeypatch.setattr(es_client, 'aes', cluster)
+    monkeypatch.setattr(es_client, 'es', type('Blocking', (), {'info': lambda self: {}})())
+    monkeypatch.setattr(es_client, 'build_clients', lambda: 0.1)
+    monkeypatch.setattr(health, 'install_template', lambda client, indices: templates.append(indices))
+    monkeypatch.setattr(health, 'index_resolver', Resolver())
+    monkeypatch.setattr(health, 'WARMUP_RETRY', 0)
+    asyncio.run(health.warm_up())
+    readiness = health.readiness
+    assert readiness.attempts == 2 and readiness.warm and readiness.error is None
+    assert len(templates) == 2
+    assert cluster.calls.count('info') == 2 * health.WARMUP_CONNECTIONS    # every connection, once per attempt
+    assert sorted(readiness.indices) == ['app', 'model']
+    assert set(readiness.phases) == {'clients', 'template', 'connections', 'indices'}
+
+#----------Routes----------#
+def test_probes(request_app, monkeypatch):
+    monkeypatch.setattr(health.readiness, 'ready_after', None)
+    assert request_app('GET', '/healthz')[0] == 200
+    status, body = request_app('GET', '/readyz')
+    assert (status, body['status']) == (503, 'warming up')
+    monkeypatch.setattr(health.readiness, 'ready_after', 0.5)
+    monkeypatch.setattr(health.readiness, '_ping', (float('inf'), False))
+    status, body = request_app('GET', '/readyz')
+    assert (status, body['status'], body['ready_after_seconds']) == (503, 'elasticsearch unavailable', 0.5)
+    monkeypatch.setattr(health.readiness, '_ping', (float('inf'), True))
+    assert request_app('GET', '/readyz')[0] == 200
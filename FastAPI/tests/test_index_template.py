@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+import pytest
+from elasticsearch import exceptions
+
+import index_template
+from conftest import Client, AsyncClient
+from index_template import load_template, index_body, search_fields, text_fields, install_template, ensure_index, \
+                           aensure_index, forget_index, TEMPLATE_NAME, TEMPLATE_PATH
+
+@pytest.fixture(autouse = True)
+def known_indices():
+    forget_index('*')
+    yield
+    forget_index('*')
+
+#----------Template----------#
+def test_template_matches_the_registry_documents():
+    properties = index_body()['mappings']['properties']
+    with open(TEMPLATE_PATH) as f:
+        assert json.load(f)['template']['mappings']['properties'] == properties
+    assert index_body()['mappings']['dynamic'] is False
+    assert properties['uri']['index'] is False
+    assert set(field.split('^')[0] for field in search_fields()) <= set(properties)
+    assert text_fields() == ['name^3', 'application^2', 'description', 'owner']
+
+def test_index_body_is_a_copy():
+    index_body()['settings']['number_of_shards'] = 9
+    assert index_body()['settings']['number_of_shards'] == 1
+
+def test_setting_overrides(monkeypatch):
+    monkeypatch.setattr(index_template, 'INDEX_REPLICAS', '0')
+    monkeypatch.setattr(index_template, 'INDEX_REFRESH_INTERVAL', '30s')
+    settings = load_template()['template']['settings']
+    assert (settings['number_of_shards'], settings['number_of_replicas'], settings['refresh_interval']) == (1, '0', '30s')
+
+#----------Installation----------#
+def test_install_template():
+    client = Client({'acknowledged': True})
+    install_template(client, ['model', 'app'])
+    name, kwargs = client.calls[0]
+    assert (name, kwargs['name'], kwargs['body']['index_patterns']) == ('put_index_template', TEMPLATE_NAME, ['model', 'app'])
+
+def test_ensure_index_creates_once():
+    client = Client({'acknowledged': True})
+    ensure_index(client, 'model')
+    ensure_index(client, 'model')
+    assert client.calls == [('create', {'index': 'model', 'body': index_body()})]
+    forget_index('model')
+    asyncio.run(aensure_index(AsyncClient({'acknowledged': True}), 'model'))
+
+def test_ensure_index_of_an_existing_index():
+    exists = exceptions.RequestError(400, 'resource_already_exists_exception', {})
+    ensure_index(Client(exists), 'model')
+    ensure_index(Client(), 'model')     # known now, no call
+    with pytest.raises(exceptions.RequestError):
+        asyncio.run(aensure_index(AsyncClient(exceptions.RequestError(400, 'illegal_argument_exception', {})), 'app'))
+
+def test_handlers_create_indices_from_the_template(request_app):
+    status, _ = request_app('POST', '/api/v0/index/document', 'index=model&doc_id=1', body = {
+        'name': 'm', 'version': '1', 'type': 't', 'uri': 'u', 'application': [], 'reference': 'r',
+        'description': 'd', 'content_type': 'model', 'content_id': '1', 'owner': 'o'})
+    assert status == 201
+    assert 'model' in index_template._known_indices
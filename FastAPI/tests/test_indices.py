@@ -0,0 +1,53 @@
+import asyncio
+
+from elasticsearch import exceptions
+
+from conftest import Client, AsyncClient
+from indices import IndexResolver, requested_indices, REGISTRY_CONTENT_TYPES
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+ALIASES = {'model': {'aliases': {}}, 'app': {'aliases': {}}}
+
+#----------Registry Indices----------#
+def test_requested_indices():
+    assert requested_indices() == REGISTRY_CONTENT_TYPES
+    assert requested_indices(content_type = ['model']) == ['model']
+    assert requested_indices('model,logs-*', ['app']) == ['model', 'logs-*']
+
+#----------Index Resolution----------#
+def test_resolution_is_cached_until_it_expires():
+    clock = Clock()
+    resolver = IndexResolver(ttl = 30, clock = clock)
+    client = Client(ALIASES, {'model': {'aliases': {}}})
+    assert resolver.resolve(client, ['model', 'app', 'workflow']) == ['app', 'model']
+    assert resolver.resolve(client, ['workflow', 'app', 'model']) == ['app', 'model']
+    assert client.calls == [('get_alias', {'index': 'app,model,workflow', 'ignore_unavailable': True,
+                                           'allow_no_indices': True})]
+    clock.now = 31
+    assert resolver.resolve(client, ['model', 'app', 'workflow']) == ['model']
+    assert len(client.calls) == 2
+
+def test_invalidate_matches_patterns():
+    resolver = IndexResolver()
+    client = Client(ALIASES, ALIASES, ALIASES, ALIASES)
+    resolver.resolve(client, ['model', 'app'])
+    resolver.resolve(client, ['logs-*'])
+    resolver.invalidate('logs-2026')
+    resolver.resolve(client, ['model', 'app'])
+    resolver.resolve(client, ['logs-*'])
+    assert len(client.calls) == 3
+    resolver.invalidate('workflow,app')
+    resolver.resolve(client, ['model', 'app'])
+    assert len(client.calls) == 4
+
+def test_nothing_matches():
+    resolver = IndexResolver()
+    missing = exceptions.NotFoundError(404, 'index_not_found_exception', {})
+    assert resolver.resolve(Client(missing), ['model']) == []
+    assert asyncio.run(resolver.aresolve(AsyncClient({}), ['app'])) == []
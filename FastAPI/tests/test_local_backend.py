@@ -0,0 +1,111 @@
+import pytest
+from elasticsearch import Elasticsearch, exceptions
+
+import local_backend
+from index_template import index_body
+from local_backend import LocalConnection, LocalEngine, LocalError
+from search_query import keyword_search, export_search
+
+DOCS = {
+    '1': {'name': 'Image labeling', 'application': 'segmentation', 'owner': 'mlexchange team',
+          'content_type': 'model', 'content_id': '1', 'version': '1.0', 'description': 'unet segmentation'},
+    '2': {'name': 'Image classification', 'application': 'classification', 'owner': 'mlexchange team',
+          'content_type': 'model', 'content_id': '2', 'version': '2.0', 'description': 'resnet'},
+    '3': {'name': 'Segmentation demo', 'application': 'segmentation', 'owner': 'someone else',
+          'content_type': 'model', 'content_id': '3', 'version': '1.0', 'description': 'a demo of image segmentation'},
+}
+
+@pytest.fixture
+def engine():
+    engine = LocalEngine(data_dir = '')
+    engine.create_index('model', index_body())
+    for doc_id, doc in DOCS.items():
+        engine.index_doc('model', doc_id, doc)
+    return engine
+
+def ids(resp: dict) -> list:
+    return [hit['_id'] for hit in resp['hits']['hits']]
+
+#----------Text Analysis----------#
+def test_edit_distance():
+    assert local_backend.edit_distance('segmentation', 'segmentaton', 2) == 1
+    assert local_backend.edit_distance('model', 'mdoel', 2) == 2
+    assert local_backend.edit_distance('model', 'xyzzy', 2) > 2
+
+#----------Search----------#
+def test_hits_are_ordered_by_score(engine):
+    resp = engine.search('model', keyword_search('segmentation', 'exact').to_dict())
+    assert ids(resp) == ['3', '1']
+    assert resp['hits']['hits'][0]['_score'] > resp['hits']['hits'][1]['_score']
+    assert resp['hits']['total'] == {'value': 2, 'relation': 'eq'}
+
+def test_fuzzy_phase_matches_typos(engine):
+    assert ids(engine.search('model', keyword_search('segmentaton', 'exact').to_dict())) == []
+    assert set(ids(engine.search('model', keyword_search('segmentaton', 'fuzzy').to_dict()))) == {'1', '3'}
+
+def test_keyword_filters(engine):
+    filters = {'owner': ['mlexchange team'], 'version': ['1.0']}
+    assert ids(engine.search('model', keyword_search(None, 'exact', filters).to_dict())) == ['1']
+    # the analyzed field does not match the whole value, its .keyword subfield does
+    analyzed = {'query': {'bool': {'filter': [{'terms': {'owner': ['mlexchange team']}}]}}}
+    assert ids(engine.search('model', analyzed)) == []
+
+def test_sort_ties_break_on_shard_doc(engine):
+    body = {'query': {'match_all': {}}, 'sort': [{'version': 'asc'}, {'_shard_doc': 'asc'}]}
+    resp = engine.search('model', body)
+    assert ids(resp) == ['1', '3', '2']
+    assert [hit['sort'][0] for hit in resp['hits']['hits']] == ['1.0', '1.0', '2.0']
+    after = dict(body, search_after = resp['hits']['hits'][0]['sort'])
+    assert ids(engine.search('model', after)) == ['3', '2']
+
+def test_terms_aggregation(engine):
+    body = {'size': 0, 'aggs': {'owner': {'terms': {'field': 'owner.keyword', 'size': 1}}}}
+    agg = engine.search('model', body)['aggregations']['owner']
+    assert agg['buckets'] == [{'key': 'mlexchange team', 'doc_count': 2}]
+    assert agg['sum_other_doc_count'] == 1
+
+def test_pit_pagination(engine):
+    pit = engine.open_pit('model')['id']
+    after, pages = None, []
+    while True:
+        resp = engine.search(None, export_search(None, 'exact', {}, pit, after, size = 2).to_dict())
+        if not resp['hits']['hits']:
+            break
+        pages.append(ids(resp))
+        after = resp['hits']['hits'][-1]['sort']
+    assert pages == [['1', '2'], ['3']]
+    assert engine.close_pit(pit) == {'succeeded': True, 'num_freed': 1}
+    with pytest.raises(LocalError) as e:
+        engine.search(None, {'pit': {'id': pit}})
+    assert e.value.status == 404
+
+#----------Documents----------#
+def test_seq_no_and_create_conflicts(engine):
+    first = engine.get_doc('model', '1')
+    resp = engine.index_doc('model', '1', dict(DOCS['1'], version = '1.1'))
+    assert resp['result'] == 'updated' and resp['_version'] == 2 and resp['_seq_no'] > first['_seq_no']
+    with pytest.raises(LocalError) as e:
+        engine.index_doc('model', '1', DOCS['1'], 'create')
+    assert e.value.status == 409
+    assert e.value.body['error']['type'] == 'version_conflict_engine_exception'
+    assert engine.delete_doc('model', '1')['_seq_no'] > resp['_seq_no']
+
+def test_operation_log_is_replayed(tmp_path):
+    engine = LocalEngine(data_dir = str(tmp_path))
+    engine.create_index('model', index_body())
+    for doc_id, doc in DOCS.items():
+        engine.index_doc('model', doc_id, doc)
+    engine.delete_doc('model', '2')
+    reloaded = LocalEngine(data_dir = str(tmp_path))
+    assert sorted(reloaded.indices['model'].docs) == ['1', '3']
+    assert ids(reloaded.search('model', keyword_search('segmentation', 'exact').to_dict())) == ['3', '1']
+
+#----------Client----------#
+def test_client_runs_on_the_engine(engine, monkeypatch):
+    monkeypatch.setattr(local_backend, '_engine', engine)
+    es = Elasticsearch(['http://local:9200'], connection_class = LocalConnection)
+    assert ids(es.search(index = 'model', body = keyword_search('classification', 'exact').to_dict())) == ['2']
+    with pytest.raises(exceptions.NotFoundError):
+        es.get(index = 'model', id = '42')
+    with pytest.raises(exceptions.ConflictError):
+        es.create(index = 'model', id = '1', document = DOCS['1'])
@@ -0,0 +1,79 @@
+import asyncio
+
+from elasticsearch import exceptions
+
+import metrics
+import standin
+from metrics import Counter, Gauge, Histogram
+
+#----------Exposition Format----------#
+def test_counter_and_gauge():
+    counter = Counter('calls_total', 'Calls.', ('endpoint',))
+    counter.inc('_search')
+    counter.inc('_search', value = 2)
+    counter.inc('_bulk')
+    assert counter.render() == ['# HELP calls_total Calls.', '# TYPE calls_total counter',
+                                'calls_total{endpoint="_bulk"} 1', 'calls_total{endpoint="_search"} 3']
+    gauge = Gauge('in_flight', 'In flight.')
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.render() == ['# HELP in_flight In flight.', '# TYPE in_flight gauge', 'in_flight 1']
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('duration_seconds', 'Duration.', ('route',), buckets = (0.1, 1.0))
+    histogram.observe(0.05, '/search')
+    histogram.observe(0.1, '/search')
+    histogram.observe(0.5, '/search')
+    histogram.observe(3, '/search')
+    assert histogram.render() == [
+        '# HELP duration_seconds Duration.', '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{route="/search",le="0.1"} 2',
+        'duration_seconds_bucket{route="/search",le="1.0"} 3',
+        'duration_seconds_bucket{route="/search",le="+Inf"} 4',
+        'duration_seconds_sum{route="/search"} 3.65',
+        'duration_seconds_count{route="/search"} 4']
+
+#----------Elasticsearch Calls----------#
+def test_es_endpoint():
+    assert metrics.es_endpoint('/model,app/_search?ignore_unavailable=true') == '_search'
+    assert metrics.es_endpoint('/model/_doc/42') == '_doc'
+    assert metrics.es_endpoint('/model') == 'index'
+    assert metrics.es_endpoint('/') == 'info'
+
+def test_es_error_type():
+    missing = exceptions.NotFoundError(404, 'index_not_found_exception', {})
+    assert metrics.es_error_type(missing) == 'index_not_found_exception'
+    assert metrics.es_error_type(exceptions.ConnectionError('N/A', 'refused', None)) == 'ConnectionError'
+    assert metrics.es_error_type(exceptions.TransportError(500, 'Internal Server Error', {})) == 'TransportError'
+
+def test_es_finished_splits_the_call(monkeypatch):
+    for name in ('ES_SECONDS', 'ES_TOOK', 'ES_NETWORK', 'ES_OVERHEAD'):
+        monkeypatch.setattr(metrics, name, Histogram(name, name, ('endpoint',)))
+    started = metrics.es_started() - 0.5
+    metrics.record_round_trip(0.3)
+    metrics.es_finished('/model/_search', started, {'took': 100})
+    assert metrics.ES_TOOK._series[('_search',)][1] == 0.1
+    assert abs(metrics.ES_NETWORK._series[('_search',)][1] - 0.2) < 1e-9
+    assert 0.2 <= metrics.ES_OVERHEAD._series[('_search',)][1] < 0.3
+    assert 0.5 <= metrics.ES_SECONDS._series[('_search',)][1]
+
+def test_es_finished_counts_errors(monkeypatch):
+    monkeypatch.setattr(metrics, 'ES_ERRORS', Counter('errors', 'Errors.', ('endpoint', 'type')))
+    missing = exceptions.NotFoundError(404, 'index_not_found_exception', {})
+    metrics.es_finished('/model/_doc/42', metrics.es_started(), error = missing)
+    assert metrics.ES_ERRORS._values == {('_doc', 'index_not_found_exception'): 1}
+
+#----------Route----------#
+def test_metrics_route(app, request_app):
+    request_app('GET', '/api/v0/search/document/', 'keyword=model')
+    request_app('GET', '/api/v0/async/search/document/', 'keyword=model')
+    status, data = asyncio.run(standin.asgi_request(app, 'GET', '/metrics'))
+    assert status == 200
+    text = data.decode()
+    route = 'method="GET",route="/api/v0/search/document/",status="200"'
+    assert f'search_api_request_duration_seconds_count{{{route}}}' in text
+    assert 'route="/api/v0/async/search/document/"' in text
+    assert 'search_api_es_took_seconds_count{endpoint="_search"}' in text
+    assert 'search_api_cache_lookups_total{cache="pages",result="miss"}' in text
+    assert '# TYPE search_api_searches_coalesced_total counter' in text
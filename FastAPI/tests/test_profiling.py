@@ -0,0 +1,93 @@
+import pytest
+from elasticsearch import Elasticsearch
+from fastapi import HTTPException
+
+import handlers
+import local_backend
+import profiling
+from handlers import run
+from local_backend import LocalConnection, LocalEngine
+from profiling import Sampler, check_profile, is_admin, shard_summary
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def admin(monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_ADMIN_TOKENS', ['secret'])
+    return 'secret'
+
+@pytest.fixture
+def es(monkeypatch):
+    engine = LocalEngine(data_dir = '')
+    engine.index_doc('model', '1', {'name': 'Image segmentation', 'content_type': 'model', 'content_id': '1'})
+    monkeypatch.setattr(local_backend, '_engine', engine)
+    return Elasticsearch(['http://local:9200'], connection_class = LocalConnection)
+
+def search(client, **kwargs):
+    args = dict(index = None, content_type = ['model'], owner = None, application = None, version = None, size = 10,
+                from_ = 0, exact_total = False, deep = False, cursor = None, match = 'auto', min_hits = 1,
+                facets = None, facet_size = 10, mode = 'keyword', envelope = True, profile = True,
+                x_admin_token = 'secret')
+    return run(handlers.search('segmentation', **dict(args, **kwargs)), client)
+
+def status(client, **kwargs) -> int:
+    with pytest.raises(HTTPException) as e:
+        search(client, **kwargs)
+    return e.value.status_code
+
+#----------Admission----------#
+def test_admin_token(admin, monkeypatch):
+    assert is_admin(admin)
+    assert not is_admin('guess') and not is_admin(None)
+    monkeypatch.setattr(profiling, 'PROFILE_ADMIN_TOKENS', [])
+    assert not is_admin(admin)      # no tokens, no profiling
+
+def test_check_profile():
+    check_profile('keyword', False)
+    for mode, deep in (('semantic', False), ('keyword', True)):
+        with pytest.raises(ValueError):
+            check_profile(mode, deep)
+
+def test_sampler_bucket_refills_per_minute():
+    clock = Clock()
+    draws = iter([0.1, 0.1, 0.1, 0.9, 0.1])
+    sampler = Sampler(rate = 0.5, per_minute = 2, clock = clock, draw = lambda: next(draws))
+    assert [sampler.sample() for _ in range(4)] == [True, True, False, False]
+    clock.now = 30          # one token back
+    assert sampler.sample()
+
+#----------Profile----------#
+def test_shard_summary():
+    shard = {'id': 's0', 'searches': [{'query': [{'time_in_nanos': 2000000}], 'rewrite_time': 500000,
+                                       'collector': [{'time_in_nanos': 1000000}]}],
+             'aggregations': [{'time_in_nanos': 3000000}]}
+    assert shard_summary({'shards': [shard]}) == [{'id': 's0', 'query_ms': 2.0, 'rewrite_ms': 0.5, 'collector_ms': 1.0,
+                                                   'aggregations_ms': 3.0}]
+
+def test_profiled_search(es, admin, monkeypatch):
+    monkeypatch.setattr(handlers, 'profile_sampler', Sampler(rate = 1, per_minute = 1))
+    page = search(es)
+    assert [hit['_id'] for hit in page['hits']] == ['1']
+    profile = page['profile']
+    assert profile['sampled'] and [search['phase'] for search in profile['searches']] == ['exact']
+    assert profile['searches'][0]['shard_profile'][0]['id'] == '[local][model][0]'
+    assert {'build_ms', 'convert_ms', 'encode_ms', 'es_round_trip_ms', 'total_ms'} <= set(profile)
+    # over budget: answered as usual
+    assert search(es)['profile'] == {'sampled': False}
+
+def test_profile_gate(es, admin):
+    assert status(es, x_admin_token = None) == 403
+    assert status(es, x_admin_token = 'guess') == 403
+    assert status(es, envelope = False) == 400
+    assert status(es, deep = True) == 400
+    assert status(es, mode = 'semantic') == 400
+
+#----------Routes----------#
+@pytest.mark.parametrize('prefix', ['/api/v0', '/api/v0/async'])
+def test_profile_route_needs_a_token(request_app, admin, prefix):
+    assert request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true&profile=true')[0] == 403
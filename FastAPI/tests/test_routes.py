@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from elasticsearch import exceptions
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+
+import handlers
+from conftest import Client, AsyncClient, drive
+from handlers import call, run, arun
+from search_query import hit_list
+
+PREFIXES = ['/api/v0', '/api/v0/async']
+
+#----------Handlers----------#
+def test_run_sends_replies_back():
+    def handler():
+        first = yield call('search', body = {})
+        second = yield call('indices.delete', index = 'model')
+        return first, second
+    client = Client('a', 'b')
+    assert run(handler(), client) == ('a', 'b')
+    assert client.calls == [('search', {'body': {}}), ('delete', {'index': 'model'})]
+    assert drive(handler, 'a', 'b') == ('a', 'b')
+
+def test_errors_are_thrown_into_the_handler():
+    missing = exceptions.NotFoundError(404, 'index_not_found_exception', {})
+    for factory in (lambda: handlers.delete_index('missing'), lambda: handlers.delete_doc('model', 'missing')):
+        with pytest.raises(HTTPException) as e:
+            run(factory(), Client(missing))
+        assert e.value.status_code == 404
+        with pytest.raises(HTTPException):
+            asyncio.run(arun(factory(), AsyncClient(missing)))
+    with pytest.raises(HTTPException) as e:
+        run(handlers.create_index('model'), Client(exceptions.RequestError(400, 'resource_already_exists_exception', {})))
+    assert e.value.status_code == 400
+
+def test_hit_list_encodes_like_hit_objects():
+    raw = {'hits': {'hits': [{'_index': 'model', '_type': '_doc', '_id': '1', '_score': 2.0, 'sort': [2.0, 1],
+                              '_source': {'name': 'model 1', 'application': ['a']}}]}}
+    assert hit_list(raw['hits']['hits']) == jsonable_encoder(list(Response(Search(), raw)))
+
+#----------Routes----------#
+def test_every_route_has_an_async_variant(app):
+    import main
+    routes = {(route.path, tuple(route.methods)): route for route in app.routes if route.path.startswith('/api/v0/')}
+    variants = [key for key in routes if key[0].startswith('/api/v0/async/')]
+    assert len(variants) == len(main.routes.endpoints)
+    for path, methods in variants:
+        variant = routes[(path, methods)]
+        blocking = routes[(path.replace('/api/v0/async', '/api/v0', 1), methods)]
+        assert variant.status_code == blocking.status_code
+        for params in ('path_params', 'query_params', 'header_params', 'body_params'):
+            assert [p.name for p in getattr(variant.dependant, params)] == [p.name for p in getattr(blocking.dependant, params)]
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_search(request_app, prefix):
+    status, hits = request_app('GET', prefix + '/search/document/', 'keyword=model')
+    assert status == 200
+    assert len(hits) == 10
+    assert hits[0] == {'_d_': {'name': 'model 0', 'content_type': 'model', 'content_id': '0'},
+                       'meta': {'_d_': {'index': 'model', 'id': '0', 'score': 1.0, 'sort': [1.0, 0], 'doc_type': '_doc'}}}
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_delete_doc_answers_200(request_app, prefix):
+    assert request_app('DELETE', prefix + '/index/model/document/1') == (200, None)
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_create_index(request_app, prefix):
+    status, resp = request_app('POST', prefix + '/index', body = {'index': 'model'})
+    assert status == 201 and resp['acknowledged']
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_search_envelope(request_app, prefix):
+    status, page = request_app('GET', prefix + '/search/document/', 'keyword=model&size=5&from=20&envelope=true')
+    assert status == 200
+    assert (page['size'], page['from'], page['cursor']) == (5, 20, None)
+    assert page['hits'][0]['_source']['name'] == 'model 0'
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_deep_paging(request_app, prefix):
+    ids, query = [], 'keyword=model&size=10&envelope=true&deep=true'
+    while True:
+        status, page = request_app('GET', prefix + '/search/document/', query)
+        assert status == 200
+        ids += [hit['_id'] for hit in page['hits']]
+        if page['cursor'] is None:
+            break
+        query = 'keyword=model&size=10&envelope=true&cursor=' + page['cursor']
+    assert ids == [str(i) for i in range(25)]
+
+@pytest.mark.parametrize('query', ['keyword=model&deep=true', 'keyword=model&from=9995&size=10'])
+def test_search_rejects(request_app, query):
+    assert request_app('GET', '/api/v0/search/document/', query)[0] == 400
+
+def test_cursor_of_another_search(request_app):
+    cursor = request_app('GET', '/api/v0/search/document/', 'keyword=model&envelope=true&deep=true')[1]['cursor']
+    status, error = request_app('GET', '/api/v0/search/document/', 'keyword=other&envelope=true&cursor=' + cursor)
+    assert status == 400 and 'different' in error['detail']
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_search_scope(request_app, prefix):
+    page = request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true')[1]
+    assert page['shards']['total'] == 3
+    page = request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true&content_type=model&content_type=app')[1]
+    assert page['shards']['total'] == 2
+    page = request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true&index=work*')[1]
+    assert page['shards']['total'] == 1
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_search_without_indices(request_app, prefix):
+    status, page = request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true&index=missing')
+    assert status == 200
+    assert page['hits'] == [] and page['shards']['total'] == 0
+    assert request_app('GET', prefix + '/search/document/', 'keyword=model&content_type=dataset') == (200, [])
+
+def test_cursor_is_bound_to_the_scope(request_app):
+    cursor = request_app('GET', '/api/v0/search/document/', 'keyword=model&envelope=true&deep=true&content_type=model')[1]['cursor']
+    status, error = request_app('GET', '/api/v0/search/document/', 'keyword=model&envelope=true&cursor=' + cursor)
+    assert status == 400 and 'different' in error['detail']
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_search_phases(request_app, prefix):
+    assert request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true')[1]['phase'] == 'exact'
+    page = request_app('GET', prefix + '/search/document/', 'keyword=typo&envelope=true')[1]
+    assert (page['phase'], len(page['hits'])) == ('fuzzy', 10)
+    page = request_app('GET', prefix + '/search/document/', 'keyword=typo&envelope=true&match=exact')[1]
+    assert (page['phase'], page['hits']) == ('exact', [])
+    assert request_app('GET', prefix + '/search/document/', 'keyword=model&match=regex')[0] == 422
+
+def test_deep_paging_keeps_its_phase(request_app):
+    page = request_app('GET', '/api/v0/search/document/', 'keyword=typo&envelope=true&deep=true')[1]
+    assert page['phase'] == 'fuzzy'
+    page = request_app('GET', '/api/v0/search/document/', 'keyword=typo&envelope=true&cursor=' + page['cursor'])[1]
+    assert page['phase'] == 'fuzzy' and len(page['hits']) == 10
+
+def test_filter_only_search(request_app):
+    status, page = request_app('GET', '/api/v0/search/document/', 'owner=lbnl&application=a&application=b&envelope=true')
+    assert status == 200
+    assert page['phase'] is None and len(page['hits']) == 10
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_search_facets(request_app, prefix):
+    status, page = request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true&facets=owner&facets=version')
+    assert status == 200
+    assert page['facets'] == {name: [{'value': 'standin', 'count': 25}] for name in ('owner', 'version')}
+    assert request_app('GET', prefix + '/search/document/', 'keyword=model&envelope=true&facets=name')[0] == 400
+    assert request_app('GET', prefix + '/search/document/', 'keyword=model&facets=owner')[0] == 400
@@ -0,0 +1,94 @@
+import pytest
+
+from search_query import keyword_search, plan_phases, enough_hits, page_response, encode_cursor, decode_cursor, \
+                         query_hash, MAX_RESULT_WINDOW, TOTAL_HITS_BOUND, FUZZY_MAX_EXPANSIONS, SEARCH_FIELDS, \
+                         PHRASE_FIELDS
+
+#----------Cursors----------#
+def test_cursor_round_trip():
+    query = query_hash('model', {}, None)
+    cursor = encode_cursor('pit-1', [1.5, 7], 'exact', query)
+    assert decode_cursor(cursor, query) == {'pit': 'pit-1', 'after': [1.5, 7], 'phase': 'exact'}
+    assert decode_cursor(encode_cursor('pit-1', [0.0, 2], None, query), query)['phase'] is None
+
+def test_cursor_is_bound_to_its_search():
+    cursor = encode_cursor('pit-1', [1.5, 7], 'fuzzy', query_hash('model', {}, None))
+    with pytest.raises(ValueError, match = 'different'):
+        decode_cursor(cursor, query_hash('workflow', {}, None))
+
+def test_query_hash_covers_scope():
+    query = query_hash('model', {'content_type': ['model', 'app']}, None)
+    assert query == query_hash('model', {'content_type': ['app', 'model']}, None)
+    assert query != query_hash('model', {'content_type': ['model']}, None)
+    assert query != query_hash('model', {'content_type': ['model', 'app']}, 'model')
+    assert query != query_hash('model', {'content_type': ['model', 'app'], 'owner': ['lbnl']}, None)
+    assert query_hash('model', {'content_type': None}, None) == query_hash('model', {}, None)
+
+@pytest.mark.parametrize('cursor', ['', 'not base64!', 'eyJwaXQiOiAxfQ==', encode_cursor('pit-1', [1], 'other')])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError, match = 'Invalid cursor'):
+        decode_cursor(cursor, None)
+
+#----------Query Planner----------#
+def test_plan_phases():
+    assert plan_phases() == ['exact', 'fuzzy']
+    assert plan_phases('fuzzy') == ['fuzzy']
+    assert plan_phases('auto', 'fuzzy') == ['fuzzy']    # pinned by the cursor of a deep search
+    with pytest.raises(ValueError):
+        plan_phases('regex')
+
+def test_filter_only_search_has_one_phase():
+    assert plan_phases('exact', None, None) == [None]
+    assert plan_phases('auto', None, '') == [None]
+
+def test_enough_hits():
+    raw = {'hits': {'hits': [{}, {}], 'total': {'value': 40, 'relation': 'eq'}}}
+    assert enough_hits(raw, 3)
+    assert not enough_hits({'hits': {'hits': [{}, {}]}}, 3)     # no total on later deep pages
+
+def test_phase_queries():
+    exact = keyword_search('unet seg', 'exact').to_dict()['query']['bool']
+    assert exact['minimum_should_match'] == 1
+    assert [clause['multi_match'].get('type') for clause in exact['should']] == [None, 'phrase_prefix']
+    assert exact['should'][1]['multi_match']['fields'] == PHRASE_FIELDS
+    fuzzy = keyword_search('unet seg', 'fuzzy').to_dict()['query']['multi_match']
+    assert (fuzzy['fuzziness'], fuzzy['max_expansions']) == ('AUTO', FUZZY_MAX_EXPANSIONS)
+    assert fuzzy['fields'] == SEARCH_FIELDS and 'name^3' in SEARCH_FIELDS
+
+#----------Query Builders----------#
+def test_shallow_search():
+    body = keyword_search('model', 'fuzzy', None, 20, 40).to_dict()
+    assert (body['from'], body['size'], body['track_total_hits']) == (40, 20, TOTAL_HITS_BOUND)
+    assert 'pit' not in body and 'sort' not in body
+    assert keyword_search('model', exact_total = True).to_dict()['track_total_hits'] is True
+
+def test_filters_run_in_filter_context():
+    filters = {'owner': ['lbnl', 'anl'], 'version': ['1.0'], 'application': None, 'content_type': []}
+    query = keyword_search('unet', 'fuzzy', filters).to_dict()['query']['bool']
+    assert query['must'] == [keyword_search('unet', 'fuzzy').to_dict()['query']]
+    assert query['filter'] == [{'terms': {'owner.keyword': ['lbnl', 'anl']}}, {'terms': {'version': ['1.0']}}]
+    query = keyword_search(None, None, {'owner': ['lbnl']}).to_dict()['query']
+    assert query == {'bool': {'filter': [{'terms': {'owner.keyword': ['lbnl']}}]}}
+
+def test_shallow_search_window():
+    with pytest.raises(ValueError):
+        keyword_search('model', 'fuzzy', None, 10, MAX_RESULT_WINDOW - 9)
+
+def test_deep_search():
+    body = keyword_search('model', 'exact', None, 10, 0, False, 'pit-1', [1.5, 7]).to_dict()
+    assert body['pit']['id'] == 'pit-1'
+    assert body['sort'] == ['_score', {'_shard_doc': 'asc'}]
+    assert body['search_after'] == [1.5, 7]
+    assert body['track_total_hits'] is False    # reported with the first page
+    assert 'from' not in body
+
+#----------Response Formatting----------#
+def test_page_response_cursor():
+    hits = [{'_id': str(i), 'sort': [1.0, i]} for i in range(3)]
+    raw = {'hits': {'hits': hits, 'total': {'value': 3, 'relation': 'eq'}}, 'pit_id': 'pit-2', '_shards': {'total': 2}}
+    query = query_hash('model', {}, None)
+    page = page_response(raw, 3, 0, 'exact', query)
+    assert (page['from'], page['phase']) == (None, 'exact')
+    assert decode_cursor(page['cursor'], query) == {'pit': 'pit-2', 'after': [1.0, 2], 'phase': 'exact'}
+    assert page_response(raw, 4, 0, 'exact', query)['cursor'] is None
+    assert page_response({'hits': raw['hits'], '_shards': raw['_shards']}, 3, 6)['from'] == 6
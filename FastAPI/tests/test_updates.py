@@ -0,0 +1,119 @@
+import pytest
+from elasticsearch import Elasticsearch, exceptions
+from fastapi import HTTPException
+
+import handlers
+import local_backend
+import vectors
+from conftest import Client
+from handlers import run
+from local_backend import LocalConnection, LocalEngine
+from updates import UpdateBatch, check_update, guard
+
+DOC = {'name': 'Image segmentation', 'application': ['segmentation'], 'owner': 'team', 'version': '1.0',
+       'content_type': 'model', 'content_id': '42'}
+
+@pytest.fixture
+def es(monkeypatch):
+    '''
+    Blocking client on a local engine holding DOC as model/42.
+    '''
+    engine = LocalEngine(data_dir = '')
+    engine.index_doc('model', '42', DOC)
+    monkeypatch.setattr(local_backend, '_engine', engine)
+    monkeypatch.setattr(vectors, 'vector_store', vectors.VectorStore())
+    monkeypatch.setattr(handlers, 'vector_store', vectors.vector_store)
+    return Elasticsearch(['http://local:9200'], connection_class = LocalConnection)
+
+def status(handler, client) -> int:
+    with pytest.raises(HTTPException) as e:
+        run(handler, client)
+    return e.value.status_code
+
+#----------Partial Updates----------#
+def test_check_update():
+    check_update({'owner': 'new'})
+    check_update({'owner': 'new'}, 3, 1)
+    with pytest.raises(ValueError):
+        check_update({})
+    with pytest.raises(ValueError):
+        check_update({'owner': 'new'}, 3)
+
+def test_guard():
+    assert guard(3, 1) == {'if_seq_no': 3, 'if_primary_term': 1}
+    assert guard(current = {'_seq_no': 7, '_primary_term': 1}) == {'if_seq_no': 7, 'if_primary_term': 1}
+    assert guard() == {'retry_on_conflict': 3}
+
+def test_update_is_guarded_by_seq_no(es):
+    seq_no = es.get(index = 'model', id = '42')['_seq_no']
+    resp = run(handlers.update_doc('model', '42', {'owner': 'new'}, seq_no, 1), es)
+    assert resp['result'] == 'updated' and resp['_seq_no'] > seq_no
+    # a second edit from the same read lost the race
+    assert status(handlers.update_doc('model', '42', {'owner': 'other'}, seq_no, 1), es) == 409
+    assert es.get(index = 'model', id = '42')['_source']['owner'] == 'new'
+    assert run(handlers.update_doc('model', '42', {'owner': 'new'}, None, None), es)['result'] == 'noop'
+
+def test_update_errors(es):
+    assert status(handlers.update_doc('model', '42', {}, None, None), es) == 400
+    assert status(handlers.update_doc('model', '42', {'owner': 'new'}, 1, None), es) == 400
+    assert status(handlers.update_doc('model', 'missing', {'owner': 'new'}, None, None), es) == 404
+
+def test_update_of_embedded_fields_embeds_again(es):
+    before = es.get(index = 'model', id = '42')['_source']['application']
+    run(handlers.update_doc('model', '42', {'description': 'unet for volumes'}, None, None), es)
+    source = es.get(index = 'model', id = '42')['_source']
+    assert source['application'] == before and source['description'] == 'unet for volumes'
+    assert source['embedding']['model'] == handlers.embedding_fields([source])[0]['model']
+
+def test_unguarded_conflict_reads_again():
+    current = {'_seq_no': 4, '_primary_term': 1, '_source': DOC}
+    conflict = exceptions.ConflictError(409, 'version_conflict_engine_exception', {})
+    client = Client(current, conflict, dict(current, _seq_no = 5), {'result': 'updated'})
+    assert run(handlers.update_doc('model', '42', {'name': 'Segmentation'}, None, None), client) == {'result': 'updated'}
+    assert [name for name, _ in client.calls] == ['get', 'update', 'get', 'update']
+    assert client.calls[3][1]['if_seq_no'] == 5
+
+#----------Bulk Updates----------#
+def test_bulk_update(es):
+    es.index(index = 'model', id = '43', document = dict(DOC, content_id = '43'))
+    seq_no = es.get(index = 'model', id = '43')['_seq_no']
+    updates = [{'id': '42', 'doc': {'owner': 'new'}},
+               {'id': '43', 'doc': {'name': 'Volume segmentation'}, 'if_seq_no': seq_no + 1, 'if_primary_term': 1},
+               {'id': 'missing', 'doc': {'name': 'Anything'}},
+               {'id': '44', 'doc': {'content_id': '1'}},
+               {'id': '45', 'doc': {}}]
+    resp = run(handlers.update_docs('model', updates), es)
+    assert resp['items'] == 5 and resp['errors'] == 4
+    assert [result['status'] for result in resp['results']] == [200, 409, 404, 400, 400]
+    assert [result['_id'] for result in resp['results']] == ['42', '43', 'missing', '44', '45']
+    assert es.get(index = 'model', id = '42')['_source']['owner'] == 'new'
+    assert status(handlers.update_docs('model', [{}] * (handlers.MAX_UPDATE_DOCS + 1)), es) == 400
+
+def test_bulk_update_retries_unguarded_conflicts():
+    batch = UpdateBatch('model', [{'id': '42', 'doc': {'name': 'New'}}, {'id': '43', 'doc': {'owner': 'new'}}])
+    rounds = batch.rounds()
+    assert next(rounds) == {'docs': [{'_index': 'model', '_id': '42'}]}
+    batch.feed_sources({'docs': [{'_id': '42', 'found': True, '_seq_no': 4, '_primary_term': 1, '_source': DOC}]})
+    assert len(batch.sources()) == 1
+    batch.feed_embeddings([{'model': 'm', 'vector': [1.0]}])
+    body = batch.bulk_body()
+    assert body[0] == {'update': {'if_seq_no': 4, 'if_primary_term': 1, '_index': 'model', '_id': '42'}}
+    assert body[1] == {'doc': {'name': 'New', 'embedding': {'model': 'm', 'vector': [1.0]}}}
+    assert body[2] == {'update': {'retry_on_conflict': 3, '_index': 'model', '_id': '43'}}
+    batch.feed({'items': [{'update': {'status': 409, 'error': 'conflict'}},
+                          {'update': {'status': 200, 'result': 'updated', '_seq_no': 9, '_primary_term': 1}}]})
+    # only the conflicting update goes into the next round, reading the document again
+    assert next(rounds) == {'docs': [{'_index': 'model', '_id': '42'}]}
+    batch.feed_sources({'docs': [{'_id': '42', 'found': True, '_seq_no': 8, '_primary_term': 1, '_source': DOC}]})
+    batch.feed_embeddings([{'model': 'm', 'vector': [1.0]}])
+    assert batch.bulk_body()[0]['update']['if_seq_no'] == 8
+    batch.feed({'items': [{'update': {'status': 200, 'result': 'updated', '_seq_no': 10, '_primary_term': 1}}]})
+    assert next(rounds, None) is None
+    assert [result['_seq_no'] for result in batch.response()['results']] == [10, 9]
+
+#----------Routes----------#
+@pytest.mark.parametrize('prefix', ['/api/v0', '/api/v0/async'])
+def test_update_route_validation(request_app, prefix):
+    assert request_app('PATCH', prefix + '/index/model/document/42', 'if_seq_no=3', {'owner': 'new'})[0] == 400
+    # content_type and content_id identify the document and cannot change
+    assert request_app('PATCH', prefix + '/index/model/document/42', '', {'content_id': 'new'})[0] == 422
@@ -0,0 +1,149 @@
+import asyncio
+
+import numpy as np
+import pytest
+from elasticsearch import Elasticsearch
+
+import local_backend
+import vectors
+from local_backend import LocalConnection, LocalEngine
+from vectors import VectorIndex
+
+def unit(rows: np.ndarray) -> np.ndarray:
+    return (rows / np.linalg.norm(rows, axis = -1, keepdims = True)).astype(np.float32)
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(7)
+
+def filled(rng, n: int, dim: int = 16) -> tuple:
+    index = VectorIndex(dim)
+    rows = unit(rng.normal(size = (n, dim)))
+    for i, row in enumerate(rows):
+        index.upsert(f'doc-{i}', row)
+    return index, rows
+
+#----------Vector Index----------#
+def test_exact_search_ranks_by_cosine(rng):
+    index, rows = filled(rng, 50)
+    query = rows[3]
+    found = index.search(query, 5)
+    expected = np.argsort(-(rows @ query), kind = 'stable')[:5]
+    assert [doc_id for doc_id, _ in found] == [f'doc-{i}' for i in expected]
+    assert found[0] == ('doc-3', pytest.approx(1.0, abs = 1e-5))
+    assert [score for _, score in found] == sorted((score for _, score in found), reverse = True)
+
+def test_search_returns_at_most_the_stored_vectors(rng):
+    index, _ = filled(rng, 3)
+    assert len(index.search(unit(rng.normal(size = 16)), 10)) == 3
+    assert VectorIndex(16).search(unit(rng.normal(size = 16)), 10) == []
+
+def test_upsert_replaces_and_grows(rng):
+    index, rows = filled(rng, 200)      # past the initial 64 rows
+    assert len(index) == 200
+    index.upsert('doc-0', rows[1])
+    assert len(index) == 200
+    assert {doc_id for doc_id, _ in index.search(rows[1], 2)} == {'doc-0', 'doc-1'}
+
+def test_remove_moves_the_last_row(rng):
+    index, rows = filled(rng, 10)
+    index.remove('doc-2')
+    index.remove('missing')
+    assert len(index) == 9
+    assert 'doc-2' not in [doc_id for doc_id, _ in index.search(rows[2], 9)]
+    # the last document took the freed row and is still found
+    assert index.search(rows[9], 1)[0][0] == 'doc-9'
+    index.upsert('doc-10', rows[2])
+    assert index.search(rows[2], 1)[0][0] == 'doc-10'
+
+def test_ivf_search(rng, monkeypatch):
+    monkeypatch.setattr(vectors, 'VECTOR_IVF_MIN', 500)
+    monkeypatch.setattr(vectors, 'VECTOR_NPROBE', 8)
+    index, rows = filled(rng, 2000)
+    # every stored vector lands in the list of its nearest centroid, which is always probed
+    for i in range(0, 2000, 97):
+        assert index.search(rows[i], 1)[0][0] == f'doc-{i}'
+    queries = unit(rng.normal(size = (50, 16)))
+    recall = np.mean([len({doc_id for doc_id, _ in index.search(query, 10)}
+                          & {f'doc-{i}' for i in np.argsort(-(rows @ query))[:10]}) / 10 for query in queries])
+    assert recall >= 0.8
+
+def test_ivf_follows_the_index_size(rng, monkeypatch):
+    monkeypatch.setattr(vectors, 'VECTOR_IVF_MIN', 500)
+    index, rows = filled(rng, 600)
+    index.search(rows[0], 1)
+    assert index._centroids is not None
+    # documents added after training are assigned to a list and found
+    index.upsert('new', rows[5])
+    assert {doc_id for doc_id, _ in index.search(rows[5], 2)} == {'doc-5', 'new'}
+    for i in range(300):
+        index.remove(f'doc-{i}')
+    # halved and below VECTOR_IVF_MIN: back to exact search
+    assert index.search(rows[400], 1)[0][0] == 'doc-400'
+    assert index._centroids is None
+
+def test_snapshot_is_not_changed_by_writes(rng):
+    index, rows = filled(rng, 10)
+    view = index.snapshot()
+    index.upsert('doc-0', rows[5])
+    index.remove('doc-9')
+    index.upsert('new', rows[9])
+    assert [doc_id for doc_id, _ in view.search(rows[9], 1)] == ['doc-9']
+    assert [doc_id for doc_id, _ in view.search(rows[0], 1)] == ['doc-0']
+    assert len(view) == 10
+    assert [doc_id for doc_id, _ in index.search(rows[9], 1)] == ['new']
+
+def test_nearest_keeps_the_partition_trained_on_a_snapshot(rng, monkeypatch):
+    monkeypatch.setattr(vectors, 'VECTOR_IVF_MIN', 500)
+    monkeypatch.setattr(vectors, 'VECTOR_MIN_SCORE', -1.0)
+    index, rows = filled(rng, 600)
+    index._trained = 600        # as if loaded below VECTOR_IVF_MIN: stale once over it
+    store = vectors.VectorStore()
+    assert store.nearest([('model', index)], rows[3], 1) == [(('model', 'doc-3'), pytest.approx(1.0, abs = 1e-5))]
+    assert index._centroids is not None
+
+#----------Vector Search----------#
+@pytest.fixture
+def client(monkeypatch):
+    '''
+    Blocking client on a local engine holding "segmentation" documents of two owners, the
+    five of "team" being the ones least similar to a search for "image segmentation".
+    '''
+    engine = LocalEngine(data_dir = '')
+    for i in range(20):
+        owner = 'team' if i >= 15 else 'others'
+        name = 'image segmentation' if i < 15 else f'segmentation of volume {i}'
+        engine.index_doc('model', str(i), {'name': name, 'owner': owner, 'description': 'x ' * i})
+    monkeypatch.setattr(local_backend, '_engine', engine)
+    monkeypatch.setattr(vectors, 'vector_store', vectors.VectorStore())
+    monkeypatch.setattr(vectors, 'VECTOR_MIN_SCORE', -1.0)
+    monkeypatch.setattr(vectors, 'VECTOR_CANDIDATES', 4)
+    return Elasticsearch(['http://local:9200'], connection_class = LocalConnection)
+
+def test_selective_filters_rank_more_neighbours(client):
+    filters = {'owner': ['team']}
+    page = vectors.vector_search(client, ['model'], 'image segmentation', 'semantic', filters, ['exact'], 1, 3, 0)
+    assert len(page['hits']) == 3
+    assert {hit['_source']['owner'] for hit in page['hits']} == {'team'}
+    assert page['total'] == {'value': 5, 'relation': 'eq'}
+    unfiltered = vectors.vector_search(client, ['model'], 'image segmentation', 'semantic', {}, ['exact'], 1, 3, 0)
+    assert unfiltered['total'] == {'value': 4, 'relation': 'gte'}
+
+def test_async_search_ranks_off_the_event_loop(client, monkeypatch):
+    class AsyncClient:
+        def __getattr__(self, name):
+            async def method(*args, **kwargs):
+                return getattr(client, name)(*args, **kwargs)
+            return method
+    offloaded = []
+    to_thread = asyncio.to_thread
+
+    def record(fn, *args, **kwargs):
+        offloaded.append(getattr(fn, '__name__', None))
+        return to_thread(fn, *args, **kwargs)
+    monkeypatch.setattr(vectors.asyncio, 'to_thread', record)
+    filters = {'owner': ['team']}
+    page = asyncio.run(vectors.avector_search(AsyncClient(), ['model'], 'image segmentation', 'semantic', filters,
+                                              ['exact'], 1, 3, 0))
+    assert page == vectors.vector_search(client, ['model'], 'image segmentation', 'semantic', filters, ['exact'], 1, 3, 0)
+    assert offloaded[:3] == ['_fill', 'embed', 'nearest']
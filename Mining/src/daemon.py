@@ -0,0 +1,157 @@
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#-----Daemon Settings------#
+# In daemon mode the job resyncs every MINING_INTERVAL seconds, or as soon as the registry
+# notifies it (POST /sync). A failed sync (registry or elasticsearch unreachable) is retried
+# after an exponential backoff with jitter, so a recovering service is not hit by retries in
+# lockstep. Unchanged syncs cost one conditional GET per category and no elasticsearch write.
+MINING_INTERVAL     = float(os.getenv('MINING_INTERVAL', 300))      # seconds between syncs
+MINING_PORT         = int(os.getenv('MINING_PORT', 8070))           # notifications, /metrics and /healthz, 0 disables
+MINING_BACKOFF_BASE = float(os.getenv('MINING_BACKOFF_BASE', 5))    # seconds before the first retry
+MINING_BACKOFF_MAX  = float(os.getenv('MINING_BACKOFF_MAX', 300))   # longest wait between retries
+
+def backoff(failures: int, base: float = MINING_BACKOFF_BASE, cap: float = MINING_BACKOFF_MAX, draw = random.uniform) -> float:
+    '''
+    Seconds to wait after `failures` consecutive failed syncs: base doubled per failure up to
+    cap, of which the second half is drawn at random.
+    '''
+    delay = min(cap, base * 2 ** (failures - 1))
+    return delay / 2 + draw(0, delay / 2)
+
+#-----Metrics------#
+class SyncMetrics:
+    '''
+    Outcome, duration and document counts of the syncs, and how stale the indices may be.
+    '''
+    def __init__(self, clock = time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started = clock()
+        self.last_success = None        # start of the last successful sync (unix time)
+        self.last_duration = None
+        self.failures = 0               # consecutive failed syncs
+        self.syncs = {'success': 0, 'failure': 0}
+        self.docs = {}                  # added / changed / removed / skipped / failed / invalid -> documents
+
+    def success(self, started: float, report):
+        with self._lock:
+            self.last_success = started
+            self.last_duration = self._clock() - started
+            self.failures = 0
+            self.syncs['success'] += 1
+            for kind, count in dict(report.counts, failed = report.failed, invalid = report.invalid).items():
+                self.docs[kind] = self.docs.get(kind, 0) + count
+
+    def failure(self, started: float):
+        with self._lock:
+            self.last_duration = self._clock() - started
+            self.failures += 1
+            self.syncs['failure'] += 1
+
+    def lag(self) -> float:
+        '''
+        Seconds since the start of the last successful sync (since process start before one),
+        an upper bound on how far the indices lag behind the registry.
+        '''
+        return self._clock() - (self.last_success if self.last_success is not None else self.started)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = ['# HELP mining_sync_lag_seconds Seconds since the start of the last successful sync.',
+                     '# TYPE mining_sync_lag_seconds gauge',
+                     f'mining_sync_lag_seconds {self.lag()}',
+                     '# HELP mining_consecutive_failures Failed syncs since the last successful one.',
+                     '# TYPE mining_consecutive_failures gauge',
+                     f'mining_consecutive_failures {self.failures}',
+                     '# HELP mining_syncs_total Syncs by outcome.',
+                     '# TYPE mining_syncs_total counter']
+            lines += [f'mining_syncs_total{{outcome="{outcome}"}} {count}' for outcome, count in self.syncs.items()]
+            lines += ['# HELP mining_documents_total Registry documents by sync result.',
+                      '# TYPE mining_documents_total counter']
+            lines += [f'mining_documents_total{{result="{kind}"}} {count}' for kind, count in sorted(self.docs.items())]
+            if self.last_success is not None:
+                lines += ['# HELP mining_last_success_timestamp_seconds Start of the last successful sync.',
+                          '# TYPE mining_last_success_timestamp_seconds gauge',
+                          f'mining_last_success_timestamp_seconds {self.last_success}']
+            if self.last_duration is not None:
+                lines += ['# HELP mining_last_sync_duration_seconds Duration of the last sync.',
+                          '# TYPE mining_last_sync_duration_seconds gauge',
+                          f'mining_last_sync_duration_seconds {self.last_duration}']
+        return '\n'.join(lines) + '\n'
+
+#-----HTTP Endpoint------#
+def serve(port: int, metrics: SyncMetrics, wake: threading.Event) -> ThreadingHTTPServer:
+    '''
+    Serve POST /sync (change notification: sync now), GET /metrics and GET /healthz from a
+    background thread.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: str, content_type: str = 'text/plain'):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path.split('?')[0] != '/sync':
+                return self._send(404, 'not found\n')
+            wake.set()
+            self._send(202, 'sync scheduled\n')
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/metrics':
+                return self._send(200, metrics.render(), 'text/plain; version=0.0.4')
+            if path == '/healthz':
+                return self._send(200, 'ok\n')
+            self._send(404, 'not found\n')
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    threading.Thread(target = server.serve_forever, name = 'mining-http', daemon = True).start()
+    return server
+
+#-----Sync Loop------#
+def run_daemon(sync, interval: float = MINING_INTERVAL, port: int = MINING_PORT, metrics: SyncMetrics = None,
+               stop: threading.Event = None):
+    '''
+    Call sync() forever: every interval seconds, or earlier when notified, and after a
+    jittered exponential backoff when it raised. Documents that failed alone do not fail the
+    sync, they are left to the dead letters.
+
+    Args:
+        sync: callable running one sync and returning its IngestReport
+        stop: event ending the loop once the current sync or wait is over
+    '''
+    metrics = metrics or SyncMetrics()
+    stop = stop or threading.Event()
+    wake = threading.Event()
+    server = serve(port, metrics, wake) if port else None
+    try:
+        while not stop.is_set():
+            started = time.time()
+            try:
+                report = sync()
+            except Exception as e:
+                metrics.failure(started)
+                delay = backoff(metrics.failures)
+                print(f'Sync failed ({type(e).__name__}: {e}), {metrics.failures} in a row, retrying in {delay:.1f}s')
+                stop.wait(delay)
+                continue
+            print(report.summary())
+            metrics.success(started, report)
+            # a notification received during the sync triggers the next one at once
+            wake.wait(interval)
+            wake.clear()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,103 @@
+import json
+import os
+import time
+
+from ingest import digest
+
+#-----Dead Letter Settings------#
+# Registry items that cannot be indexed (malformed, or rejected by elasticsearch) are set aside
+# with the reason instead of aborting the sync, one JSON object per line. `python update_db.py
+# replay` retries only them. Entries are keyed by index and document id (by the item digest for
+# unreadable items, per category), so a document failing at every sync is listed once, and an entry is
+# dropped as soon as its document is written. Replay only retries the failures that may be transient,
+# the others wait for the registry to list a fixed item.
+MINING_DEAD_LETTER_PATH = os.getenv('MINING_DEAD_LETTER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state', 'dead_letter.jsonl'))
+
+def retryable(entry: dict) -> bool:
+    '''
+    Whether retrying the stored item can succeed: deletes, and writes elasticsearch failed to
+    take (429 or 5xx). Unreadable items and documents it rejected (other 4xx) fail the same
+    way until the registry fixes them, so only the next sync listing them retries them.
+    '''
+    status = entry['status'] or 0
+    return entry['stage'] == 'delete' or (entry['stage'] == 'index' and (status == 429 or status >= 500))
+
+class DeadLetters:
+    '''
+    The failed registry items and writes, as {key: entry}. An entry holds the stage that failed
+    ("invalid", "index" or "delete"), the category, index and document id when known, the
+    status, the reason, the time and the item to retry.
+    '''
+    def __init__(self, path: str = MINING_DEAD_LETTER_PATH, entries: dict = None):
+        self.path = path
+        self.entries = entries or {}
+        self.added = set()      # keys added since the file was read
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str = MINING_DEAD_LETTER_PATH):
+        '''
+        Read the dead letter file, skipping unreadable lines.
+        '''
+        entries = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry['key']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        print(f'Ignoring unreadable dead letter in {path}: {line.strip()[:200]}')
+        except FileNotFoundError:
+            pass
+        return cls(path, entries)
+
+    def save(self):
+        '''
+        Rewrite the file atomically when an entry was added or dropped.
+        '''
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, default = str) + '\n')
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def add(self, key: str, stage: str, reason, item = None, category: str = None, index: str = None,
+            doc_id: str = None, status = None):
+        self.entries[key] = {'key': key, 'stage': stage, 'category': category, 'index': index, 'id': doc_id,
+                             'status': status, 'reason': reason, 'time': time.time(), 'item': item}
+        self.added.add(key)
+        self.dirty = True
+
+    def invalid(self, category: str, item, error: Exception):
+        self.add(f'invalid/{category}/{digest(item)}', 'invalid', str(error), item, category)
+
+    def failed(self, kind: str, index: str, doc_id: str, doc: dict, result: dict):
+        self.add(f'{index}/{doc_id}', 'delete' if kind == 'removed' else 'index', result['error'], doc,
+                 index = index, doc_id = doc_id, status = result['status'])
+
+    def resolve(self, key: str):
+        if self.entries.pop(key, None) is not None:
+            self.dirty = True
+
+    def retries(self) -> dict:
+        '''
+        The entries replay() retries, see retryable().
+        '''
+        return {key: entry for key, entry in self.entries.items() if retryable(entry)}
+
+    def sweep(self, categories):
+        '''
+        Drop the invalid items of categories listed in full that were not listed again, i.e.
+        were fixed or removed in the registry.
+        '''
+        for key, entry in list(self.entries.items()):
+            if entry['stage'] == 'invalid' and entry['category'] in categories and key not in self.added:
+                self.resolve(key)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,340 @@
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import exceptions
+
+#-----Ingest Settings------#
+# Registry items stream through fetch -> transform -> diff -> bulk: items whose digest matches
+# the one recorded at the last sync are skipped, the others are grouped into bulk requests with
+# several requests in flight at once, and the documents that left the registry are deleted in
+# bulk at the end. A sync costs one round trip per batch of changes. While it runs, the last
+# item of each category handled so far is checkpointed with the state, so an interrupted sync
+# resumes after it.
+INGEST_BATCH_DOCS  = int(os.getenv('INGEST_BATCH_DOCS', 500))           # documents per bulk request
+INGEST_BATCH_BYTES = int(os.getenv('INGEST_BATCH_BYTES', 5 * 2**20))    # payload bytes per bulk request
+INGEST_IN_FLIGHT   = int(os.getenv('INGEST_IN_FLIGHT', 4))              # bulk requests sent concurrently
+INGEST_CHECKPOINT  = float(os.getenv('INGEST_CHECKPOINT', 10))          # seconds between checkpoints
+INGEST_ERRORS_SHOWN = 10                                                 # failed documents printed in the report
+
+KEYS = ["name", "version", "type", "uri", "application", "reference", "description", "content_type", "content_id", "owner"]
+
+#-----Indices------#
+class IndexCache:
+    '''
+    The registry indices known to exist, so each one is created (with the template settings
+    and mappings) at most once per run instead of checked before every document.
+    '''
+    def __init__(self, body: dict):
+        self.body = body
+        self.known = set()
+
+    def ensure(self, client, index: str):
+        if index in self.known:
+            return
+        try:
+            client.indices.create(index = index, body = self.body)
+        except exceptions.RequestError as e:
+            if e.error != 'resource_already_exists_exception':
+                raise
+        self.known.add(index)
+
+#-----Transform------#
+def transform(item: dict) -> tuple:
+    '''
+    The registry fields of a content registry item.
+
+    Return:
+        (index, document id, document)
+    Raise:
+        ValueError when the item is not an object or has no content_type or content_id
+    '''
+    if not isinstance(item, dict):
+        raise ValueError(f'Item is not an object: {item!r:.200}')
+    doc = {key: value for key, value in item.items() if key in KEYS}
+    if not doc.get('content_type') or not doc.get('content_id'):
+        raise ValueError(f'Item without content_type or content_id: {item}')
+    return doc['content_type'], str(doc['content_id']), doc
+
+def digest(doc: dict) -> str:
+    '''
+    Content digest of a registry document, independent of key order.
+    '''
+    raw = json.dumps(doc, sort_keys = True, separators = (',', ':'), default = str)
+    return hashlib.blake2b(raw.encode(), digest_size = 8).hexdigest()
+
+def item_key(item) -> str:
+    '''
+    Identity of a registry item within its category: its content_id, or its digest when it has none.
+    '''
+    content_id = item.get('content_id') if isinstance(item, dict) else None
+    return str(content_id) if content_id else digest(item)
+
+def plan(entries, state, report, full: bool = False, keep: set = frozenset(), dead = None, progress: dict = None):
+    '''
+    The writes bringing the indices in line with the registry: an index action per new or
+    changed item, then a delete action per document of the state missing from the registry.
+    The deletes are only planned once every item was read.
+
+    Args:
+        entries: iterable of (category, content registry item)
+        state: SyncState of the last sync
+        report: IngestReport counting the fetched, invalid and unchanged items
+        full: rewrite unchanged items too
+        keep: indices whose documents are not deleted, e.g. of categories the registry did
+              not list again because they did not change (read once every item was read)
+        dead: DeadLetters receiving the items that cannot be indexed
+        progress: {category: {"after": item_key of the last item read, "items": items read}},
+                  advanced as entries are read
+    Return:
+        generator of (kind, index, document id, document, digest), kind is "added",
+        "changed" or "removed"
+    '''
+    seen = {}
+    for category, item in entries:
+        report.fetched += 1
+        if progress is not None:
+            handled = progress.get(category, {'items': 0})['items'] + 1
+            progress[category] = {'after': item_key(item), 'items': handled}
+        try:
+            index, doc_id, doc = transform(item)
+        except ValueError as e:
+            report.invalid += 1
+            if dead is not None:
+                dead.invalid(category, item, e)
+            else:
+                print(e)
+            continue
+        seen.setdefault(index, set()).add(doc_id)
+        value = digest(doc)
+        known = state.get(index, doc_id)
+        if known == value and not full:
+            report.counts['skipped'] += 1
+            continue
+        yield 'added' if known is None else 'changed', index, doc_id, doc, value
+    removed = [(index, doc_id) for index in state.indices if index not in keep
+               for doc_id in state.ids(index) - seen.get(index, set())]
+    for index, doc_id in removed:
+        yield 'removed', index, doc_id, None, None
+
+def replay_plan(dead, state, report):
+    '''
+    The writes retrying the dead letters that may succeed now, see dead_letter.retryable().
+    Each of them is dropped from dead; a retry that fails again adds it back. Documents written
+    since they failed are skipped, and a delete is only retried while the state still lists
+    the document.
+
+    Return:
+        generator of (kind, index, document id, document, digest), like plan()
+    '''
+    for key, entry in dead.retries().items():
+        dead.resolve(key)
+        report.fetched += 1
+        if entry['stage'] == 'delete':
+            if state.get(entry['index'], entry['id']) is not None:
+                yield 'removed', entry['index'], entry['id'], None, None
+            continue
+        index, doc_id, doc = transform(entry['item'])
+        value = digest(doc)
+        known = state.get(index, doc_id)
+        if known == value:
+            report.counts['skipped'] += 1
+            continue
+        yield 'added' if known is None else 'changed', index, doc_id, doc, value
+
+#-----Bulk Requests------#
+def send_batch(client, batch: list) -> list:
+    '''
+    Send one batch of planned writes with a single bulk request.
+
+    Args:
+        batch: list of (kind, index, document id, document, digest)
+    Return:
+        list of per-document results ({"_index", "_id", "status", "result" or "error"}), in batch order
+    Raise:
+        TransportError when the bulk request itself failed, e.g. elasticsearch is unreachable
+    '''
+    body = []
+    for kind, index, doc_id, doc, _ in batch:
+        if kind == 'removed':
+            body.append({'delete': {'_index': index, '_id': doc_id}})
+        else:
+            body.append({'index': {'_index': index, '_id': doc_id}})
+            body.append(doc)
+    resp = client.bulk(body = body)
+    results = []
+    for item in resp['items']:
+        item = next(iter(item.values()))
+        result = {'_index': item['_index'], '_id': item['_id'], 'status': item['status']}
+        if 'error' in item:
+            result['error'] = item['error']
+        else:
+            result['result'] = item['result']
+        results.append(result)
+    return results
+
+class IngestReport:
+    '''
+    Counts and throughput of one sync.
+    '''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.fetched = 0
+        self.invalid = 0
+        self.batches = 0
+        self.counts = {'added': 0, 'changed': 0, 'removed': 0, 'skipped': 0}
+        self.failed = 0
+        self.errors = []
+
+    def add(self, batch: list, results: list, state, dead = None):
+        '''
+        Count the results of one bulk request, record the successful writes in the state and
+        the failed ones in the dead letters.
+        '''
+        self.batches += 1
+        for (kind, index, doc_id, doc, value), result in zip(batch, results):
+            if kind == 'removed' and result['status'] == 404:
+                pass    # already gone
+            elif 'error' in result:
+                self.failed += 1
+                if len(self.errors) < INGEST_ERRORS_SHOWN:
+                    self.errors.append(result)
+                if dead is not None:
+                    dead.failed(kind, index, doc_id, doc, result)
+                continue
+            if dead is not None:
+                dead.resolve(f'{index}/{doc_id}')
+            self.counts[kind] += 1
+            if kind == 'removed':
+                state.discard(index, doc_id)
+            else:
+                state.set(index, doc_id, value)
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.start
+        return self
+
+    @property
+    def written(self) -> int:
+        return self.counts['added'] + self.counts['changed'] + self.counts['removed']
+
+    @property
+    def docs_per_sec(self) -> float:
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.start
+        return self.written / seconds if seconds else 0.0
+
+    def summary(self) -> str:
+        lines = [f'Synced {self.fetched} registry items with {self.batches} bulk requests in '
+                 f'{self.seconds:.2f}s ({self.docs_per_sec:.0f} docs/s): '
+                 + ', '.join(f'{count} {kind}' for kind, count in self.counts.items())
+                 + f', {self.failed} failed, {self.invalid} invalid']
+        lines += [f'  failed {error["_index"]}/{error["_id"]} ({error["status"]}): {error["error"]}' for error in self.errors]
+        return '\n'.join(lines)
+
+def ingest(client, entries, indices: IndexCache, state, full: bool = False, keep: set = frozenset(), dead = None,
+           start: dict = None, checkpoint: float = INGEST_CHECKPOINT, batch_docs: int = INGEST_BATCH_DOCS,
+           batch_bytes: int = INGEST_BATCH_BYTES, in_flight: int = INGEST_IN_FLIGHT) -> IngestReport:
+    '''
+    Sync the indices with the registry items in bulk batches, with up to in_flight batches
+    awaiting elasticsearch. The state records every successful write as it is confirmed, and
+    the dead letters every item or write that failed.
+
+    Only the current batch and the in-flight ones are held in memory; reading items pauses
+    while the in-flight limit is reached, so items can be streamed from the registry.
+
+    Batches are confirmed in order, so once a batch is confirmed every item read before it
+    was closed is handled. The last item read per category up to there is saved with the
+    state (and the dead letters) every `checkpoint` seconds and when the sync fails, and
+    cleared once it completes.
+
+    Args:
+        client: Elasticsearch client, shared by the sending threads
+        entries: iterable of (category, content registry item)
+        indices: cache of the indices already created
+        state: SyncState of the last sync, updated in place
+        full: rewrite unchanged items too
+        keep: indices whose documents are not deleted, see plan()
+        dead: DeadLetters, updated in place
+        start: checkpoints of the interrupted sync when resuming, the entries follow them
+    Return:
+        IngestReport of the run
+    Raise:
+        the first error reading the registry or sending a bulk request, once the batches
+        already sent were recorded
+    '''
+    report = IngestReport()
+    progress = dict(start or {})
+    writes = plan(entries, state, report, full, keep, dead, progress)
+    return _write(client, writes, indices, state, report, dead, progress, checkpoint, batch_docs, batch_bytes, in_flight)
+
+def replay(client, dead, indices: IndexCache, state, batch_docs: int = INGEST_BATCH_DOCS,
+           batch_bytes: int = INGEST_BATCH_BYTES, in_flight: int = INGEST_IN_FLIGHT) -> IngestReport:
+    '''
+    Retry the dead letters only, see replay_plan().
+
+    Return:
+        IngestReport of the replay
+    '''
+    report = IngestReport()
+    writes = replay_plan(dead, state, report)
+    return _write(client, writes, indices, state, report, dead, None, INGEST_CHECKPOINT, batch_docs, batch_bytes, in_flight)
+
+def _write(client, writes, indices, state, report, dead, progress, checkpoint, batch_docs, batch_bytes, in_flight):
+    pending = deque()
+    batch, size = [], 0
+    error = None
+    saved = time.perf_counter()
+
+    def confirm():
+        nonlocal error, saved
+        sent, future, handled = pending.popleft()
+        try:
+            results = future.result()
+        except exceptions.TransportError as e:
+            # not written: the state does not list them, so the next sync retries them
+            error = error or e
+            return
+        report.add(sent, results, state, dead)
+        if progress is not None and error is None:
+            state.checkpoint(handled)
+            if time.perf_counter() - saved >= checkpoint:
+                state.save()
+                if dead is not None:
+                    dead.save()
+                saved = time.perf_counter()
+
+    def send():
+        pending.append((batch, pool.submit(send_batch, client, batch), dict(progress or {})))
+
+    with ThreadPoolExecutor(max_workers = in_flight) as pool:
+        try:
+            for write in writes:
+                kind, index, _, doc, _ = write
+                if kind != 'removed':
+                    indices.ensure(client, index)
+                    size += len(json.dumps(doc))
+                batch.append(write)
+                if len(batch) >= batch_docs or size >= batch_bytes:
+                    send()
+                    batch, size = [], 0
+                    if len(pending) >= in_flight:
+                        confirm()
+                if error is not None:
+                    break
+            else:
+                if batch:
+                    send()
+        except BaseException as e:
+            error = e
+        # record what was sent even when the sync failed
+        while pending:
+            confirm()
+    if error is not None:
+        raise error
+    if progress is not None:
+        state.checkpoint({})
+    return report.finish()
@@ -0,0 +1,107 @@
+'''
+Stand-in for the content registry (content-api), serving generated models, apps and workflows.
+
+Runs the Mining job, or exercises its fetch stage, without the real registry:
+
+    python local_registry.py [--items 1000] [--page-size 0] [--port 8000] [--latency 0] [--invalid 0]
+    REGISTRY_URL=http://localhost:8000/api/v0/ python update_db.py
+
+GET /api/v0/{category} returns a JSON array, streamed in small chunks. It honours the offset
+paging parameters (REGISTRY_PAGE_PARAMS, skip and limit by default). With --page-size it also
+pages on its own and links each page to the next one with a Link rel="next" header. Whole
+categories carry an ETag and are answered with 304 Not Modified when it matches If-None-Match.
+'''
+import argparse
+import asyncio
+import json
+
+from aiohttp import web
+
+from registry import REGISTRY_PAGE_PARAMS
+
+CATEGORIES = {'models': 'model', 'apps': 'app', 'workflows': 'workflow'}
+CHUNK_BYTES = 4096
+
+def make_item(content_type: str, i: int, revision: int = 0) -> dict:
+    return {'name': f'{content_type} {i}',
+            'version': f'1.{revision}',
+            'type': 'supervised' if i % 2 else 'unsupervised',
+            'uri': f'mlexchange/{content_type}-{i}:latest',
+            'application': ['segmentation' if i % 3 else 'classification'],
+            'reference': f'https://example.org/{content_type}/{i}',
+            'description': f'Generated {content_type} number {i} for the local registry',
+            'content_type': content_type,
+            'content_id': f'{content_type}-{i}',
+            'owner': f'owner {i % 7}',
+            'public': True}
+
+def make_app(items: int = 1000, page_size: int = 0, latency: float = 0, revision: int = 0, invalid: int = 0) -> web.Application:
+    '''
+    Args:
+        items: items per category
+        page_size: items per page when paging with Link headers, 0 serves whole categories
+        latency: seconds waited before each response
+        revision: changes the version of every item, to simulate registry updates
+        invalid: malformed items spread over each category (without content_type, or not an object)
+    '''
+    registry = {name: [make_item(content_type, i, revision) for i in range(items)] for name, content_type in CATEGORIES.items()}
+    for listed in registry.values():
+        for i in range(invalid):
+            bad = dict(make_item('broken', i, revision), content_type = None) if i % 2 else f'broken item {i}'
+            listed.insert((i + 1) * len(listed) // (invalid + 1), bad)
+    offset_param, size_param = REGISTRY_PAGE_PARAMS
+
+    async def category(request: web.Request) -> web.StreamResponse:
+        name = request.match_info['category']
+        if name not in registry:
+            raise web.HTTPNotFound()
+        await asyncio.sleep(latency)
+        listed = registry[name]
+        if size_param in request.query:
+            start = int(request.query.get(offset_param, 0))
+            listed = listed[start:start + int(request.query[size_param])]
+        resp = web.StreamResponse(headers = {'Content-Type': 'application/json'})
+        if not page_size and size_param not in request.query:
+            etag = f'"{name}-{items}-{revision}-{invalid}"'
+            if request.headers.get('If-None-Match') == etag:
+                return web.Response(status = 304, headers = {'ETag': etag})
+            resp.headers['ETag'] = etag
+        if page_size and size_param not in request.query:
+            page = int(request.query.get('page', 0))
+            listed = listed[page * page_size:(page + 1) * page_size]
+            if (page + 1) * page_size < len(registry[name]):
+                resp.headers['Link'] = f'<{request.url.with_query(page = page + 1)}>; rel="next"'
+        await resp.prepare(request)
+        body = json.dumps(listed).encode()
+        for start in range(0, len(body), CHUNK_BYTES):
+            await resp.write(body[start:start + CHUNK_BYTES])
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_get('/api/v0/{category}', category)
+    return app
+
+async def start(app: web.Application, port: int = 8000) -> web.AppRunner:
+    '''
+    Serve the stand-in from the running event loop; stop it with `await runner.cleanup()`.
+    '''
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    return runner
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[1])
+    parser.add_argument('--items', type = int, default = 1000, help = 'items per category')
+    parser.add_argument('--page-size', type = int, default = 0, help = 'page with Link headers, 0 disables')
+    parser.add_argument('--latency', type = float, default = 0, help = 'seconds before each response')
+    parser.add_argument('--revision', type = int, default = 0, help = 'version suffix of every item')
+    parser.add_argument('--invalid', type = int, default = 0, help = 'malformed items per category')
+    parser.add_argument('--port', type = int, default = 8000)
+    args = parser.parse_args()
+    web.run_app(make_app(args.items, args.page_size, args.latency, args.revision, args.invalid), port = args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+import asyncio
+import json
+import os
+import queue
+import threading
+
+import aiohttp
+
+from ingest import item_key
+
+#-----Registry Settings------#
+# The categories are fetched concurrently over one pooled HTTP session. Each response is
+# parsed as it arrives and its items are handed to the indexing stage through a bounded
+# queue, so neither a whole category list nor the whole registry is ever held in memory.
+REGISTRY_URL         = os.getenv('REGISTRY_URL', 'http://content-api:8000/api/v0/')
+REGISTRY_CONNECTIONS = int(os.getenv('REGISTRY_CONNECTIONS', 8))       # pooled connections to the registry
+REGISTRY_TIMEOUT     = float(os.getenv('REGISTRY_TIMEOUT', 60))        # seconds without data before a request fails
+REGISTRY_PAGE_SIZE   = int(os.getenv('REGISTRY_PAGE_SIZE', 0))         # items per page, 0 fetches each category at once
+REGISTRY_PAGE_PARAMS = os.getenv('REGISTRY_PAGE_PARAMS', 'skip,limit').split(',')  # offset and page size query parameters
+REGISTRY_QUEUE       = int(os.getenv('REGISTRY_QUEUE', 1000))          # items buffered ahead of the indexing stage
+REGISTRY_CHUNK_BYTES = 64 * 2**10
+
+_DONE = object()
+
+class _Stopped(Exception):
+    pass
+
+#-----Streaming JSON------#
+async def iter_json_array(chunks):
+    '''
+    Parse a JSON array from a stream of byte chunks, one element at a time.
+
+    Args:
+        chunks: async iterator of bytes, e.g. ClientResponse.content.iter_chunked()
+    Return:
+        async generator of the array elements
+    Raise:
+        ValueError when the stream is not a JSON array
+    '''
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    ended = False
+    separated = True        # an element may follow: after "[" or ","
+    count = 0
+    pending = b''
+    chunks = chunks.__aiter__()
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos < len(buf):
+            if ended:
+                raise ValueError(f'Unexpected data after the JSON array: {buf[pos:pos + 20]!r}')
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f'Expected a JSON array, got {buf[pos:pos + 20]!r}')
+                started = True
+                pos += 1
+                continue
+            if not separated:
+                if buf[pos] not in ',]':
+                    raise ValueError(f'Expected "," or "]" in the JSON array, got {buf[pos:pos + 20]!r}')
+                ended = buf[pos] == ']'
+                separated = buf[pos] == ','
+                pos += 1
+                continue
+            if buf[pos] == ']' and not count:
+                ended = True
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a number ending the buffer, or before "." or an exponent, may continue in the next chunk
+                if eof or (end < len(buf) and buf[end] not in '.eE+-'):
+                    yield item
+                    count += 1
+                    pos = end
+                    separated = False
+                    continue
+        elif eof:
+            if ended:
+                return
+            raise ValueError('JSON array ended early')
+        # need more data: drop what was consumed and append the next chunk
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            eof = True
+            chunk = b''
+        pending += chunk
+        try:
+            text = pending.decode()
+            pending = b''
+        except UnicodeDecodeError as e:
+            if eof:
+                raise ValueError(f'Invalid UTF-8 in the registry response: {e}')
+            # a multi-byte character split across chunks
+            text, pending = pending[:e.start].decode(), pending[e.start:]
+        buf = buf[pos:] + text
+        pos = 0
+
+#-----Fetching------#
+class Validators:
+    '''
+    ETag and Last-Modified of the last response of each category that came in one page, sent
+    back on the next fetch so an unchanged category is answered with 304 Not Modified instead
+    of its whole list. A sync passes the indices of those categories to the indexing stage,
+    which keeps their documents since none of them was listed.
+
+    The validators of a fetch only take effect once commit() confirms that its items were
+    indexed, so a sync that failed lists the categories in full again.
+    '''
+    def __init__(self):
+        self._validators = {}       # url -> (request headers, indices of the category)
+        self._fetched = {}          # validators of the current fetch, until committed
+        self.unchanged = set()      # indices of the categories answered with 304 by the last fetch
+
+    def headers(self, url: str) -> dict:
+        return self._validators.get(url, ({}, set()))[0]
+
+    def store(self, url: str, resp: aiohttp.ClientResponse, indices: set):
+        headers = {}
+        if resp.headers.get('ETag'):
+            headers['If-None-Match'] = resp.headers['ETag']
+        if resp.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = resp.headers['Last-Modified']
+        self._fetched[url] = (headers, indices) if headers else None
+
+    def not_modified(self, url: str):
+        self.unchanged |= self._validators[url][1]
+
+    def reset(self):
+        self._fetched.clear()
+        self.unchanged.clear()
+
+    def commit(self):
+        for url, validators in self._fetched.items():
+            if validators:
+                self._validators[url] = validators
+            else:
+                self._validators.pop(url, None)
+        self._fetched.clear()
+
+def _field(item, key: str):
+    return item.get(key) if isinstance(item, dict) else None
+
+def _next_link(resp: aiohttp.ClientResponse) -> str:
+    link = resp.links.get('next')
+    return str(link['url']) if link else None
+
+async def _pages(session: aiohttp.ClientSession, url: str, page_size: int, validators: Validators, offset: int):
+    '''
+    Stream the items of one registry category from `offset` on, see fetch_category().
+    '''
+    offset_param, size_param = REGISTRY_PAGE_PARAMS
+    category_url = url
+    first_id = None
+    pages = 0
+    indices = set()
+    while url:
+        params = {offset_param: offset, size_param: page_size} if page_size else None
+        conditional = validators is not None and url == category_url and not offset
+        headers = validators.headers(url) if conditional else None
+        async with session.get(url, params = params, headers = headers) as resp:
+            if resp.status == 304 and headers:
+                validators.not_modified(url)
+                return
+            resp.raise_for_status()
+            count = 0
+            async for item in iter_json_array(resp.content.iter_chunked(REGISTRY_CHUNK_BYTES)):
+                if count == 0 and page_size and pages:
+                    # a registry ignoring the page parameters sends the first page again
+                    if first_id is not None and _field(item, 'content_id') == first_id:
+                        return
+                elif count == 0 and not pages:
+                    first_id = _field(item, 'content_id')
+                count += 1
+                indices.add(_field(item, 'content_type'))
+                yield item
+            pages += 1
+            following = _next_link(resp)
+            if conditional:
+                single_page = not following and not (page_size and count == page_size)
+                if single_page:
+                    validators.store(url, resp, indices)
+        if following:
+            url, page_size = following, 0
+        elif page_size and count == page_size:
+            offset += page_size
+        else:
+            url = None
+
+async def fetch_category(session: aiohttp.ClientSession, url: str, page_size: int = REGISTRY_PAGE_SIZE,
+                         validators: Validators = None, start: dict = None):
+    '''
+    Stream the items of one registry category, following its pagination: a Link rel="next"
+    header when the registry sends one, otherwise offset pages of page_size items (when set)
+    until a page comes back short.
+
+    Args:
+        validators: conditional request state, nothing is yielded when the category did not change
+        start: checkpoint of an interrupted sync, {"after": item_key of the last item handled,
+               "items": items handled}. The items up to that one are left out. When paging by
+               offset they are not fetched, provided the item is still at the same position.
+               When the registry no longer lists it, the whole category is yielded.
+    Return:
+        async generator of registry items
+    '''
+    if not start:
+        async for item in _pages(session, url, page_size, validators, 0):
+            yield item
+        return
+    after = start['after']
+    offset = max(start['items'] - 1, 0) if page_size else 0
+    while True:
+        found = False
+        items = _pages(session, url, page_size, None, offset)
+        try:
+            async for item in items:
+                if found:
+                    yield item
+                elif item_key(item) == after:
+                    found = True
+                elif offset:
+                    break       # the registry order changed: look for the item from the start
+        finally:
+            await items.aclose()
+        if found:
+            return
+        if offset:
+            offset = 0
+            continue
+        break
+    print(f'Resumed category {url} no longer lists its checkpoint item {after}, reading all of it')
+    async for item in _pages(session, url, page_size, None, 0):
+        yield item
+
+async def _produce(url_head: str, categories: list, items: queue.Queue, stop: threading.Event, validators: Validators,
+                   start: dict):
+    async def put(item):
+        while not stop.is_set():
+            try:
+                items.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+        raise _Stopped()
+
+    async def category(session, name):
+        async for item in fetch_category(session, url_head + name, validators = validators, start = start.get(name)):
+            await put((name, item))
+
+    timeout = aiohttp.ClientTimeout(total = None, sock_connect = REGISTRY_TIMEOUT, sock_read = REGISTRY_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit = REGISTRY_CONNECTIONS)
+    try:
+        async with aiohttp.ClientSession(connector = connector, timeout = timeout) as session:
+            await asyncio.gather(*(category(session, name) for name in categories))
+        result = _DONE
+    except _Stopped:
+        return
+    except Exception as e:
+        result = e
+    while not stop.is_set():
+        try:
+            items.put(result, timeout = 0.1)
+            return
+        except queue.Full:
+            pass
+
+def stream_registry(url_head: str = REGISTRY_URL, categories: list = ('models', 'apps', 'workflows'),
+                    validators: Validators = None, start: dict = None):
+    '''
+    Fetch every category concurrently on a background event loop and yield their items,
+    interleaved, as they are parsed. Reading pauses while REGISTRY_QUEUE items are waiting.
+
+    Args:
+        validators: conditional request state kept between syncs; its unchanged indices are
+                    complete once the generator is exhausted
+        start: {category: checkpoint} of an interrupted sync, see fetch_category()
+
+    Return:
+        generator of (category, registry item)
+    Raise:
+        the first error of any category fetch, once the items received before it were yielded
+    '''
+    items = queue.Queue(maxsize = REGISTRY_QUEUE)
+    stop = threading.Event()
+    if validators is not None:
+        validators.reset()
+    producer = threading.Thread(target = lambda: asyncio.run(_produce(url_head, list(categories), items, stop, validators,
+                                                                      start or {})),
+                                name = 'registry-fetch', daemon = True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join(timeout = 5)
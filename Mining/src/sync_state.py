@@ -0,0 +1,114 @@
+import json
+import os
+
+from ingest import digest, KEYS
+
+#-----Sync State Settings------#
+# The digest of every document the Mining job indexed, per index, so the next run only writes
+# the registry items that are new or changed and deletes the ones that disappeared. The file
+# lives next to the job (Mining/src is mounted into the container) and holds a 16 hex digit
+# digest per document, and the checkpoints of a sync that did not complete.
+MINING_STATE_PATH = os.getenv('MINING_STATE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state', 'sync_state.json'))
+STATE_VERSION = 1
+VERIFY_PAGE   = 1000    # documents read back per mget when rebuilding the state of an index
+
+class SyncState:
+    '''
+    Digests of the documents the Mining job wrote, as {index: {document id: digest}}, and the
+    last item of each category handled by an interrupted sync, as {category: {"after": item
+    key, "items": items handled}}.
+    '''
+    def __init__(self, path: str = MINING_STATE_PATH, indices: dict = None, checkpoints: dict = None):
+        self.path = path
+        self.indices = indices or {}
+        self.checkpoints = checkpoints or {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str = MINING_STATE_PATH):
+        '''
+        Read the state file, or start empty when it is missing, unreadable or of another version.
+        '''
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == STATE_VERSION:
+                return cls(path, data['indices'], data.get('checkpoints'))
+            print(f'Ignoring sync state {path} of version {data.get("version")}')
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError) as e:
+            print(f'Ignoring unreadable sync state {path}: {e}')
+        return cls(path)
+
+    def save(self):
+        '''
+        Write the state file atomically, so an interrupted run leaves the previous one intact.
+        Nothing is written when the state did not change.
+        '''
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'indices': self.indices, 'checkpoints': self.checkpoints}, f,
+                      separators = (',', ':'))
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def get(self, index: str, doc_id: str) -> str:
+        return self.indices.get(index, {}).get(doc_id)
+
+    def set(self, index: str, doc_id: str, value: str):
+        self.indices.setdefault(index, {})[doc_id] = value
+        self.dirty = True
+
+    def discard(self, index: str, doc_id: str):
+        self.indices.get(index, {}).pop(doc_id, None)
+        self.dirty = True
+
+    def checkpoint(self, progress: dict):
+        if progress != self.checkpoints:
+            self.checkpoints = dict(progress)
+            self.dirty = True
+
+    def ids(self, index: str) -> set:
+        return set(self.indices.get(index, {}))
+
+    def __len__(self):
+        return sum(len(docs) for docs in self.indices.values())
+
+    def verify(self, client) -> list:
+        '''
+        Check the state against elasticsearch: an index that is gone, or holds fewer documents
+        than the state lists, was changed behind the job's back. The state of such an index is
+        rebuilt by reading back the documents it lists, so missing documents are indexed again
+        and edited ones rewritten. Documents the job did not write are never adopted.
+
+        The document counts of all indices come from one _cat/indices call, so a sync that finds
+        nothing changed costs a single request here.
+
+        Return:
+            the indices whose state was rebuilt
+        '''
+        listed = [index for index, docs in self.indices.items() if docs]
+        if not listed:
+            return []
+        counts = {row['index']: int(row['docs.count'] or 0)
+                  for row in client.cat.indices(format = 'json', h = 'index,docs.count')}
+        rebuilt = []
+        for index in listed:
+            docs = self.indices[index]
+            if index not in counts:
+                self.indices[index] = {}
+            elif counts[index] < len(docs):
+                ids, found = list(docs), {}
+                for start in range(0, len(ids), VERIFY_PAGE):
+                    resp = client.mget(index = index, body = {'ids': ids[start:start + VERIFY_PAGE]}, _source_includes = KEYS)
+                    found.update((doc['_id'], digest(doc['_source'])) for doc in resp['docs'] if doc.get('found'))
+                self.indices[index] = found
+            else:
+                continue
+            rebuilt.append(index)
+            self.dirty = True
+        return rebuilt
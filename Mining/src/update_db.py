@@ -1,50 +1,96 @@
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search, Index, Document
+from elasticsearch import Elasticsearch, exceptions
 import json
-import urllib.request
+import os
+import sys
+import time
 from ssl import create_default_context
 
-cert = create_default_context(cafile = '/app/mining/src/certs/ca/ca.crt')
-es = Elasticsearch('https://es01:9200',
-                    http_auth=('elastic','elastic'),
-                    ssl_context=cert)
+from daemon import run_daemon
+from dead_letter import DeadLetters
+from ingest import ingest, replay, IndexCache, INGEST_IN_FLIGHT
+from registry import stream_registry, Validators, REGISTRY_URL
+from sync_state import SyncState
 
-#-----Define editing functions------#
-def create_index(index: str):
+#-----Elasticsearch connection------#
+# Same variables as the search-api; the client is only built when first needed, so importing
+# this module works without the cluster or its certificates.
+ES_HOSTS    = os.getenv('ES_HOSTS', 'https://es01:9200').split(',')
+ES_USER     = os.getenv('ES_USER', 'elastic')
+ES_PASSWORD = os.getenv('ES_PASSWORD', 'elastic')
+ES_CA_CERTS = os.getenv('ES_CA_CERTS', '/app/mining/src/certs/ca/ca.crt')
+ES_WAIT     = float(os.getenv('ES_WAIT', 300))     # seconds to wait for the cluster at startup
+ES_RETRY    = float(os.getenv('ES_RETRY', 5))      # seconds between connection attempts
+_es = None
+
+def get_es() -> Elasticsearch:
     '''
-    Check if the index exists, if not, add the given index
+    The elasticsearch client, built on first use.
     '''
-    try:
-        resp = Index(index).create(using = es)
-        return [f'Index: \"{index}\" has been successfully created!', resp]
+    global _es
+    if _es is None:
+        kwargs = {'http_auth': (ES_USER, ES_PASSWORD), 'maxsize': INGEST_IN_FLIGHT}
+        if ES_CA_CERTS:
+            kwargs['ssl_context'] = create_default_context(cafile = ES_CA_CERTS)
+        _es = Elasticsearch(ES_HOSTS, **kwargs)
+    return _es
 
-    except Exception as e:
-        return f'Index: \"{index}\" already exists, please check.'
+def warm_up(indices: list, wait: float = ES_WAIT) -> dict:
+    '''
+    Wait until elasticsearch answers (and its certificates exist), then open the connection
+    and run a cheap query against each existing registry index.
 
-def create_doc(index: str, id: str, doc: dict):
+    Return:
+        dict of timings in seconds: client build, until the cluster answered, index queries
+    Raise:
+        the last connection error when the cluster did not answer within `wait` seconds
     '''
-    Check if the doc exists within the given index, then add/update doc to the index.
+    start = time.perf_counter()
+    deadline = start + wait
+    timings = {}
+    while True:
+        try:
+            es = get_es()
+            timings.setdefault('client', time.perf_counter() - start)
+            es.info()
+            break
+        except (exceptions.ElasticsearchException, OSError) as e:
+            if time.perf_counter() + ES_RETRY > deadline:
+                raise
+            print(f'Elasticsearch not reachable yet ({type(e).__name__}: {e}), retrying in {ES_RETRY}s')
+            time.sleep(ES_RETRY)
+    timings['connected'] = time.perf_counter() - start
+    queried = time.perf_counter()
+    es.search(index = ','.join(indices), body = {'size': 0, 'track_total_hits': False}, ignore_unavailable = True)
+    timings['indices'] = time.perf_counter() - queried
+    return timings
+
+#-----Index template------#
+# registry_template.json lives in FastAPI/src, so Mining creates the same mappings as the API. The
+# default path is the repository layout; the compose files mount the file at the matching place
+# in the container (/app/FastAPI/src).
+template_path = os.getenv('INDEX_TEMPLATE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                             '..', '..', 'FastAPI', 'src', 'registry_template.json'))
+template_name = os.getenv('INDEX_TEMPLATE_NAME', 'mlex-registry')
+template = None
+
+def load_template() -> dict:
     '''
-    check_index = Index(index).exists(using = es)
-    if not check_index:
-        return f'Index: \"{index}\" does not exist, please check.'
-    else:
-        check_doc = Document().exists(using = es, index = index, id = id)
-        if check_doc:
-            es.index(index = index, id = id, document = doc)
-            return 'UID: \"' + id + '\" has been updated.'
-        else:
-            es.index(index = index, id = id, document = doc)
-            return f'New document has been successfully inserted in \"{index}\".'
-
-#-----Content Registry API calls-----#
-def content_list_GET_call(url):
-    """
-    Get the whole model registry data from the fastapi url.
-    """
-    response = urllib.request.urlopen(url)
-    data = json.loads(response.read())
-    return data
+    Read the registry index template on first use and apply the shard/replica/refresh overrides.
+    '''
+    global template
+    if template is None:
+        try:
+            with open(template_path) as f:
+                loaded = json.load(f)
+        except FileNotFoundError:
+            raise FileNotFoundError(f'Index template not found at {template_path}: mount FastAPI/src/registry_template.json '
+                                    f'there or set INDEX_TEMPLATE_PATH')
+        for setting, env in (('number_of_shards', 'INDEX_SHARDS'), ('number_of_replicas', 'INDEX_REPLICAS'),
+                             ('refresh_interval', 'INDEX_REFRESH_INTERVAL')):
+            if os.getenv(env):
+                loaded['template']['settings'][setting] = os.getenv(env)
+        template = loaded
+    return template
 
 #-----Testing Database-----#
 # with open('database.json') as json_file:
@@ -53,25 +99,94 @@ def content_list_GET_call(url):
 # # Convert string to dict    
 # database = json.loads(database)
 
-# for key, values in database.items():
-#     create_index(key)
-#     for item in values:
-#         create_doc(key, item['uid'], item)
+# ingest(get_es(), ((name, item) for name, values in database.items() for item in values), IndexCache(load_template()['template']), SyncState.load())
 
 #-----Content Registry-----#
-keys = ["name", "version", "type", "uri", "application", "reference", "description", "content_type", "content_id", "owner"]
-url_head = 'http://content-api:8000/api/v0/'
-catagory = ['models', 'apps', 'workflows']
-
-for item in catagory:
-    url = url_head + item
-    for model in content_list_GET_call(url):
-        create_index(model['content_type'])
-        content_data = {}
-        for key, value in model.items():
-            if key in keys:
-                content_data[key] = value
-        create_doc(content_data['content_type'], content_data['content_id'], content_data)        
-
-for h in Search().using(es).scan():
-    print(h)
\ No newline at end of file
+# registry category -> index its items go to (their content_type), like REGISTRY_CONTENT_TYPES of the search-api
+CATEGORY_INDEX = {'models': 'model', 'apps': 'app', 'workflows': 'workflow'}
+catagory = list(CATEGORY_INDEX)
+MINING_MODE      = os.getenv('MINING_MODE', 'once')     # "daemon" keeps syncing (see daemon.py), "replay" retries the dead letters
+MINING_FULL_SYNC = os.getenv('MINING_FULL_SYNC', '').lower() in ('1', 'true')  # rewrite unchanged items too
+
+def prepare(wait: float = ES_WAIT):
+    '''
+    Wait for elasticsearch and install the index template.
+    '''
+    timings = warm_up(list(CATEGORY_INDEX.values()), wait)
+    print('Elasticsearch ready: ' + ', '.join(f'{name} {seconds:.3f}s' for name, seconds in timings.items()))
+    get_es().indices.put_index_template(name = template_name, body = load_template())
+
+def sync(state: SyncState, dead: DeadLetters, validators: Validators = None, full: bool = MINING_FULL_SYNC):
+    '''
+    Sync the registry into elasticsearch once and save the state and the dead letters. A sync
+    interrupted before is resumed after its checkpoints.
+
+    Args:
+        validators: conditional request state kept between syncs, unchanged categories are
+                    neither fetched nor diffed
+        full: rewrite unchanged items too
+    Return:
+        IngestReport of the sync
+    '''
+    rebuilt = state.verify(get_es())
+    if rebuilt:
+        print(f'Indices changed since the last sync, checking them again: {", ".join(rebuilt)}')
+        state.checkpoint({})
+    # a rebuilt index needs its category listed again, even if the registry did not change
+    validators = None if full or rebuilt else validators
+    start = state.checkpoints
+    if start:
+        print('Resuming the interrupted sync after ' + ', '.join(f'{name} {checkpoint["after"]} ({checkpoint["items"]} items)'
+                                                             for name, checkpoint in start.items()))
+    # documents listed before the checkpoints were not listed again, they are only pruned by a complete sync
+    keep = {CATEGORY_INDEX[name] for name in start}
+
+    def entries():
+        yield from stream_registry(REGISTRY_URL, catagory, validators, start)
+        if validators is not None:
+            keep.update(validators.unchanged)
+    try:
+        report = ingest(get_es(), entries(), IndexCache(load_template()['template']), state, full = full, keep = keep,
+                        dead = dead, start = start)
+        dead.sweep([name for name in catagory if CATEGORY_INDEX[name] not in keep])
+        if validators is not None and not report.failed:
+            validators.commit()
+        return report
+    finally:
+        state.save()
+        dead.save()
+
+def replay_dead_letters(state: SyncState, dead: DeadLetters):
+    '''
+    Retry the dead letters only and save the state and the dead letters.
+
+    Return:
+        IngestReport of the replay
+    '''
+    try:
+        return replay(get_es(), dead, IndexCache(load_template()['template']), state)
+    finally:
+        state.save()
+        dead.save()
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else MINING_MODE
+    state = SyncState.load()
+    dead = DeadLetters.load()
+    if mode == 'daemon':
+        validators = Validators()
+        prepared = []
+
+        def cycle():
+            if not prepared:
+                prepare(wait = 0)       # fail fast, the daemon backs off between attempts
+                prepared.append(True)
+            return sync(state, dead, validators)
+        run_daemon(cycle)
+    else:
+        prepare()
+        report = replay_dead_letters(state, dead) if mode == 'replay' else sync(state, dead)
+        print(report.summary())
+        if len(dead):
+            print(f'{len(dead)} items in the dead letter file {dead.path}, {len(dead.retries())} of them may '
+                  'succeed on a retry with "python update_db.py replay"')
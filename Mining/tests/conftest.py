@@ -0,0 +1,143 @@
+import asyncio
+import os
+import sys
+import threading
+import types
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from elasticsearch import exceptions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import registry
+
+#-----Registry------#
+@pytest.fixture
+def serve():
+    '''
+    Serve aiohttp apps from a background event loop, so both the registry fetch (which runs
+    its own loop) and tests calling asyncio.run() can reach them.
+
+    Return:
+        function taking an app and returning its base URL
+    '''
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target = loop.run_forever, daemon = True)
+    thread.start()
+    servers = []
+
+    def start(app) -> str:
+        server = TestServer(app)
+        asyncio.run_coroutine_threadsafe(server.start_server(), loop).result()
+        servers.append(server)
+        return str(server.make_url('/'))
+
+    yield start
+    for server in servers:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+async def _chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+def parse(data: bytes, size: int = 64) -> list:
+    async def collect():
+        return [item async for item in registry.iter_json_array(_chunked(data, size))]
+    return asyncio.run(collect())
+
+def fetch(url: str, page_size: int = 0, **kwargs) -> list:
+    async def collect():
+        async with aiohttp.ClientSession() as session:
+            return [item async for item in registry.fetch_category(session, url, page_size, **kwargs)]
+    return asyncio.run(collect())
+
+def listing(items: list, paged: bool = True) -> web.Application:
+    '''
+    A registry serving `items` at /models, honouring the offset paging parameters when `paged`.
+    '''
+    offset_param, size_param = registry.REGISTRY_PAGE_PARAMS
+
+    async def category(request: web.Request) -> web.Response:
+        listed = items
+        if paged and size_param in request.query:
+            start = int(request.query[offset_param])
+            listed = listed[start:start + int(request.query[size_param])]
+        return web.json_response(listed)
+
+    app = web.Application()
+    app.router.add_get('/models', category)
+    return app
+
+def ids(items: list) -> list:
+    return [item['content_id'] for item in items]
+
+#-----Elasticsearch------#
+
+class FakeES:
+    '''
+    The part of the elasticsearch client the Mining job uses: bulk writes and deletes, index
+    creation, and the reads checking the sync state. Set `fail_at` to raise ConnectionError on that bulk call (1-based), `reject` to answer
+    {document id: status} for some documents.
+    '''
+    def __init__(self):
+        self.docs = {}          # (index, id) -> document
+        self.written = []       # (index, id) of every write, in order
+        self.created = []       # indices created, in order
+        self.batches = []       # documents per bulk call
+        self.calls = 0
+        self.fail_at = None
+        self.reject = {}
+        self.listings = 0       # _cat/indices calls
+        self.indices = self
+        self.cat = types.SimpleNamespace(indices = self.cat_indices)
+
+    def create(self, index: str, body: dict):
+        if index in self.created:
+            raise exceptions.RequestError(400, 'resource_already_exists_exception', {})
+        self.created.append(index)
+
+    def bulk(self, body: list):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise exceptions.ConnectionError('N/A', 'elasticsearch down', None)
+        items, lines = [], iter(body)
+        for action in lines:
+            kind, meta = next(iter(action.items()))
+            key = (meta['_index'], meta['_id'])
+            item = {'_index': key[0], '_id': key[1]}
+            doc = next(lines) if kind == 'index' else None
+            if key[1] in self.reject:
+                item.update(status = self.reject[key[1]], error = {'type': 'rejected', 'reason': 'rejected'})
+            elif kind == 'index':
+                item.update(status = 200 if key in self.docs else 201, result = 'updated' if key in self.docs else 'created')
+                self.docs[key] = doc
+                self.written.append(key)
+            elif self.docs.pop(key, None) is None:
+                item.update(status = 404, result = 'not_found')
+            else:
+                item.update(status = 200, result = 'deleted')
+            items.append({kind: item})
+        self.batches.append(len(items))
+        return {'errors': any('error' in next(iter(item.values())) for item in items), 'items': items}
+
+    def cat_indices(self, format: str, h: str) -> list:
+        self.listings += 1
+        names = set(self.created) | {index for index, _ in self.docs}
+        return [{'index': name, 'docs.count': str(sum(key[0] == name for key in self.docs))} for name in sorted(names)]
+
+    def mget(self, index: str, body: dict, _source_includes: list = None) -> dict:
+        docs = [{'_index': index, '_id': doc_id, 'found': (index, doc_id) in self.docs} for doc_id in body['ids']]
+        for doc in docs:
+            if doc['found']:
+                doc['_source'] = self.docs[(index, doc['_id'])]
+        return {'docs': docs}
+
+@pytest.fixture
+def es():
+    return FakeES()
@@ -0,0 +1,111 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import daemon
+from daemon import backoff, run_daemon, serve, SyncMetrics
+from ingest import IngestReport
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def report(failed: int = 0, added: int = 0) -> IngestReport:
+    report = IngestReport()
+    report.failed = failed
+    report.counts['added'] = added
+    return report.finish()
+
+#-----Backoff------#
+def test_backoff_doubles_up_to_the_cap():
+    top = lambda low, high: high
+    assert [backoff(failures, 5, 60, top) for failures in range(1, 7)] == [5, 10, 20, 40, 60, 60]
+    bottom = lambda low, high: low
+    assert [backoff(failures, 5, 60, bottom) for failures in range(1, 4)] == [2.5, 5, 10]
+
+def test_backoff_jitter_stays_in_the_upper_half():
+    for _ in range(100):
+        assert 10 <= backoff(3, 5, 60) <= 20
+
+#-----Sync Loop------#
+@pytest.fixture
+def waits(monkeypatch):
+    '''
+    The failure counts run_daemon backed off for, without waiting.
+    '''
+    seen = []
+    monkeypatch.setattr(daemon, 'backoff', lambda failures: seen.append(failures) or 0)
+    return seen
+
+def run(outcomes: list, metrics: SyncMetrics = None) -> SyncMetrics:
+    '''
+    Run the daemon loop over `outcomes`, a report or an exception per sync, until they run out.
+    '''
+    metrics = metrics or SyncMetrics()
+    stop = threading.Event()
+    outcomes = iter(outcomes)
+
+    def sync():
+        outcome = next(outcomes, None)
+        if outcome is None:
+            stop.set()
+            return report()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    run_daemon(sync, interval = 0, port = 0, metrics = metrics, stop = stop)
+    return metrics
+
+def test_failed_syncs_back_off_until_one_succeeds(waits):
+    metrics = run([ConnectionError('registry down'), ConnectionError('registry down'), report(added = 3),
+                   ConnectionError('elasticsearch down')])
+    assert waits == [1, 2, 1]
+    assert metrics.syncs == {'success': 2, 'failure': 3} and metrics.failures == 0
+    assert metrics.docs['added'] == 3
+
+def test_failed_documents_do_not_fail_the_sync(waits):
+    # they are left to the dead letters
+    metrics = run([report(failed = 2)])
+    assert waits == []
+    assert metrics.syncs == {'success': 2, 'failure': 0} and metrics.docs['failed'] == 2
+
+#-----Metrics------#
+def test_lag_counts_from_the_last_successful_start():
+    clock = Clock()
+    metrics = SyncMetrics(clock)
+    clock.now += 30
+    assert metrics.lag() == 30
+    metrics.success(clock.now, report(added = 1))
+    clock.now += 5
+    metrics.failure(clock.now)
+    clock.now += 5
+    assert metrics.lag() == 10 and metrics.failures == 1
+    text = metrics.render()
+    assert 'mining_sync_lag_seconds 10.0' in text
+    assert 'mining_syncs_total{outcome="failure"} 1' in text
+    assert 'mining_documents_total{result="added"} 1' in text
+    assert 'mining_last_success_timestamp_seconds 1030.0' in text
+
+#-----HTTP Endpoint------#
+def test_endpoint_schedules_syncs_and_serves_metrics():
+    wake = threading.Event()
+    server = serve(0, SyncMetrics(), wake)
+    url = f'http://localhost:{server.server_address[1]}'
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + '/sync', method = 'POST')) as resp:
+            assert resp.status == 202 and wake.is_set()
+        with urllib.request.urlopen(url + '/metrics') as resp:
+            assert b'# TYPE mining_sync_lag_seconds gauge' in resp.read()
+        with urllib.request.urlopen(url + '/healthz') as resp:
+            assert resp.status == 200
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/missing')
+        assert e.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
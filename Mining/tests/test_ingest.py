@@ -0,0 +1,170 @@
+import pytest
+from elasticsearch import exceptions
+
+import local_registry
+from conftest import fetch, listing, ids
+from dead_letter import DeadLetters
+from ingest import ingest, replay, transform, IndexCache
+from registry import stream_registry
+from sync_state import SyncState
+
+def item(i: int, content_type: str = 'model', **fields) -> dict:
+    return dict({'content_id': f'{content_type}-{i}', 'content_type': content_type, 'name': f'{content_type} {i}',
+                 'owner': 'mlexchange team'}, **fields)
+
+def listed(items):
+    '''
+    The items as the registry stream yields them, with the category of their content_type.
+    '''
+    return ((f'{item.get("content_type", "model")}s' if isinstance(item, dict) else 'models', item) for item in items)
+
+def models(n: int) -> list:
+    return [('models', local_registry.make_item('model', i)) for i in range(n)]
+
+@pytest.fixture
+def state(tmp_path):
+    return SyncState(str(tmp_path / 'sync_state.json'))
+
+@pytest.fixture
+def dead(tmp_path):
+    return DeadLetters(str(tmp_path / 'dead_letter.jsonl'))
+
+def sync(es, items, state, **kwargs):
+    return ingest(es, listed(items), IndexCache({}), state, **dict({'batch_docs': 10, 'in_flight': 2}, **kwargs))
+
+#-----Transform------#
+def test_transform_keeps_the_registry_fields():
+    assert transform(item(1, uid = 'internal', content_id = 7)) == \
+           ('model', '7', {'content_id': 7, 'content_type': 'model', 'name': 'model 1', 'owner': 'mlexchange team'})
+    for broken in ({'content_id': '1'}, {'content_type': 'model'}, item(1, content_id = '')):
+        with pytest.raises(ValueError):
+            transform(broken)
+
+#-----Indices------#
+def test_each_index_is_created_once(es):
+    indices = IndexCache({'mappings': {}})
+    for index in ('model', 'app', 'model'):
+        indices.ensure(es, index)
+    assert es.created == ['model', 'app']
+    # created by someone else in the meantime
+    IndexCache({}).ensure(es, 'model')
+
+def test_index_creation_errors_are_raised(es):
+    def create(index: str, body: dict):
+        raise exceptions.RequestError(400, 'mapper_parsing_exception', {})
+    es.create = create
+    with pytest.raises(exceptions.RequestError):
+        IndexCache({}).ensure(es, 'model')
+
+#-----Bulk Pipeline------#
+def test_items_are_indexed_in_batches(es, state):
+    items = [item(i) for i in range(25)] + [item(i, 'app') for i in range(5)]
+    report = sync(es, items, state)
+    assert es.batches == [10, 10, 10] and es.created == ['model', 'app']
+    assert (report.fetched, report.written, report.failed) == (30, 30, 0)
+    assert report.counts == {'added': 30, 'changed': 0, 'removed': 0, 'skipped': 0}
+
+def test_batches_are_capped_by_payload_size(es, state):
+    sync(es, [item(i, description = 'x' * 100) for i in range(6)], state, batch_bytes = 300)
+    assert es.batches == [2, 2, 2]
+
+def test_invalid_items_are_skipped(es, state):
+    report = sync(es, [item(1), {'name': 'no ids'}, item(2)], state)
+    assert (report.fetched, report.invalid, report.written) == (3, 1, 2)
+
+def test_failures_are_counted_per_document(es, state):
+    es.reject = {'model-3': 400}
+    report = sync(es, [item(i) for i in range(20)], state)
+    assert (report.written, report.failed) == (19, 1)
+    summary = report.summary()
+    assert summary.startswith('Synced 20 registry items with 2 bulk requests')
+    assert '19 added, 0 changed, 0 removed, 0 skipped, 1 failed, 0 invalid' in summary
+    assert 'failed model/model-3 (400)' in summary
+
+def test_failed_bulk_request_fails_the_sync(es, state):
+    es.fail_at = 2
+    with pytest.raises(exceptions.ConnectionError):
+        sync(es, [item(i) for i in range(30)], state, in_flight = 1)
+    # the first batch was confirmed before the failure, the others are left to the next sync
+    assert len(state) == 10
+    assert sync(es, [item(i) for i in range(30)], state).counts == {'added': 20, 'changed': 0, 'removed': 0, 'skipped': 10}
+
+#-----Dead Letters------#
+def dead_sync(es, entries, state, dead, **kwargs):
+    return ingest(es, entries, IndexCache({}), state, dead = dead, batch_docs = 10, in_flight = 1, **kwargs)
+
+def test_bad_records_go_to_the_dead_letters(es, state, dead):
+    es.reject = {'model-3': 400, 'model-4': 503}
+    entries = models(20) + [('models', 'not an object'), ('apps', {'content_id': 'no type'})]
+    report = dead_sync(es, entries, state, dead)
+    assert (report.counts['added'], report.failed, report.invalid) == (18, 2, 2)
+    assert len(state) == 18 and state.get('model', 'model-3') is None
+    assert {key for key, entry in dead.entries.items() if entry['stage'] == 'index'} == {'model/model-3', 'model/model-4'}
+    assert {entry['category'] for entry in dead.entries.values() if entry['stage'] == 'invalid'} == {'models', 'apps'}
+    # written once fixed: the entry is dropped
+    es.reject = {}
+    dead_sync(es, models(20), state, dead)
+    assert 'model/model-3' not in dead.entries and 'model/model-4' not in dead.entries
+
+def test_dead_letters_persist_and_sweep(es, dead):
+    dead.invalid('models', 'broken', ValueError('not an object'))
+    dead.invalid('apps', 'broken', ValueError('not an object'))
+    dead.save()
+    loaded = DeadLetters.load(dead.path)
+    assert loaded.entries == dead.entries and len(loaded) == 2
+    # models was listed in full without its broken item, apps was not listed
+    loaded.sweep(['models'])
+    assert [entry['category'] for entry in loaded.entries.values()] == ['apps']
+
+def test_replay_retries_only_transient_failures(es, state, dead):
+    es.reject = {'model-1': 400, 'model-2': 503, 'model-3': 429}
+    dead_sync(es, models(5) + [('models', 'not an object')], state, dead)
+    assert len(dead) == 4 and sorted(dead.retries()) == ['model/model-2', 'model/model-3']
+    es.reject = {}
+    report = replay(es, dead, IndexCache({}), state)
+    assert report.counts['added'] == 2
+    assert {('model', 'model-2'), ('model', 'model-3')} <= set(es.docs)
+    # a rejected document and an unreadable item would fail the same way: left to the next sync
+    assert ('model', 'model-1') not in es.docs
+    assert len(dead) == 2 and dead.retries() == {}
+
+#-----Checkpoints------#
+def test_crashed_sync_resumes_after_its_checkpoint(es, state, dead, serve):
+    url = serve(local_registry.make_app(60)) + 'api/v0/'
+    es.fail_at = 4
+    with pytest.raises(exceptions.ConnectionError):
+        dead_sync(es, stream_registry(url, ['models']), state, dead, start = {})
+    state.save()
+    checkpoint = SyncState.load(state.path).checkpoints['models']
+    assert checkpoint == {'after': 'model-29', 'items': 30}
+    assert len(es.docs) == 30
+
+    es.fail_at = None
+    state = SyncState.load(state.path)
+    start = state.checkpoints
+    report = dead_sync(es, stream_registry(url, ['models'], start = start), state, dead, start = start,
+                       keep = {'model'})
+    assert report.fetched == 30
+    assert sorted(es.written) == sorted(('model', f'model-{i}') for i in range(60))
+    assert len(state) == 60 and state.checkpoints == {}
+
+def test_resumed_categories_are_not_pruned(es, state, dead):
+    dead_sync(es, models(10), state, dead)
+    resumed = models(10)[5:]
+    dead_sync(es, resumed, state, dead, start = {'models': {'after': 'model-4', 'items': 5}}, keep = {'model'})
+    assert len(state) == 10
+    dead_sync(es, resumed, state, dead)
+    assert len(state) == 5 and ('model', 'model-0') not in es.docs
+
+ITEMS = [{'content_id': f'model-{i}', 'content_type': 'model'} for i in range(10)]
+
+@pytest.mark.parametrize('page_size', [0, 3])
+@pytest.mark.parametrize('registry_items, expected', [
+    (ITEMS, ITEMS[5:]),
+    (ITEMS[:2] + ITEMS[3:], ITEMS[5:]),                     # an earlier item was removed
+    (ITEMS[5:] + ITEMS[:5], []),                            # reordered, the checkpoint item is now last
+    (ITEMS[:4] + ITEMS[5:], ITEMS[:4] + ITEMS[5:]),         # the checkpoint item is gone: read all
+])
+def test_resume_follows_the_checkpoint_item(serve, page_size, registry_items, expected):
+    url = serve(listing(registry_items)) + 'models'
+    assert ids(fetch(url, page_size, start = {'after': 'model-4', 'items': 5})) == ids(expected)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+
+import local_registry
+import registry
+from conftest import _chunked, parse, fetch, listing, ids
+
+#-----Streaming JSON------#
+ITEMS = [{'content_id': 'nested', 'application': [{'deep': [1, [2, {'x': None}]]}], 'public': True},
+         {'content_id': 'escaped', 'description': 'quote " backslash \\ brackets ] } [ { comma , newline \n tab \t'},
+         {'content_id': 'unicode', 'name': 'é 中 😀  '},
+         "]", 0, -1.5e3, None, [], {}]
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 4096])
+def test_iter_json_array_any_chunking(size):
+    assert parse(json.dumps(ITEMS).encode(), size) == ITEMS
+    assert parse(json.dumps(ITEMS, ensure_ascii = False).encode(), size) == ITEMS
+    assert parse(json.dumps(ITEMS, indent = 2).encode(), size) == ITEMS
+
+def test_iter_json_array_empty():
+    assert parse(b'[]') == []
+    assert parse(b' \n[ \n] ') == []
+
+@pytest.mark.parametrize('data', [b'', b'[', b'[{"a": 1}', b'[{"a": 1},', b'[{"a": "unterminated', b'[{"a": 1}, {"b"'])
+def test_iter_json_array_truncated(data):
+    with pytest.raises(ValueError):
+        parse(data, 1)
+
+def test_iter_json_array_truncated_yields_complete_items_first():
+    received = []
+
+    async def collect():
+        async for item in registry.iter_json_array(_chunked(b'[{"a": 1}, {"b": 2}, {"c": ', 4)):
+            received.append(item)
+    with pytest.raises(ValueError):
+        asyncio.run(collect())
+    assert received == [{'a': 1}, {'b': 2}]
+
+@pytest.mark.parametrize('data', [b'{"a": 1}', b'"text"', b'[1 2]', b'[1,]', b'[,1]', b'[1,,2]', b'[{"a": 1}] x',
+                                  b'[1][2]'])
+def test_iter_json_array_rejects_other_documents(data):
+    with pytest.raises(ValueError):
+        parse(data)
+
+def test_iter_json_array_invalid_utf8():
+    with pytest.raises(ValueError):
+        parse(b'["\xff"]')
+
+#-----Pagination------#
+def test_fetch_whole_category(serve):
+    url = serve(local_registry.make_app(25)) + 'api/v0/models'
+    assert ids(fetch(url)) == [f'model-{i}' for i in range(25)]
+
+@pytest.mark.parametrize('page_size', [1, 7, 25, 100])
+def test_fetch_offset_pages(serve, page_size):
+    url = serve(local_registry.make_app(25)) + 'api/v0/models'
+    assert ids(fetch(url, page_size)) == [f'model-{i}' for i in range(25)]
+
+def test_fetch_follows_link_header(serve):
+    url = serve(local_registry.make_app(25, page_size = 6)) + 'api/v0/models'
+    assert ids(fetch(url)) == [f'model-{i}' for i in range(25)]
+
+def test_fetch_stops_when_registry_ignores_page_parameters(serve):
+    items = [{'content_id': f'model-{i}', 'content_type': 'model'} for i in range(5)]
+    url = serve(listing(items, paged = False)) + 'models'
+    assert ids(fetch(url, 5)) == ids(items)
+
+def test_stream_registry_interleaves_categories(serve):
+    url = serve(local_registry.make_app(30))
+    entries = list(registry.stream_registry(url + 'api/v0/', ['models', 'apps', 'workflows']))
+    assert len(entries) == 90
+    for name, content_type in local_registry.CATEGORIES.items():
+        assert [item['content_id'] for category, item in entries if category == name] == \
+               [f'{content_type}-{i}' for i in range(30)]
+
+def test_stream_registry_raises_fetch_errors(serve):
+    url = serve(local_registry.make_app(5))
+    with pytest.raises(aiohttp.ClientResponseError):
+        list(registry.stream_registry(url + 'api/v0/', ['models', 'missing']))
+
+#-----Conditional Requests------#
+def test_fetch_unchanged_category_with_etag(serve):
+    url = serve(local_registry.make_app(10)) + 'api/v0/models'
+    validators = registry.Validators()
+    assert len(fetch(url, validators = validators)) == 10
+    # validators only take effect once the sync that used them is committed
+    assert len(fetch(url, validators = validators)) == 10
+    validators.commit()
+    assert fetch(url, validators = validators) == []
+    assert validators.unchanged == {'model'}
+
+def test_fetch_changed_category_with_etag(serve):
+    old = serve(local_registry.make_app(10))
+    new = serve(local_registry.make_app(10, revision = 1))
+    validators = registry.Validators()
+    fetch(old + 'api/v0/models', validators = validators)
+    validators.commit()
+    headers = validators.headers(old + 'api/v0/models')
+    assert headers['If-None-Match'] == '"models-10-0-0"'
+
+    async def refetch():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(new + 'api/v0/models', headers = headers) as resp:
+                return resp.status, await resp.json()
+    status, items = asyncio.run(refetch())
+    assert status == 200 and len(items) == 10
+
+def test_fetch_paged_category_is_not_conditional(serve):
+    url = serve(local_registry.make_app(10, page_size = 4)) + 'api/v0/models'
+    validators = registry.Validators()
+    fetch(url, validators = validators)
+    validators.commit()
+    assert len(fetch(url, validators = validators)) == 10
+    assert validators.unchanged == set()
@@ -0,0 +1,104 @@
+import json
+
+import pytest
+
+from ingest import ingest, digest, transform, IndexCache
+from sync_state import SyncState, STATE_VERSION
+from test_ingest import item, listed
+
+@pytest.fixture
+def state(tmp_path):
+    return SyncState(str(tmp_path / 'sync_state.json'))
+
+def sync(es, items, state, **kwargs):
+    return ingest(es, listed(items), IndexCache({}), state, **dict({'batch_docs': 10, 'in_flight': 2}, **kwargs))
+
+#-----State File------#
+def test_state_round_trip(state):
+    state.set('model', '1', 'abc')
+    state.save()
+    loaded = SyncState.load(state.path)
+    assert loaded.indices == {'model': {'1': 'abc'}} and len(loaded) == 1
+    assert SyncState.load(state.path + '.missing').indices == {}
+
+def test_state_of_another_version_is_ignored(state):
+    with open(state.path, 'w') as f:
+        json.dump({'version': STATE_VERSION + 1, 'indices': {'model': {'1': 'abc'}}}, f)
+    assert SyncState.load(state.path).indices == {}
+    with open(state.path, 'w') as f:
+        f.write('{not json')
+    assert SyncState.load(state.path).indices == {}
+
+#-----Incremental Sync------#
+def test_unchanged_items_are_skipped(es, state):
+    items = [item(i) for i in range(5)]
+    sync(es, items, state)
+    report = sync(es, items[:3] + [item(3, owner = 'someone else'), item(4), item(5)], state)
+    assert report.counts == {'added': 1, 'changed': 1, 'removed': 0, 'skipped': 4}
+    assert es.written[5:] == [('model', 'model-3'), ('model', 'model-5')]
+    assert state.get('model', 'model-3') == digest(transform(item(3, owner = 'someone else'))[2])
+
+def test_documents_leaving_the_registry_are_deleted(es, state):
+    sync(es, [item(i) for i in range(3)] + [item(1, 'app')], state)
+    report = sync(es, [item(0)], state)
+    assert report.counts == {'added': 0, 'changed': 0, 'removed': 3, 'skipped': 1}
+    assert list(es.docs) == [('model', 'model-0')] and len(state) == 1
+    # a document someone else already deleted counts as removed
+    state.set('model', 'model-9', 'abc')
+    assert sync(es, [item(0)], state).counts['removed'] == 1 and len(state) == 1
+
+def test_full_sync_rewrites_everything(es, state):
+    items = [item(i) for i in range(3)]
+    sync(es, items, state)
+    assert sync(es, items, state, full = True).counts == {'added': 0, 'changed': 3, 'removed': 0, 'skipped': 0}
+
+def test_state_only_records_confirmed_writes(es, state):
+    es.reject = {'model-1': 429}
+    sync(es, [item(i) for i in range(3)], state)
+    assert state.ids('model') == {'model-0', 'model-2'}
+    es.reject = {}
+    assert sync(es, [item(i) for i in range(3)], state).counts['added'] == 1
+
+def test_state_is_kept_when_the_fetch_fails(es, state):
+    def items():
+        yield from (item(i) for i in range(15))
+        raise ConnectionError('registry down')
+    sync(es, [item(20)], state)
+    with pytest.raises(ConnectionError):
+        sync(es, items(), state)
+    # the batch that was sent is recorded, nothing is deleted before the registry was read in full
+    assert state.ids('model') == {f'model-{i}' for i in (*range(10), 20)}
+    assert ('model', 'model-20') in es.docs
+
+#-----Verify------#
+def test_verify_rebuilds_a_missing_index(es, state):
+    sync(es, [item(i) for i in range(3)] + [item(1, 'app')], state)
+    del es.docs[('app', 'app-1')]
+    es.created.remove('app')
+    assert state.verify(es) == ['app'] and es.listings == 1
+    assert state.ids('app') == set() and len(state.ids('model')) == 3
+    assert sync(es, [item(i) for i in range(3)] + [item(1, 'app')], state).counts['added'] == 1
+
+def test_verify_reads_back_an_index_missing_documents(es, state):
+    sync(es, [item(i) for i in range(3)], state)
+    del es.docs[('model', 'model-1')]
+    es.docs[('model', 'model-2')] = dict(es.docs[('model', 'model-2')], owner = 'edited')
+    assert state.verify(es) == ['model']
+    report = sync(es, [item(i) for i in range(3)], state)
+    assert report.counts == {'added': 1, 'changed': 1, 'removed': 0, 'skipped': 1}
+    assert state.verify(es) == [] and es.listings == 2
+
+def test_state_is_only_saved_when_changed(es, state, tmp_path):
+    items = [item(i) for i in range(3)]
+    sync(es, items, state)
+    state.save()
+    (tmp_path / 'sync_state.json').unlink()
+    # nothing changed, so nothing is written
+    sync(es, items, state)
+    state.save()
+    assert not (tmp_path / 'sync_state.json').exists()
+
+def test_unchanged_categories_keep_their_documents(es, state):
+    sync(es, [item(i) for i in range(3)] + [item(1, 'app')], state)
+    report = sync(es, [item(i) for i in range(3)], state, keep = {'app'})
+    assert report.counts['removed'] == 0 and state.ids('app') == {'app-1'}